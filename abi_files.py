@@ -0,0 +1,14 @@
+import os
+import json
+from functools import lru_cache
+
+# ABI лежат в репозитории рядом с кодом: abi/<протокол>/<Контракт>.v<N>.json.
+# Версия в имени файла меняется вместе с ABI, чтобы старый и новый контракт могли жить рядом
+ABI_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "abi")
+
+
+@lru_cache(maxsize=None)
+def load_abi(name: str) -> list:
+    """Vendored ABI by name, e.g. load_abi("euler/AccountLens.v1"); read from disk once."""
+    with open(os.path.join(ABI_DIR, f"{name}.json")) as f:
+        return json.load(f)
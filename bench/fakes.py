@@ -0,0 +1,302 @@
+"""Local stand-ins for every upstream the bot talks to, on one HTTP port.
+
+    /rpc        Ethereum JSON-RPC: single and batch requests, eth_getBalance,
+                eth_call (Multicall3.aggregate3 and the Compound / Euler /
+                ERC-20 getters the bot reads), eth_chainId, eth_blockNumber
+    /esplora    Esplora: /blocks/tip/height, /address/<addr>
+    /pendle     Pendle dashboard: /core/v1/dashboard/positions/database/<addr>
+    /coingecko  CoinGecko: /api/v3/simple/price, /api/v3/simple/token_price/ethereum
+    /__stats    request counters as JSON (used by the benchmark driver)
+
+Answers are deterministic functions of the address, so repeated runs see the
+same portfolio. Latency, 429s and the max JSON-RPC batch size are configurable:
+
+    python bench/fakes.py --port 8900 --rpc-latency 0.05 --rpc-429-rate 0.02
+
+The first line printed is the base URL, e.g. http://127.0.0.1:8900.
+"""
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from collections import Counter
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import eth_abi
+from eth_utils import to_checksum_address, function_abi_to_4byte_selector
+from web3._utils.abi import get_abi_input_types, get_abi_output_types
+
+from abi_files import load_abi
+from compound import COMET_ABI, ERC20_ABI as COMPOUND_ERC20_ABI
+from rpc_manager import MULTICALL3_ADDRESS, MULTICALL3_ABI
+
+PENDLE_PREFIX = "/core/v1/dashboard/positions/database/"
+ZERO_ADDRESS = "0x" + "00" * 20
+N_COLLATERALS = 4
+TIP_HEIGHT = 850_000
+PRICES_USD = {"bitcoin": 60_000.0, "ethereum": 3_000.0, "tether": 1.0}
+RUB_PER_USD = 90.0
+
+
+def _seed(addr: str) -> int:
+    """Stable per-address number, so every upstream agrees on one wallet."""
+    return int(hashlib.sha256(addr.lower().encode()).hexdigest()[:12], 16)
+
+def _price(usd: float, currency: str) -> float:
+    return usd * RUB_PER_USD if currency == "rub" else usd
+
+def _token(i: int) -> str:
+    return to_checksum_address(f"0x{0xE000 + i:040x}")
+
+
+# ---------- ответы на eth_call ----------
+def _default(output: dict):
+    """Zero value of one ABI output, recursing into tuples."""
+    kind = output["type"]
+    if kind.endswith("]"):
+        return []
+    if kind == "tuple":
+        return tuple(_default(c) for c in output["components"])
+    if kind == "address":
+        return ZERO_ADDRESS
+    if kind == "bool":
+        return False
+    if kind == "string":
+        return ""
+    if kind == "bytes":
+        return b""
+    if kind.startswith("bytes"):
+        return b"\0" * int(kind[5:])
+    return 0
+
+def _vault_account_info(fn_abi, account, vault):
+    info = list(_default(fn_abi["outputs"][0]))
+    info[1], info[2], info[3] = account, vault, _token(0)
+    info[6] = 10 ** 18 * (_seed(account) % 5)  # VaultAccountInfo.assets
+    return (tuple(info),)
+
+# Значения по имени функции; всё остальное — нули нужной формы
+VALUES = {
+    "baseToken": lambda fn_abi: (_token(100),),
+    "baseScale": lambda fn_abi: (10 ** 6,),
+    "numAssets": lambda fn_abi: (N_COLLATERALS,),
+    "getAssetInfo": lambda fn_abi, i: ((i, _token(i), ZERO_ADDRESS, 10 ** 18, 0, 0, 0),),
+    "balanceOf": lambda fn_abi, account: ((_seed(account) % 10_000) * 10 ** 6,),
+    "borrowBalanceOf": lambda fn_abi, account: ((_seed(account) % 7) * 10 ** 6,),
+    "collateralBalanceOf": lambda fn_abi, account, asset: ((_seed(account + asset) % 3) * 10 ** 17,),
+    "symbol": lambda fn_abi: ("TKN",),
+    "decimals": lambda fn_abi: (18,),
+    "getVaultAccountInfo": _vault_account_info,
+}
+
+
+class Contracts:
+    """Selector → (function ABI, input types, output types) over every ABI the bot reads."""
+
+    def __init__(self):
+        self.functions = {}
+        for abi in (COMET_ABI, COMPOUND_ERC20_ABI, load_abi("euler/AccountLens.v1"),
+                    load_abi("euler/EVC.v1"), load_abi("erc20/ERC20.v1")):
+            for fn_abi in abi:
+                if fn_abi.get("type") != "function":
+                    continue
+                selector = function_abi_to_4byte_selector(fn_abi)
+                self.functions.setdefault(
+                    selector, (fn_abi, get_abi_input_types(fn_abi), get_abi_output_types(fn_abi))
+                )
+        aggregate3 = next(f for f in MULTICALL3_ABI if f["name"] == "aggregate3")
+        self.aggregate3 = function_abi_to_4byte_selector(aggregate3)
+
+    def call(self, data: bytes):
+        """Return data of one eth_call, or None for a revert (unknown selector)."""
+        known = self.functions.get(data[:4])
+        if known is None:
+            return None
+        fn_abi, input_types, output_types = known
+        args = eth_abi.decode(input_types, data[4:]) if input_types else ()
+        make = VALUES.get(fn_abi["name"])
+        value = make(fn_abi, *args) if make else tuple(_default(o) for o in fn_abi["outputs"])
+        return eth_abi.encode(output_types, value)
+
+    def multicall(self, data: bytes, stats):
+        (calls,) = eth_abi.decode(["(address,bool,bytes)[]"], data[4:])
+        stats["rpc.multicall_subcalls"] += len(calls)
+        results = []
+        for _, _, calldata in calls:
+            out = self.call(calldata)
+            results.append((out is not None, out or b""))
+        return eth_abi.encode(["(bool,bytes)[]"], [results])
+
+
+# ---------- сервер ----------
+class Upstreams:
+    def __init__(self, rpc_latency=0.0, rpc_429_rate=0.0, rpc_max_batch=100,
+                 esplora_latency=0.0, pendle_latency=0.0, coingecko_latency=0.0):
+        self.rpc_latency = rpc_latency
+        self.rpc_429_rate = rpc_429_rate
+        self.rpc_max_batch = rpc_max_batch
+        self.latency = {"esplora": esplora_latency, "pendle": pendle_latency, "coingecko": coingecko_latency}
+        self.contracts = Contracts()
+        self.stats = Counter()
+        self.lock = threading.Lock()
+        self.random = random.Random(0)
+
+    def count(self, **counts):
+        with self.lock:
+            self.stats.update(counts)
+
+    # ── JSON-RPC ──
+    def rpc(self, body):
+        """(status, payload, headers) for one POST."""
+        self.count(**{"rpc.http": 1})
+        time.sleep(self.rpc_latency)
+        with self.lock:
+            limited = self.random.random() < self.rpc_429_rate
+        if limited:
+            self.count(**{"rpc.429": 1})
+            return 429, {"error": "rate limited"}, {"Retry-After": "1"}
+        if isinstance(body, list):
+            if len(body) > self.rpc_max_batch:
+                self.count(**{"rpc.batch_too_large": 1})
+                return 200, {"jsonrpc": "2.0", "id": None,
+                             "error": {"code": -32600, "message": f"batch limit is {self.rpc_max_batch}"}}, {}
+            return 200, [self.rpc_one(item) for item in body], {}
+        return 200, self.rpc_one(body), {}
+
+    def rpc_one(self, item):
+        method, params = item.get("method"), item.get("params") or []
+        stats = Counter({f"rpc.{method}": 1})
+        try:
+            if method == "eth_chainId":
+                result = "0x1"
+            elif method == "eth_blockNumber":
+                result = hex(20_000_000)
+            elif method == "eth_getBalance":
+                result = hex((_seed(params[0]) % 100) * 10 ** 16)
+            elif method == "eth_call":
+                tx = params[0]
+                data = bytes.fromhex((tx.get("data") or tx.get("input") or "0x")[2:])
+                if tx["to"].lower() == MULTICALL3_ADDRESS.lower() and data[:4] == self.contracts.aggregate3:
+                    out = self.contracts.multicall(data, stats)
+                else:
+                    out = self.contracts.call(data)
+                    if out is None:
+                        return {"jsonrpc": "2.0", "id": item.get("id"),
+                                "error": {"code": 3, "message": "execution reverted"}}
+                result = "0x" + out.hex()
+            else:
+                return {"jsonrpc": "2.0", "id": item.get("id"),
+                        "error": {"code": -32601, "message": f"method {method} not supported"}}
+        finally:
+            self.count(**stats)
+        return {"jsonrpc": "2.0", "id": item.get("id"), "result": result}
+
+    # ── HTTP API ──
+    def get(self, service, path, query):
+        self.count(**{f"{service}.http": 1})
+        time.sleep(self.latency[service])
+        if service == "esplora":
+            if path == "/blocks/tip/height":
+                return 200, TIP_HEIGHT
+            if path.startswith("/address/"):
+                seed = _seed(path[len("/address/"):])
+                return 200, {
+                    "chain_stats": {"funded_txo_sum": seed % 10 ** 8 + 10 ** 6, "spent_txo_sum": 10 ** 6,
+                                    "tx_count": seed % 50},
+                    "mempool_stats": {"funded_txo_sum": 0, "spent_txo_sum": 0, "tx_count": 0},
+                }
+        elif service == "pendle":
+            if path.startswith(PENDLE_PREFIX):
+                seed = _seed(path[len(PENDLE_PREFIX):])
+                return 200, {"positions": [{"openPositions": [{"lp": {"valuation": seed % 5000 + 0.25}}]}]}
+        elif service == "coingecko":
+            currencies = query.get("vs_currencies", [""])[0].split(",")
+            if path == "/api/v3/simple/price":
+                ids = query.get("ids", [""])[0].split(",")
+                return 200, {coin: {c: _price(PRICES_USD.get(coin, 1.0), c) for c in currencies} for coin in ids}
+            if path == "/api/v3/simple/token_price/ethereum":
+                tokens = query.get("contract_addresses", [""])[0].split(",")
+                return 200, {t.lower(): {c: _price(1.0, c) for c in currencies} for t in tokens}
+        return 404, {"error": "not found"}
+
+
+def make_handler(upstreams: Upstreams):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, как у настоящих апстримов
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, status, payload, headers=None):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"null")
+            if urlsplit(self.path).path.rstrip("/") != "/rpc":
+                return self._reply(404, {"error": "not found"})
+            self._answer(upstreams.rpc, body)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == "/__stats":
+                with upstreams.lock:
+                    return self._reply(200, dict(upstreams.stats))
+            service, _, rest = url.path.lstrip("/").partition("/")
+            if service not in upstreams.latency:
+                return self._reply(404, {"error": "not found"})
+            self._answer(upstreams.get, service, "/" + rest, parse_qs(url.query))
+
+        def _answer(self, handler, *args):
+            # Ошибка стенда должна дойти до клиента 500-м, а не оборванным соединением
+            try:
+                reply = handler(*args)
+            except Exception as e:
+                upstreams.count(**{"fake_errors": 1})
+                print(f"fake upstream error: {e!r}", file=sys.stderr)
+                reply = (500, {"error": repr(e)})
+            self._reply(*reply)
+
+    return Handler
+
+
+def serve(port=0, **options):
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(Upstreams(**options)))
+    server.daemon_threads = True
+    print(f"http://127.0.0.1:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--rpc-latency", type=float, default=0.0, help="seconds per JSON-RPC POST")
+    parser.add_argument("--rpc-429-rate", type=float, default=0.0, help="share of POSTs answered with 429")
+    parser.add_argument("--rpc-max-batch", type=int, default=100)
+    parser.add_argument("--esplora-latency", type=float, default=0.0)
+    parser.add_argument("--pendle-latency", type=float, default=0.0)
+    parser.add_argument("--coingecko-latency", type=float, default=0.0)
+    args = parser.parse_args()
+    ThreadingHTTPServer.request_queue_size = 256  # тысячи адресов — сотни соединений разом
+    serve(**vars(args))
+
+
+if __name__ == "__main__":
+    main()
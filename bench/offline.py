@@ -0,0 +1,262 @@
+"""Offline benchmark: the bot's hot paths against local stand-ins (bench/fakes.py).
+
+Every upstream — JSON-RPC, Esplora, Pendle, CoinGecko — is replaced by the
+fake server running in a child process, so numbers don't depend on public
+node moods, and the memory peak is only the bot's own. For 1/10/100/1000
+addresses it drives
+
+    eth_balances    rpc_manager.get_balances_concurrent
+    btc_balances    btc.get_balances_btc
+    compound        daemon.refresh_positions (fetch_comet_positions batches,
+                    fetch_comet_position-style single reads on failure)
+    pendle          pendle.fetch_pendle_positions
+    portfolio_cmd   main.portfolio_cmd with a fake Telegram update, live path
+                    (no precomputed snapshot), addresses half ETH, half BTC
+
+and reports p50/p99 latency, upstream requests per run and the tracemalloc
+peak of one extra run. Per-address caches (RPC, BTC balances, Pendle, Euler
+discovery) are cleared before every run; process-wide tables (Compound market
+metadata, CoinGecko prices) stay warm, as in the running bot.
+
+    python bench/offline.py [--runs 10] [--sizes 1,10,100,1000] [--only portfolio_cmd]
+                            [--rpc-latency 0.03] [--rpc-429-rate 0.02] ...
+"""
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import hashlib
+import logging
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+import urllib.request
+from collections import Counter
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SIZES = (1, 10, 100, 1000)
+UPSTREAMS = ("rpc", "esplora", "pendle", "coingecko")
+
+
+def eth_address(i: int) -> str:
+    from eth_utils import to_checksum_address
+    return to_checksum_address("0x" + hashlib.sha256(f"eth{i}".encode()).hexdigest()[:40])
+
+def btc_address(i: int) -> str:
+    return "bc1q" + hashlib.sha256(f"btc{i}".encode()).hexdigest()[:38]
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+# ---------- стенды ----------
+def start_fakes(args):
+    """Run bench/fakes.py in a child process; returns (process, base URL)."""
+    cmd = [sys.executable, os.path.join(ROOT, "bench", "fakes.py")]
+    for name in ("rpc_latency", "rpc_429_rate", "rpc_max_batch", "esplora_latency", "pendle_latency", "coingecko_latency"):
+        cmd += ["--" + name.replace("_", "-"), str(getattr(args, name))]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    base = proc.stdout.readline().strip()
+    if not base.startswith("http"):
+        proc.kill()
+        raise SystemExit("fake upstreams failed to start")
+    return proc, base
+
+def point_clients_at(base, args):
+    """Swap every upstream URL for the fake server."""
+    import btc
+    import pendle
+    from cg import price_service
+    from rpc_manager import rpc_manager
+
+    rpc_url = f"{base}/rpc"
+    rpc_manager.rpc_endpoints = [rpc_url]
+    rpc_manager.batch_sizes[rpc_url] = args.rpc_max_batch
+    btc.ESPLORA_URLS[:] = [f"{base}/esplora"]
+    pendle.rpc = f"{base}/pendle/core/v1/dashboard/positions/database/"
+    price_service._client.api_base_url = f"{base}/coingecko/api/v3/"
+
+def upstream_stats(base) -> Counter:
+    with urllib.request.urlopen(f"{base}/__stats") as resp:
+        return Counter(json.load(resp))
+
+def reset_caches():
+    import btc
+    import euler
+    import pendle
+    import history
+    from precompute import precomputer
+    from rpc_manager import rpc_manager
+
+    rpc_manager.cache.clear()
+    btc._balance_cache.clear()
+    btc._tip = (0.0, None)
+    pendle._cache.clear()
+    euler._discovered.clear()
+    precomputer.snapshots.clear()
+    history._last_recorded.clear()
+
+
+# ---------- сценарии ----------
+class FakeMessage:
+    """Telegram message stand-in; remembers the last text sent or edited in."""
+
+    def __init__(self, text=None):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        reply = FakeMessage(text)
+        self.replies.append(reply)
+        return reply
+
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+        return self
+
+async def setup_portfolio_users(sizes):
+    """One user per size, holding that many addresses (half ETH, half BTC).
+
+    Compound snapshots are filled once, as the daemon would have done.
+    """
+    from db import init_db_sync, open_db, add_address
+    from daemon import refresh_compound
+
+    init_db_sync()
+    await open_db()
+    for n in sizes:
+        for i in range(n):
+            await add_address(n, eth_address(i) if i % 2 == 0 else btc_address(i))
+    await refresh_compound()
+
+def errors_in(result) -> int:
+    if isinstance(result, dict):
+        return sum(isinstance(v, Exception) for v in result.values())
+    if isinstance(result, str):  # текст портфеля
+        return result.count("ошибк") + result.count("нет данных")
+    return 0
+
+async def run_portfolio_cmd(n):
+    """Returns the final portfolio text the user would see."""
+    from main import portfolio_cmd
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=n), message=FakeMessage())
+    await portfolio_cmd(update, SimpleNamespace(args=[]))
+    return update.message.replies[-1].text
+
+def scenarios():
+    from btc import get_balances_btc
+    from daemon import refresh_positions
+    from pendle import fetch_pendle_positions
+    from rpc_manager import get_balances_concurrent
+
+    eth = lambda n: [eth_address(i) for i in range(n)]
+    return {
+        "eth_balances": lambda n: get_balances_concurrent(eth(n)),
+        "btc_balances": lambda n: get_balances_btc([btc_address(i) for i in range(n)]),
+        "compound": lambda n: refresh_positions(eth(n)),
+        "pendle": lambda n: fetch_pendle_positions(eth(n)),
+        "portfolio_cmd": run_portfolio_cmd,
+    }
+
+async def measure(base, make_call, n, runs):
+    latencies, errors = [], 0
+    calls = Counter()
+    for _ in range(runs):
+        reset_caches()
+        before = upstream_stats(base)
+        started = time.perf_counter()
+        result = await make_call(n)
+        latencies.append(time.perf_counter() - started)
+        calls += upstream_stats(base) - before
+        errors += errors_in(result)
+
+    reset_caches()
+    tracemalloc.start()
+    try:
+        await make_call(n)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "calls": {name: calls[f"{name}.http"] / runs for name in UPSTREAMS},
+        "subcalls": calls["rpc.multicall_subcalls"] / runs,
+        "rpc_429": calls["rpc.429"] / runs,
+        "errors": errors / runs,
+        "peak_mb": peak / 2 ** 20,
+    }
+
+def format_row(name, n, r):
+    calls = " ".join(f"{k}={v:g}" for k, v in r["calls"].items() if v)
+    extra = f" subcalls={r['subcalls']:g}" if r["subcalls"] else ""
+    extra += f" 429={r['rpc_429']:g}" if r["rpc_429"] else ""
+    extra += f" ERRORS={r['errors']:g}" if r["errors"] else ""
+    return (
+        f"{name:14s} {n:5d}  p50 {r['p50'] * 1000:8.1f} ms  p99 {r['p99'] * 1000:8.1f} ms  "
+        f"peak {r['peak_mb']:6.1f} MB  {calls}{extra}"
+    )
+
+async def bench(base, args):
+    from db import close_db
+
+    point_clients_at(base, args)
+    table = scenarios()
+    names = args.only.split(",") if args.only else list(table)
+    sizes = [int(s) for s in args.sizes.split(",")]
+    if "portfolio_cmd" in names:
+        await setup_portfolio_users(sizes)
+
+    report = {}
+    try:
+        for name in names:
+            await table[name](1)  # прогрев: импорты, web3-кодек, метаданные рынков, цены
+            for n in sizes:
+                result = await measure(base, table[name], n, args.runs)
+                report[f"{name}/{n}"] = result
+                print(format_row(name, n, result), flush=True)
+    finally:
+        await close_db()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)))
+    parser.add_argument("--only", default="", help="comma-separated scenario names")
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--rpc-latency", type=float, default=0.03)
+    parser.add_argument("--rpc-429-rate", type=float, default=0.0)
+    parser.add_argument("--rpc-max-batch", type=int, default=100)
+    parser.add_argument("--esplora-latency", type=float, default=0.03)
+    parser.add_argument("--pendle-latency", type=float, default=0.05)
+    parser.add_argument("--coingecko-latency", type=float, default=0.1)
+    args = parser.parse_args()
+
+    os.environ.setdefault("TELEGRAM_TOKEN", "0:bench")
+    json_path = os.path.abspath(args.json) if args.json else None
+    proc, base = start_fakes(args)
+    workdir = tempfile.TemporaryDirectory()
+    os.chdir(workdir.name)  # своя wallets.db, рабочая не трогается
+    try:
+        import main as bot  # noqa: F401 — настраивает логирование, его и приглушаем
+        logging.getLogger().setLevel(logging.CRITICAL)
+        report = asyncio.run(bench(base, args))
+    finally:
+        proc.terminate()
+        proc.wait()
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Bot cold-start benchmark: how long `import main` takes in a fresh interpreter.
+
+Every run happens in a new process with sockets disabled, so any network
+access at import time fails the run instead of silently slowing it down.
+Also times the first Web3 use (contract build), which is now deferred to
+the first request.
+
+    python bench/startup.py [runs]
+"""
+import os
+import sys
+import json
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = r"""
+import json, socket, sys, time
+
+def _no_network(*args, **kwargs):
+    raise RuntimeError("network access during startup")
+socket.socket.connect = _no_network
+socket.create_connection = _no_network
+socket.getaddrinfo = _no_network
+
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+web3_loaded = "web3" in sys.modules
+from euler import get_lens
+get_lens()
+first_use = time.perf_counter()
+print(json.dumps({
+    "import": imported - started,
+    "first_web3_use": first_use - imported,
+    "web3_at_import": web3_loaded,
+}))
+"""
+
+
+def run_once():
+    env = dict(os.environ, TELEGRAM_TOKEN=os.getenv("TELEGRAM_TOKEN", "0:bench"))
+    out = subprocess.run(
+        [sys.executable, "-c", PROBE], cwd=ROOT, env=env, capture_output=True, text=True, timeout=60,
+    )
+    if out.returncode != 0:
+        raise SystemExit(f"startup probe failed:\n{out.stderr}")
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    samples = [run_once() for _ in range(runs)]
+    for name in ("import", "first_web3_use"):
+        values = sorted(s[name] for s in samples)
+        print(
+            f"{name:15s} median {statistics.median(values) * 1000:7.1f} ms  "
+            f"max {values[-1] * 1000:7.1f} ms  ({runs} runs)"
+        )
+    if any(s["web3_at_import"] for s in samples):
+        print("warning: web3 is imported at startup")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,167 @@
+import os
+import time
+import random
 import asyncio
+import logging
 from decimal import Decimal
-import requests
+from typing import Optional
+import httpx
+from singleflight import SingleFlight
+from http_pool import UpstreamPool
+from metrics import CACHE_LOOKUPS, time_upstream, endpoint_label
+from tracing import span, incr
+
+logger = logging.getLogger(__name__)
+
+# Esplora-совместимые API по приоритету; свой esplora ставим первым через ESPLORA_URLS
+ESPLORA_URLS = [
+    url.strip().rstrip("/")
+    for url in os.getenv("ESPLORA_URLS", "https://blockstream.info/api,https://mempool.space/api").split(",")
+    if url.strip()
+]
+MAX_CONCURRENCY = int(os.getenv("ESPLORA_MAX_CONCURRENCY", "16"))
+TIMEOUT = 10
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.5      # сек, удваивается на каждой попытке, плюс джиттер
+FAILURE_COOLDOWN = 60   # сек, на которые упавший base URL уходит в конец очереди
+# Кэш балансов живёт до нового блока; входящие mempool-транзакции подхватываем по таймеру
+TIP_TTL = 15                                                    # сек между запросами высоты
+MEMPOOL_REFRESH = int(os.getenv("BTC_MEMPOOL_REFRESH", "60"))    # адреса с неподтверждёнными tx
+MEMPOOL_MAX_AGE = int(os.getenv("BTC_MEMPOOL_MAX_AGE", "300"))   # все остальные
+
+_pool = UpstreamPool(MAX_CONCURRENCY, TIMEOUT, http2=True)
+_failed_until = {}  # base URL → timestamp, до которого он в немилости
+
+# Одновременные запросы одного и того же адреса делят один HTTP-запрос
+_single_flight = SingleFlight()
+
+_tip = (0.0, None)      # (fetched_at, height)
+_balance_cache = {}     # addr → BalanceEntry
+
+
+class BalanceEntry:
+    """Cached balance of one address with the chain state it was read at."""
+
+    def __init__(self, balance: int, tip_height: int, chain_tx_count: int, mempool_tx_count: int):
+        self.balance = balance
+        self.tip_height = tip_height
+        self.chain_tx_count = chain_tx_count
+        self.mempool_tx_count = mempool_tx_count
+        self.fetched_at = time.time()
+
+    def is_fresh(self, tip_height: Optional[int]) -> bool:
+        """Still valid while no block arrived; pending mempool activity shortens the lifetime."""
+        if tip_height is None or tip_height != self.tip_height:
+            return False
+        max_age = MEMPOOL_REFRESH if self.mempool_tx_count else MEMPOOL_MAX_AGE
+        return time.time() - self.fetched_at < max_age
 
-API_URL = "https://blockstream.info/api/address/{addr}"  # нужный префикс /api/! :contentReference[oaicite:0]{index=0}
 
 def satoshi_to_btc(value: int) -> str:
     """Красиво конвертируем сатоши → BTC c 8 знаками."""
     return Decimal(value) / Decimal(1e8)
 
-def fetch_balance_btc(addr: str) -> int:
+async def aclose():
+    """Закрываем общий HTTP-клиент (при остановке бота)."""
+    await _pool.aclose()
+
+def _ordered_base_urls() -> list[str]:
+    """Base URLs in priority order, recently failed ones last."""
+    now = time.time()
+    return sorted(ESPLORA_URLS, key=lambda url: _failed_until.get(url, 0) > now)
+
+async def esplora_get(path: str):
+    """GET an Esplora path with failover across base URLs and jittered retries; returns parsed JSON."""
+    last_exception = None
+    tries = 0
+    with span("esplora", request=path.split("/")[1]) as trace_span:
+        for attempt in range(MAX_RETRIES):
+            for base_url in _ordered_base_urls():
+                trace_span.set(endpoint=endpoint_label(base_url), retries=tries)
+                tries += 1
+                try:
+                    async with _pool.semaphore():
+                        with time_upstream("esplora"):
+                            resp = await _pool.client().get(f"{base_url}{path}")
+                            resp.raise_for_status()
+                    return resp.json()
+                except httpx.HTTPStatusError as e:
+                    status = e.response.status_code
+                    if status == 400:
+                        # Кривой адрес — другие серверы скажут то же самое
+                        raise
+                    logger.warning(f"Esplora {base_url} error for {path}: {status}")
+                    last_exception = e
+                    # В немилость — только перегруженный или сломанный сервер, а не 404 на чужой адрес
+                    if status == 429 or status >= 500:
+                        _failed_until[base_url] = time.time() + FAILURE_COOLDOWN
+                except httpx.HTTPError as e:
+                    logger.warning(f"Esplora {base_url} request failed for {path}: {e!r}")
+                    last_exception = e
+                    _failed_until[base_url] = time.time() + FAILURE_COOLDOWN
+
+            if attempt == MAX_RETRIES - 1:
+                break
+            delay = BACKOFF_BASE * 2 ** attempt
+            await asyncio.sleep(delay + random.uniform(0, delay))
+
+        raise last_exception or Exception("All Esplora endpoints failed")
+
+async def get_tip_height() -> Optional[int]:
+    """Current chain tip height, re-read at most every TIP_TTL seconds; None if unavailable."""
+    global _tip
+    fetched_at, height = _tip
+    if height is not None and time.time() - fetched_at < TIP_TTL:
+        return height
+    try:
+        height = int(await _single_flight.do("tip", esplora_get, "/blocks/tip/height"))
+    except Exception as e:
+        logger.warning(f"Failed to read BTC tip height, bypassing balance cache: {e}")
+        return None
+    _tip = (time.time(), height)
+    return height
+
+async def fetch_balance_btc(addr: str, tip_height: Optional[int] = None) -> int:
+    """Запрашиваем баланс адреса в сатоши.
+
+    Пока не пришёл новый блок, отдаём баланс из кэша; одновременные
+    запросы одного адреса схлопываются.
+    """
+    if tip_height is None:
+        tip_height = await get_tip_height()
+    entry = _balance_cache.get(addr)
+    if entry is not None and entry.is_fresh(tip_height):
+        CACHE_LOOKUPS.inc(cache="btc_balance", result="hit")
+        incr("cache_hits")
+        return entry.balance
+    CACHE_LOOKUPS.inc(cache="btc_balance", result="miss")
+    entry = await _single_flight.do(addr, _fetch_balance_btc, addr, tip_height)
+    return entry.balance
+
+async def _fetch_balance_btc(addr: str, tip_height: Optional[int]) -> BalanceEntry:
     """Запрашиваем баланс адреса в сатоши."""
-    resp = requests.get(API_URL.format(addr=addr), timeout=10)
-    resp.raise_for_status()
-    data = resp.json()
+    data = await esplora_get(f"/address/{addr}")
 
     # Документация: поля funded_txo_sum / spent_txo_sum в объектах chain_stats и mempool_stats
-    # баланс = получено − потрачено (и в mempool тоже)  :contentReference[oaicite:1]{index=1}
+    # баланс = получено − потрачено (и в mempool тоже)
     chain = data["chain_stats"]
     mempool = data["mempool_stats"]
 
     confirmed = chain["funded_txo_sum"] - chain["spent_txo_sum"]
     unconfirmed = mempool["funded_txo_sum"] - mempool["spent_txo_sum"]
 
-    return confirmed + unconfirmed
+    entry = BalanceEntry(confirmed + unconfirmed, tip_height, chain["tx_count"], mempool["tx_count"])
+    if tip_height is not None:
+        previous = _balance_cache.get(addr)
+        if previous is not None and previous.chain_tx_count != entry.chain_tx_count:
+            logger.info(f"BTC address {addr[:10]}… has new confirmed transactions")
+        _balance_cache[addr] = entry
+    return entry
 
 async def get_balances_btc(addresses: list[str]) -> dict[str, int]:
-    """Асинхронно получаем балансы всех адресов."""
-    tasks = [asyncio.to_thread(fetch_balance_btc, a) for a in addresses]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-    return dict(zip(addresses, results))
\ No newline at end of file
+    """Асинхронно получаем балансы всех адресов (одна проверка высоты на всех)."""
+    with span("btc.balances", addresses=len(addresses), cache_hits=0):
+        tip_height = await get_tip_height()
+        tasks = [fetch_balance_btc(a, tip_height) for a in addresses]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    return dict(zip(addresses, results))
@@ -1,8 +1,168 @@
+import time
+import asyncio
+import logging
 from pycoingecko import CoinGeckoAPI
+from singleflight import SingleFlight
+from metrics import time_upstream
+from tracing import span, incr
 
-def get_prices(ids, vs_currencies):
-	cg = CoinGeckoAPI()
-	return cg.get_price(ids, vs_currencies)
+logger = logging.getLogger(__name__)
 
+REFRESH_INTERVAL = 60   # сек между фоновыми обновлениями
+STALE_AFTER = 15 * 60   # после этого цены считаются протухшими (но всё ещё отдаются)
 
-#print(get_prices("bitcoin", "usd,rub")["bitcoin"]['usd'])
+
+class PriceService:
+    """Process-wide CoinGecko price table, refreshed in the background.
+
+    Reads come from memory. New coins/currencies are tracked as soon as
+    someone asks for them; if a refresh fails the last good prices stay
+    in place (stale-while-error).
+    """
+
+    def __init__(self, coins=(), currencies=(), refresh_interval=REFRESH_INTERVAL):
+        self.coins = set(coins)
+        self.currencies = set(currencies)
+        self.tokens = set()     # ERC-20 контракты в Ethereum, в нижнем регистре
+        self.refresh_interval = refresh_interval
+        self.prices = {}        # coin → {currency: price}
+        self.token_prices = {}  # контракт → {currency: price}
+        self.unknown_tokens = {}  # контракт → когда CoinGecko ответил, что цены нет
+        self.updated_at = 0.0
+        self.last_error = None
+        self._client = CoinGeckoAPI()
+        self._single_flight = SingleFlight()
+        self._task = None
+        self._wakeup = None
+
+    def _missing(self, coins, currencies):
+        return [
+            coin for coin in coins
+            if any(currency not in self.prices.get(coin, {}) for currency in currencies)
+        ]
+
+    def track(self, coins, currencies, tokens=()):
+        """Start tracking coins/currencies/token contracts; wakes the refresher if anything is new."""
+        tokens = {t.lower() for t in tokens}
+        new = not (set(coins) <= self.coins and set(currencies) <= self.currencies and tokens <= self.tokens)
+        self.coins.update(coins)
+        self.currencies.update(currencies)
+        self.tokens.update(tokens)
+        if new and self._wakeup is not None:
+            self._wakeup.set()
+
+    def _missing_tokens(self, tokens, currencies):
+        return [
+            token for token in tokens
+            if any(currency not in self.token_prices.get(token, {}) for currency in currencies)
+        ]
+
+    def is_stale(self) -> bool:
+        return time.time() - self.updated_at > STALE_AFTER
+
+    async def refresh(self):
+        """Fetch every tracked pair in one CoinGecko call; concurrent refreshes are coalesced."""
+        await self._single_flight.do("refresh", self._refresh)
+
+    async def _refresh(self):
+        if not self.currencies:
+            return
+        vs_currencies = ",".join(sorted(self.currencies))
+        try:
+            if self.coins:
+                with time_upstream("coingecko"), span("coingecko", request="simple/price", coins=len(self.coins)):
+                    prices = await asyncio.to_thread(self._client.get_price, ",".join(sorted(self.coins)), vs_currencies)
+                for coin, values in prices.items():
+                    self.prices.setdefault(coin, {}).update(values)
+            if self.tokens:
+                with time_upstream("coingecko"), span("coingecko", request="simple/token_price", tokens=len(self.tokens)):
+                    prices = await asyncio.to_thread(
+                        self._client.get_token_price, "ethereum", ",".join(sorted(self.tokens)), vs_currencies
+                    )
+                for token, values in prices.items():
+                    self.token_prices.setdefault(token.lower(), {}).update(values)
+                now = time.time()
+                for token in self.tokens - {t.lower() for t in prices}:
+                    self.unknown_tokens[token] = now
+        except Exception as e:
+            self.last_error = e
+            logger.warning(f"CoinGecko refresh failed, keeping prices from {self.updated_at:.0f}: {e}")
+            return
+        self.updated_at = time.time()
+        self.last_error = None
+
+    async def _run(self):
+        while True:
+            await self.refresh()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.refresh_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def start(self):
+        """Start the background refresher on the running loop."""
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def get_prices(self, ids, vs_currencies):
+        """Prices in CoinGecko's shape ({coin: {currency: price}}) for comma-separated ids/currencies.
+
+        Served from memory; only coins never seen before cost a round trip.
+        """
+        coins = [c.strip() for c in ids.split(",") if c.strip()]
+        currencies = [c.strip() for c in vs_currencies.split(",") if c.strip()]
+        self.track(coins, currencies)
+        if self._missing(coins, currencies):
+            await self.refresh()
+        else:
+            incr("cache_hits")
+        missing = self._missing(coins, currencies)
+        if missing:
+            raise self.last_error or KeyError(f"No prices for {', '.join(missing)}")
+        return {coin: {currency: self.prices[coin][currency] for currency in currencies} for coin in coins}
+
+    async def get_token_prices(self, contracts, vs_currencies):
+        """Prices of Ethereum ERC-20 contracts: {contract (lowercase): {currency: price}}.
+
+        Contracts CoinGecko doesn't know are simply absent from the result.
+        """
+        tokens = {c.lower() for c in contracts}
+        currencies = [c.strip() for c in vs_currencies.split(",") if c.strip()]
+        self.track((), currencies, tokens)
+        # Неизвестные CoinGecko токены не дёргают API на каждом запросе
+        now = time.time()
+        missing = [
+            t for t in self._missing_tokens(tokens, currencies)
+            if now - self.unknown_tokens.get(t, 0) > STALE_AFTER
+        ]
+        if missing:
+            await self.refresh()
+        else:
+            incr("cache_hits")
+        return {
+            token: {currency: self.token_prices[token][currency] for currency in currencies}
+            for token in tokens if not self._missing_tokens([token], currencies)
+        }
+
+
+price_service = PriceService(("bitcoin", "ethereum", "tether"), ("usd", "rub"))
+
+async def get_prices(ids, vs_currencies):
+	return await price_service.get_prices(ids, vs_currencies)
+
+async def get_token_prices(contracts, vs_currencies):
+	return await price_service.get_token_prices(contracts, vs_currencies)
+
+
+#print(asyncio.run(get_prices("bitcoin", "usd,rub"))["bitcoin"]['usd'])
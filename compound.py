@@ -1,13 +1,14 @@
 import os
-import asyncio
+import time
+import logging
+import threading
 from decimal import Decimal
-from web3 import Web3, HTTPProvider
-from rpc_manager import get_web3, call_contract_with_retry
+from eth_utils import to_checksum_address
 
-USER     = Web3.to_checksum_address("0x0C8eb038c58E0a9d8D66Bf5805A6eC0dfDaE6c4c")
-COMET    = Web3.to_checksum_address("0x3Afdc9BCA9213A35503b077a6072F3D0d5AB0840")
+logger = logging.getLogger(__name__)
 
-w3 = get_web3()
+USER     = to_checksum_address("0x0C8eb038c58E0a9d8D66Bf5805A6eC0dfDaE6c4c")
+COMET    = to_checksum_address("0x3Afdc9BCA9213A35503b077a6072F3D0d5AB0840")
 
 # ─────── ABI-фрагменты ровно под нужные вызовы ───────
 COMET_ABI = [
@@ -50,66 +51,131 @@ ERC20_ABI = [
 def scale(value: int, factor: int) -> Decimal:
     return Decimal(value) / Decimal(factor)
 
-def fetch_comet_position(comet_addr: str, account: str, use_cache: bool = True):
-    try:
-        from rpc_manager import rpc_manager
-        
-        # Get a fresh Web3 instance
-        w3_instance = rpc_manager.get_web3_instance()
-        comet = w3_instance.eth.contract(address=comet_addr, abi=COMET_ABI)
-
-        # ── база (USDC) ────────────────────────────
-        def _get_base_token():
-            return comet.functions.baseToken().call()
-        base_token = rpc_manager._make_request_with_retry(_get_base_token, use_cache=use_cache)
-        
-        def _get_base_scale():
-            return comet.functions.baseScale().call()
-        base_scale = rpc_manager._make_request_with_retry(_get_base_scale, use_cache=use_cache)
-        
-        erc20 = w3_instance.eth.contract(address=base_token, abi=ERC20_ABI)
-        
-        def _get_symbol():
-            return erc20.functions.symbol().call()
-        base_symbol = rpc_manager._make_request_with_retry(_get_symbol, use_cache=use_cache)
-
-        def _get_balance():
-            return comet.functions.balanceOf(account).call()
-        supplied = scale(rpc_manager._make_request_with_retry(_get_balance, use_cache=use_cache), base_scale)
-        
-        def _get_borrow_balance():
-            return comet.functions.borrowBalanceOf(account).call()
-        borrowed = scale(rpc_manager._make_request_with_retry(_get_borrow_balance, use_cache=use_cache), base_scale)
-
-        # ── коллатерали ────────────────────────────
+# Параметры рынка и символы токенов меняются только голосованием governance —
+# читаем их редко, а не на каждый аккаунт
+META_TTL = int(os.getenv("COMPOUND_META_TTL", "86400"))
+
+_markets = {}       # comet → метаданные рынка, см. load_market_meta
+_markets_lock = threading.Lock()
+
+def load_market_meta(comet_addr: str) -> dict:
+    """Read a market's static metadata from the chain in three Multicall3 round trips.
+
+    Market parameters, then the collateral asset infos, then the ERC-20
+    symbols; each round needs the addresses the previous one returned.
+
+    Returns {"base_token", "base_symbol", "base_scale", "assets": [[asset, scale, symbol]], "loaded_at"}.
+    """
+    from rpc_manager import rpc_manager
+
+    comet = rpc_manager.get_contract(comet_addr, COMET_ABI)
+
+    # ── 1: параметры рынка ──
+    res = rpc_manager.multicall(
+        [comet.functions.baseToken(), comet.functions.baseScale(), comet.functions.numAssets()],
+        use_cache=False,
+    )
+    base_token, base_scale, n_assets = res
+    if base_token is None or base_scale is None or n_assets is None:
+        raise Exception(f"Failed to read market parameters of comet {comet_addr}")
+    base_token = to_checksum_address(base_token)
+
+    # ── 2: описание коллатералей ──
+    infos = rpc_manager.multicall([comet.functions.getAssetInfo(i) for i in range(n_assets)], use_cache=False)
+    if any(info is None for info in infos):
+        raise Exception(f"Failed to read collateral assets of comet {comet_addr}")
+    assets = [(to_checksum_address(info[1]), info[3]) for info in infos]
+
+    # ── 3: символы базового токена и коллатералей ──
+    tokens = [base_token] + [asset for asset, _ in assets]
+    symbols = rpc_manager.multicall(
+        [rpc_manager.get_contract(token, ERC20_ABI).functions.symbol() for token in tokens]
+    )
+
+    return {
+        "base_token": base_token,
+        "base_symbol": symbols[0] or "USDC",
+        "base_scale": base_scale,
+        "assets": [[asset, scale_, symbol or asset] for (asset, scale_), symbol in zip(assets, symbols[1:])],
+        "loaded_at": int(time.time()),
+    }
+
+def market_meta(comet_addr: str, refresh: bool = False) -> dict:
+    """Cached metadata of a market; reloaded after META_TTL or on request."""
+    with _markets_lock:
+        meta = _markets.get(comet_addr)
+        if refresh or meta is None or time.time() - meta["loaded_at"] > META_TTL:
+            meta = _markets[comet_addr] = load_market_meta(comet_addr)
+        return meta
+
+def cached_market_meta(comet_addr: str):
+    return _markets.get(comet_addr)
+
+def seed_market_meta(comet_addr: str, meta: dict) -> None:
+    """Use previously stored metadata unless what we hold in memory is newer."""
+    with _markets_lock:
+        current = _markets.get(comet_addr)
+        if current is None or current["loaded_at"] < meta["loaded_at"]:
+            _markets[comet_addr] = meta
+
+def fetch_comet_positions(comet_addr: str, accounts: list[str], use_cache: bool = True) -> dict:
+    """Read Compound v3 positions for a batch of accounts in one Multicall3 round trip.
+
+    Market metadata comes from market_meta(); numAssets() rides along with
+    the balance reads, and a changed asset count reloads the metadata and
+    reads the batch again.
+    Returns {account: (base_symbol, supplied, borrowed, positions) | Exception};
+    an account whose balance reads failed gets the exception, not zeros.
+    """
+    from rpc_manager import rpc_manager
+
+    comet = rpc_manager.get_contract(comet_addr, COMET_ABI)
+
+    for attempt in range(2):
+        meta = market_meta(comet_addr, refresh=attempt > 0)
+        assets = meta["assets"]
+        calls = [comet.functions.numAssets()]
+        for account in accounts:
+            calls.append(comet.functions.balanceOf(account))
+            calls.append(comet.functions.borrowBalanceOf(account))
+            calls += [comet.functions.collateralBalanceOf(account, asset) for asset, _, _ in assets]
+        res = rpc_manager.multicall(calls, use_cache=use_cache)
+        if res[0] is None or res[0] == len(assets):
+            break
+        # governance добавил коллатераль — балансы прочитаны по старому списку
+        logger.info(f"Comet {comet_addr} now has {res[0]} assets (had {len(assets)}), reloading metadata")
+
+    base_symbol, base_scale = meta["base_symbol"], meta["base_scale"]
+    per_account = 2 + len(assets)
+    result = {}
+    for idx, account in enumerate(accounts):
+        supplied_raw, borrowed_raw, *collateral_balances = res[1 + idx * per_account:1 + (idx + 1) * per_account]
+        if supplied_raw is None or borrowed_raw is None:
+            logger.warning(f"Error fetching comet position for {account}: balance call failed")
+            result[account] = RuntimeError(f"Comet balance call failed for {account}")
+            continue
+
         positions = []
-        
-        def _get_num_assets():
-            return comet.functions.numAssets().call()
-        n_assets = rpc_manager._make_request_with_retry(_get_num_assets, use_cache=use_cache)
-        
-        for i in range(n_assets):
-            def _get_asset_info():
-                return comet.functions.getAssetInfo(i).call()
-            info = rpc_manager._make_request_with_retry(_get_asset_info, use_cache=use_cache)
-            asset = info[1]
-            scale_ = info[3]
-            
-            def _get_collateral_balance():
-                return comet.functions.collateralBalanceOf(account, asset).call()
-            bal = rpc_manager._make_request_with_retry(_get_collateral_balance, use_cache=use_cache)
-            
-            if bal == 0:
+        for (asset, scale_, symbol), bal in zip(assets, collateral_balances):
+            if not bal:
                 continue
-
-            erc20 = w3_instance.eth.contract(asset, ERC20_ABI)
-            
-            def _get_asset_symbol():
-                return erc20.functions.symbol().call()
-            symbol = rpc_manager._make_request_with_retry(_get_asset_symbol, use_cache=use_cache)
             positions.append((symbol, scale(bal, scale_)))
 
-        return base_symbol, supplied, borrowed, positions
+        result[account] = (
+            base_symbol,
+            scale(supplied_raw, base_scale),
+            scale(borrowed_raw, base_scale),
+            positions,
+        )
+
+    return result
+
+def fetch_comet_position(comet_addr: str, account: str, use_cache: bool = True):
+    try:
+        position = fetch_comet_positions(comet_addr, [account], use_cache=use_cache)[account]
+        if isinstance(position, Exception):
+            raise position
+        return position
     except Exception as e:
         print(f"Error fetching comet position for {account}: {e}")
         return "USDC", 0, 0, []
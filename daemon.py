@@ -1,46 +1,133 @@
 import asyncio
-import datetime
-import json, sqlite3, time
-from web3 import Web3
-from compound import fetch_comet_position
-from db import init_db_sync, add_address, remove_address, list_addresses, filter_btc_addresses, filter_eth_addresses, list_addresses_all
+import logging, os, time
+from eth_utils import to_checksum_address
+from compound import fetch_comet_positions, seed_market_meta, cached_market_meta
+from db import init_db_sync, list_addresses_all, save_compound_positions, save_compound_market, get_compound_market, open_db, close_db
 
-COMET    = Web3.to_checksum_address("0x3Afdc9BCA9213A35503b077a6072F3D0d5AB0840")
+logger = logging.getLogger(__name__)
 
-async def main() -> None:
-    addrs = await list_addresses_all()
-    eth_addrs = filter_eth_addresses(addrs)
-    
-    result = {
-        "addresses": {},
-        "time": f"{datetime.datetime.now()}"
-    }
-    for addr in eth_addrs:
+COMET    = to_checksum_address("0x3Afdc9BCA9213A35503b077a6072F3D0d5AB0840")
+
+CONCURRENCY = int(os.getenv("DAEMON_CONCURRENCY", "8"))   # батчей в работе одновременно
+BATCH_SIZE  = int(os.getenv("DAEMON_BATCH_SIZE", "10"))   # аккаунтов в одном multicall-батче
+TIMEOUT     = float(os.getenv("DAEMON_TIMEOUT", "30"))    # сек на батч и на одиночный адрес
+PROGRESS_EVERY = 5  # сек между строками прогресса
+
+def unique_eth_addresses(addrs) -> list[str]:
+    """Checksummed, deduplicated ETH addresses (one wallet tracked by many users is fetched once)."""
+    unique = {}
+    for addr in addrs:
+        try:
+            unique.setdefault(to_checksum_address(addr), None)
+        except ValueError:
+            logger.warning(f"Skipping malformed ETH address {addr}")
+    return list(unique)
+
+async def refresh_positions(eth_addrs: list[str]) -> dict:
+    """Fetch Compound positions of all addresses with bounded parallelism.
+
+    Addresses go out in multicall batches; a batch that fails is retried
+    address by address, so one bad account can't sink the rest. A batch
+    that times out is not retried: its thread is still running and would
+    race the retries for the same RPC slots.
+    Returns {addr: (base_symbol, supplied, borrowed, collats)}; addresses
+    that still fail are left out, keeping their previous snapshot.
+    """
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    results = {}
+    failed = []
+    latencies = []
+    started = time.monotonic()
+    last_progress = started
+
+    def _log_progress(final=False):
+        nonlocal last_progress
+        now = time.monotonic()
+        if not final and now - last_progress < PROGRESS_EVERY:
+            return
+        last_progress = now
+        avg = sum(latencies) / len(latencies) if latencies else 0
+        logger.info(
+            f"Compound refresh: {len(results) + len(failed)}/{len(eth_addrs)} addresses "
+            f"({len(failed)} failed), "
+            f"{now - started:.1f}s elapsed, avg batch latency {avg:.2f}s"
+        )
+
+    async def _fetch_single(addr):
+        # fetch_comet_position глотает ошибки и отдаёт нули — нам нужна сама ошибка
         try:
-            base_symbol, supplied, borrowed, positions = fetch_comet_position(COMET, Web3.to_checksum_address(addr), use_cache=False)
-            
-            payload = {
-                "ts": int(time.time()),
-                "base_symbol": str(base_symbol),
-                "supplied": str(supplied),       # str, чтобы избежать проблем с Decimal
-                "borrowed": str(borrowed),
-                "collats": [(sym, str(amt)) for sym, amt in positions],
-            }
-            result["addresses"][addr] = payload
+            positions = await asyncio.wait_for(
+                asyncio.to_thread(fetch_comet_positions, COMET, [addr], False), TIMEOUT
+            )
+            if isinstance(positions[addr], Exception):
+                raise positions[addr]
+            results[addr] = positions[addr]
         except Exception as e:
-            print(f"Error processing {addr}: {e}")
-            # Add error entry
-            payload = {
-                "ts": int(time.time()),
-                "base_symbol": "USDT",
-                "supplied": "0",
-                "borrowed": "0",
-                "collats": [],
-            }
-            result["addresses"][addr] = payload
-
-    with open("./cache_compound.json", "w") as f:
-        json.dump(result, f)
+            logger.error(f"Error processing {addr}: {e!r}")
+            failed.append(addr)
+
+    async def _fetch_batch(batch):
+        async with semaphore:
+            batch_started = time.monotonic()
+            try:
+                positions = await asyncio.wait_for(
+                    asyncio.to_thread(fetch_comet_positions, COMET, batch, False), TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                # wait_for не может прервать поток: он дорабатывает в фоне, повтор лишь удвоит нагрузку
+                logger.warning(f"Batch of {len(batch)} addresses timed out after {TIMEOUT:g}s, keeping previous snapshots")
+                failed.extend(batch)
+            except Exception as e:
+                logger.warning(f"Batch of {len(batch)} addresses failed ({e!r}), retrying one by one")
+                await asyncio.gather(*(_fetch_single(addr) for addr in batch))
+            else:
+                retry = []
+                for addr in batch:
+                    if isinstance(positions[addr], Exception):
+                        retry.append(addr)
+                    else:
+                        results[addr] = positions[addr]
+                # Упавшие чтения балансов — повторяем поштучно, нули в снимок не пишем
+                await asyncio.gather(*(_fetch_single(addr) for addr in retry))
+            latencies.append(time.monotonic() - batch_started)
+            _log_progress()
+
+    batches = [eth_addrs[i:i + BATCH_SIZE] for i in range(0, len(eth_addrs), BATCH_SIZE)]
+    await asyncio.gather(*(_fetch_batch(batch) for batch in batches))
+    _log_progress(final=True)
+    return results
+
+async def refresh_compound() -> None:
+    """One refresh cycle over every tracked address (also run by the bot's scheduler)."""
+    # Реестр уже хранит каждый кошелёк один раз, в checksum-виде
+    eth_addrs = unique_eth_addresses(await list_addresses_all("eth"))
+    logger.info(f"Refreshing Compound positions of {len(eth_addrs)} unique addresses")
+
+    # Статика рынка с прошлого запуска: без неё первый батч перечитал бы её с цепочки
+    stored = await get_compound_market(COMET)
+    if stored is not None:
+        seed_market_meta(COMET, stored)
+
+    positions = await refresh_positions(eth_addrs)
+    # Одна транзакция: читатели видят либо старые снимки, либо новые целиком
+    await save_compound_positions(COMET, positions)
+
+    meta = cached_market_meta(COMET)
+    if meta is not None and meta != stored:
+        logger.info(f"Compound market metadata updated: {len(meta['assets'])} collateral assets")
+        await save_compound_market(COMET, meta)
+
+async def main() -> None:
+    init_db_sync()
+    await open_db()
+    try:
+        await refresh_compound()
+    finally:
+        await close_db()
 
 if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(name)s — %(message)s",
+    )
     asyncio.run(main())
@@ -1,78 +1,532 @@
+import json
+import time
+import asyncio
+import logging
 import aiosqlite
 import sqlite3
+from eth_utils import to_checksum_address
+from metrics import Gauge
+
+logger = logging.getLogger(__name__)
 
 DB_PATH = "wallets.db"
 
+# WAL: читатели не ждут писателя, а бот и демон не дерутся за блокировку файла
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",     # в WAL этого достаточно: теряем максимум последние транзакции при сбое ОС
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-16000",      # 16 МБ страничного кэша
+    "PRAGMA temp_store=MEMORY",
+)
+STATEMENT_CACHE_SIZE = 256   # подготовленные запросы, которые sqlite3 держит на соединении
+WRITE_BATCH_MAX = 500        # записей в одной транзакции писателя
+# Реестр адресов: каждый кошелёк один раз, в нормализованном виде и с сетью,
+# определённой при добавлении; пользователи ссылаются на него
+ADDRESS_SCHEMAS = (
+    "CREATE TABLE IF NOT EXISTS addresses ("
+    "id INTEGER PRIMARY KEY, address TEXT NOT NULL UNIQUE, chain TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS user_address_links ("
+    "user_id INTEGER, address_id INTEGER REFERENCES addresses(id), "
+    "PRIMARY KEY(user_id, address_id))",
+    "CREATE INDEX IF NOT EXISTS user_address_links_address ON user_address_links(address_id)",
+)
+
+# Снимки позиций Compound: строка на (адрес, рынок), адрес в checksum-виде
+COMPOUND_POSITIONS_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS compound_positions ("
+    "address TEXT, market TEXT, base_symbol TEXT, "
+    "supplied TEXT, borrowed TEXT, collats TEXT, updated_at INTEGER, "
+    "PRIMARY KEY(address, market))"
+)
+
+# Статика рынков Compound (база, коллатерали, их scale и символы) одним JSON на рынок:
+# переживает рестарт, чтобы не перечитывать её с цепочки
+COMPOUND_MARKETS_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS compound_markets ("
+    "market TEXT PRIMARY KEY, meta TEXT, updated_at INTEGER)"
+)
+
+# История оценок: resolution — длина бакета в секундах (0 — сырые точки).
+# WITHOUT ROWID кладёт строки в порядке ключа, так что выборка периода — один диапазон
+PORTFOLIO_HISTORY_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS portfolio_history ("
+    "user_id INTEGER, resolution INTEGER, asset TEXT, ts INTEGER, "
+    "value_usd REAL, value_rub REAL, "
+    "PRIMARY KEY(user_id, resolution, asset, ts)) WITHOUT ROWID"
+)
+# Докуда (ts, не включая) уже свёрнута каждая точность: rollup берёт только новые бакеты
+HISTORY_ROLLUPS_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS history_rollups ("
+    "resolution INTEGER PRIMARY KEY, rolled_until INTEGER)"
+)
+# Для даунсэмплинга и чистки: выборка по точности и времени сразу по всем пользователям
+PORTFOLIO_HISTORY_INDEX = (
+    "CREATE INDEX IF NOT EXISTS portfolio_history_resolution_ts "
+    "ON portfolio_history(resolution, ts)"
+)
+
+# ---------- соединение ----------
+GROUP = object()    # вид операции писателя: несколько операторов одной группой (write_group)
+
+class Database:
+    """Long-lived aiosqlite connections of the process, in WAL mode.
+
+    Reads go to their own connection (and thread), so they never queue
+    behind writes. Writes are queued, and a single writer task commits
+    everything that piled up meanwhile in one transaction; each write
+    still gets its own result or exception. Long maintenance statements
+    run on a short-lived connection of their own (see `maintenance`).
+    """
+
+    def __init__(self, path=None, batch_max=WRITE_BATCH_MAX):
+        self.path = path
+        self.batch_max = batch_max
+        self._conn = None
+        self._reader = None
+        self._queue = None
+        self._writer_task = None
+        self._loop = None
+        self._open_lock = None
+
+    async def open(self):
+        """Open the connection and start the writer (idempotent)."""
+        loop = asyncio.get_running_loop()
+        if self._open_lock is None or self._loop is not loop:
+            self._open_lock = asyncio.Lock()
+        async with self._open_lock:
+            if self._conn is None:
+                self._conn = await self._connect()
+            if self._reader is None:
+                # В WAL читатель видит последний коммит и не ждёт писателя
+                self._reader = await self._connect()
+                await self._reader.execute("PRAGMA query_only=ON")
+            if self._loop is not loop or self._writer_task is None or self._writer_task.done():
+                # Очередь и писатель привязаны к циклу событий
+                self._loop = loop
+                self._queue = asyncio.Queue()
+                self._writer_task = asyncio.create_task(self._writer())
+
+    async def _connect(self):
+        conn = aiosqlite.connect(
+            self.path or DB_PATH, isolation_level=None, cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        # Поток соединения не должен держать процесс, если close() так и не позвали;
+        # WAL переживает такой выход как обычный сбой
+        conn.daemon = True
+        conn = await conn
+        for pragma in PRAGMAS:
+            await conn.execute(pragma)
+        return conn
+
+    async def close(self):
+        """Flush pending writes and close the connections."""
+        if self._writer_task is not None and self._loop is asyncio.get_running_loop():
+            await self._queue.put(None)
+            await self._writer_task
+        self._writer_task = None
+        if self._conn is not None:
+            try:
+                await self._conn.execute("PRAGMA optimize")
+            finally:
+                await self._conn.close()
+                self._conn = None
+        if self._reader is not None:
+            await self._reader.close()
+            self._reader = None
+
+    async def _ensure_open(self):
+        if self._conn is None or self._loop is not asyncio.get_running_loop() or self._writer_task.done():
+            await self.open()
+
+    async def fetchall(self, sql, params=()):
+        await self._ensure_open()
+        async with self._reader.execute(sql, params) as cur:
+            return await cur.fetchall()
+
+    async def maintenance(self, sql, params=()) -> int:
+        """Run one long statement (rollups, pruning) in its own transaction on its own connection.
+
+        Neither reads nor the write queue wait behind it; the writer only
+        meets it at the SQLite write lock, for as long as busy_timeout allows.
+        """
+        conn = await self._connect()
+        try:
+            await conn.execute("BEGIN IMMEDIATE")
+            cur = await conn.execute(sql, params)
+            await conn.commit()
+            return cur.rowcount
+        finally:
+            await conn.close()
+
+    async def write(self, sql, params=()) -> int:
+        """Queue one statement; returns its rowcount once the batch is committed."""
+        return await self._submit(sql, params, False)
+
+    async def write_many(self, sql, rows) -> int:
+        return await self._submit(sql, list(rows), True)
+
+    async def write_group(self, statements) -> list[int]:
+        """Queue [(sql, params)] that must apply together; returns their rowcounts.
+
+        An item may be (sql, rows, True) to run it as executemany.
+
+        The statements share the writer's transaction under a savepoint, so
+        no other queued write lands between them, and a failing one undoes
+        the whole group.
+        """
+        return await self._submit(None, list(statements), GROUP)
+
+    def queue_size(self) -> int:
+        """Writes queued for the writer task and not yet picked up (0 before open)."""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _submit(self, sql, params, many):
+        await self._ensure_open()
+        future = self._loop.create_future()
+        await self._queue.put((sql, params, many, future))
+        return await future
+
+    async def _writer(self):
+        while True:
+            op = await self._queue.get()
+            if op is None:
+                return
+            batch = [op]
+            stop = False
+            while len(batch) < self.batch_max and not self._queue.empty():
+                op = self._queue.get_nowait()
+                if op is None:
+                    stop = True
+                    break
+                batch.append(op)
+            await self._commit_batch(batch)
+            if stop:
+                return
+
+    async def _run_group(self, statements):
+        await self._conn.execute("SAVEPOINT write_group")
+        try:
+            rowcounts = []
+            for sql, params, *many in statements:
+                if many and many[0]:
+                    cur = await self._conn.executemany(sql, params)
+                else:
+                    cur = await self._conn.execute(sql, params)
+                rowcounts.append(cur.rowcount)
+        except sqlite3.Error:
+            await self._conn.execute("ROLLBACK TO write_group")
+            await self._conn.execute("RELEASE write_group")
+            raise
+        await self._conn.execute("RELEASE write_group")
+        return rowcounts
+
+    async def _commit_batch(self, batch):
+        outcomes = []
+        try:
+            await self._conn.execute("BEGIN")
+            for sql, params, many, future in batch:
+                try:
+                    if many is GROUP:
+                        outcomes.append((future, await self._run_group(params), None))
+                        continue
+                    if many:
+                        cur = await self._conn.executemany(sql, params)
+                    else:
+                        cur = await self._conn.execute(sql, params)
+                    outcomes.append((future, cur.rowcount, None))
+                except sqlite3.Error as e:
+                    # Нарушение ограничения откатывает только сам оператор, транзакция живёт дальше
+                    outcomes.append((future, None, e))
+            await self._conn.commit()
+        except Exception as e:
+            logger.error(f"Write batch of {len(batch)} statements failed: {e}")
+            try:
+                await self._conn.rollback()
+            except Exception:
+                pass
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, rowcount, error in outcomes:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(rowcount)
+
+
+database = Database()
+Gauge(
+    "db_write_queue_depth", "Writes waiting for the SQLite writer task",
+    fn=lambda: {(): database.queue_size()},
+)
+
+async def open_db() -> None:
+    await database.open()
+
+async def close_db() -> None:
+    await database.close()
+
+
 # ---------- работа с БД ----------
-def init_db_sync():
-    with sqlite3.connect(DB_PATH) as conn:
+def normalize_address(addr: str) -> tuple[str, str]:
+    """(normalized address, chain): ETH → checksum, bech32 BTC → lowercase, base58 BTC as is.
+
+    Raises ValueError for a malformed ETH address.
+    """
+    addr = addr.strip()
+    if is_addr_eth(addr):
+        return to_checksum_address(addr), "eth"
+    if addr.lower().startswith(("bc1", "tb1")):
+        return addr.lower(), "btc"
+    return addr, "btc"
+
+def _migrate_user_addresses(conn):
+    """One-off move of the legacy user_addresses rows into the registry; the old table is dropped after."""
+    legacy = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_addresses'"
+    ).fetchone()
+    if not legacy:
+        return
+    for user_id, raw in conn.execute("SELECT user_id, address FROM user_addresses").fetchall():
+        try:
+            address, chain = normalize_address(raw)
+        except ValueError:
+            logger.warning(f"Skipping malformed legacy address {raw} of user {user_id}")
+            continue
+        conn.execute("INSERT OR IGNORE INTO addresses(address, chain) VALUES(?, ?)", (address, chain))
         conn.execute(
-            "CREATE TABLE IF NOT EXISTS user_addresses ("
-            "user_id INTEGER, address TEXT, PRIMARY KEY(user_id, address))"
+            "INSERT OR IGNORE INTO user_address_links(user_id, address_id) "
+            "SELECT ?, id FROM addresses WHERE address = ?",
+            (user_id, address),
         )
+    # Вместе с копированием, в одной транзакции: удалённые потом адреса не вернутся на рестарте
+    conn.execute("DROP TABLE user_addresses")
+
+def init_db_sync():
+    with sqlite3.connect(DB_PATH) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")  # сохраняется в файле БД
+        for sql in ADDRESS_SCHEMAS:
+            conn.execute(sql)
+        _migrate_user_addresses(conn)
+        conn.execute(COMPOUND_POSITIONS_SCHEMA)
+        conn.execute(COMPOUND_MARKETS_SCHEMA)
+        conn.execute(PORTFOLIO_HISTORY_SCHEMA)
+        conn.execute(PORTFOLIO_HISTORY_INDEX)
+        conn.execute(HISTORY_ROLLUPS_SCHEMA)
             
 async def init_db() -> None:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "CREATE TABLE IF NOT EXISTS user_addresses ("
-            "user_id INTEGER, address TEXT, "
-            "PRIMARY KEY(user_id, address))"
-        )
-        await db.commit()
+    for sql in (
+        *ADDRESS_SCHEMAS,
+        COMPOUND_POSITIONS_SCHEMA,
+        COMPOUND_MARKETS_SCHEMA,
+        PORTFOLIO_HISTORY_SCHEMA,
+        PORTFOLIO_HISTORY_INDEX,
+        HISTORY_ROLLUPS_SCHEMA,
+    ):
+        await database.write(sql)
 
 
 async def add_address(user_id: int, address: str) -> bool:
+    """Link an address to the user; False if already linked. Raises ValueError if malformed."""
+    address, chain = normalize_address(address)
+    # Одной группой: remove_address другого пользователя не удалит запись между вставками
+    _, linked = await database.write_group([
+        ("INSERT OR IGNORE INTO addresses(address, chain) VALUES(?, ?)", (address, chain)),
+        (
+            "INSERT OR IGNORE INTO user_address_links(user_id, address_id) "
+            "SELECT ?, id FROM addresses WHERE address = ?",
+            (user_id, address),
+        ),
+    ])
+    return linked > 0
+
+
+async def remove_address(user_id: int, address: str) -> bool:
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                "INSERT INTO user_addresses(user_id, address) VALUES(?, ?)",
-                (user_id, address),
-            )
-            await db.commit()
-        return True
-    except aiosqlite.IntegrityError:
+        address, _ = normalize_address(address)
+    except ValueError:
         return False
+    rowcount = await database.write(
+        "DELETE FROM user_address_links WHERE user_id = ? "
+        "AND address_id = (SELECT id FROM addresses WHERE address = ?)",
+        (user_id, address),
+    )
+    # Адрес, на который больше никто не ссылается, уходит из реестра
+    await database.write(
+        "DELETE FROM addresses WHERE address = ? AND NOT EXISTS "
+        "(SELECT 1 FROM user_address_links WHERE address_id = addresses.id)",
+        (address,),
+    )
+    return rowcount > 0
 
 
-async def remove_address(user_id: int, address: str) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "DELETE FROM user_addresses WHERE user_id = ? AND address = ?",
-            (user_id, address),
-        )
-        await db.commit()
-        return cur.rowcount > 0
+async def list_addresses(user_id: int) -> list[tuple[str, str]]:
+    """[(address, chain)] of one user; the chain is the one stored when the address was added."""
+    rows = await database.fetchall(
+        "SELECT a.address, a.chain FROM user_address_links l JOIN addresses a ON a.id = l.address_id "
+        "WHERE l.user_id = ?", (user_id,)
+    )
+    return [(address, chain) for address, chain in rows]
 
+async def list_user_addresses(user_ids: list[int]) -> dict[int, list[tuple[str, str]]]:
+    """{user_id: [(address, chain)]} for many users in one query."""
+    if not user_ids:
+        return {}
+    placeholders = ",".join("?" * len(user_ids))
+    rows = await database.fetchall(
+        "SELECT l.user_id, a.address, a.chain FROM user_address_links l JOIN addresses a ON a.id = l.address_id "
+        f"WHERE l.user_id IN ({placeholders})", tuple(user_ids)
+    )
+    result = {user_id: [] for user_id in user_ids}
+    for user_id, address, chain in rows:
+        result[user_id].append((address, chain))
+    return result
 
-async def list_addresses(user_id: int) -> list[str]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT address FROM user_addresses WHERE user_id = ?", (user_id,)
-        )
-        rows = await cur.fetchall()
-        return [r[0] for r in rows]
+def addresses_on(addrs, chain: str) -> list[str]:
+    """Addresses of one chain ("eth" / "btc") out of registry (address, chain) pairs."""
+    return [address for address, addr_chain in addrs if addr_chain == chain]
 
 def is_addr_eth(addr):
-    return addr.startswith("0x")
+    # Только для разбора ввода; дальше сеть берётся из реестра
+    return addr[:2].lower() == "0x"
 
-async def list_addresses_all() -> list[str]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT address FROM user_addresses"
+async def list_addresses_all(chain: str = None) -> list[str]:
+    """Every tracked address once, optionally of one chain ("eth" / "btc")."""
+    if chain is None:
+        rows = await database.fetchall(
+            "SELECT address FROM addresses"
+        )
+    else:
+        rows = await database.fetchall(
+            "SELECT address FROM addresses WHERE chain = ?", (chain,)
         )
-        rows = await cur.fetchall()
-        return [r[0] for r in rows]
-
-def filter_btc_addresses(addrs):
-    btc_addrs = []
-    for addr in addrs:
-        if is_addr_eth(addr) == False:
-            btc_addrs.append(addr)
-    return btc_addrs
-
-def filter_eth_addresses(addrs):
-    eth_addrs = []
-    for addr in addrs:
-        if is_addr_eth(addr) == True:
-            eth_addrs.append(addr)
-    return eth_addrs
\ No newline at end of file
+    return [r[0] for r in rows]
+
+async def list_user_ids() -> list[int]:
+    rows = await database.fetchall(
+        "SELECT DISTINCT user_id FROM user_address_links"
+    )
+    return [r[0] for r in rows]
+
+# ---------- снимки Compound ----------
+async def save_compound_positions(market: str, positions: dict) -> None:
+    """Upsert {address: (base_symbol, supplied, borrowed, collats)} in one transaction.
+
+    Exception values (failed reads) are skipped, so those addresses keep their previous row.
+    Rows of this market whose address has left the registry are deleted in the same
+    transaction.
+    """
+    now = int(time.time())
+    rows = []
+    for address, position in positions.items():
+        if isinstance(position, Exception):
+            continue
+        base_symbol, supplied, borrowed, collats = position
+        rows.append((
+            address, market, str(base_symbol), str(supplied), str(borrowed),  # str, чтобы не терять точность Decimal
+            json.dumps([(sym, str(amt)) for sym, amt in collats]), now,
+        ))
+    await database.write_group([
+        (
+            "INSERT OR REPLACE INTO compound_positions"
+            "(address, market, base_symbol, supplied, borrowed, collats, updated_at) "
+            "VALUES(?, ?, ?, ?, ?, ?, ?)",
+            rows, True,
+        ),
+        # Реестр, а не этот проход: упавшие адреса сохраняют прежний снимок, удалённые — уходят
+        (
+            "DELETE FROM compound_positions WHERE market = ? AND address NOT IN "
+            "(SELECT address FROM addresses WHERE chain = 'eth')",
+            (market,),
+        ),
+    ])
+
+
+async def get_compound_positions(addresses: list[str], market: str) -> dict:
+    """Snapshots of the given addresses only: {address: row dict}; unseen addresses are absent."""
+    if not addresses:
+        return {}
+    placeholders = ",".join("?" * len(addresses))
+    rows = await database.fetchall(
+        "SELECT address, base_symbol, supplied, borrowed, collats, updated_at "
+        f"FROM compound_positions WHERE market = ? AND address IN ({placeholders})",
+        (market, *addresses),
+    )
+    return {
+        address: {
+            "base_symbol": base_symbol,
+            "supplied": supplied,
+            "borrowed": borrowed,
+            "collats": json.loads(collats),
+            "updated_at": updated_at,
+        }
+        for address, base_symbol, supplied, borrowed, collats, updated_at in rows
+    }
+
+
+async def save_compound_market(market: str, meta: dict) -> None:
+    await database.write(
+        "INSERT OR REPLACE INTO compound_markets(market, meta, updated_at) VALUES(?, ?, ?)",
+        (market, json.dumps(meta), meta["loaded_at"]),
+    )
+
+
+async def get_compound_market(market: str):
+    """Stored metadata of a market, or None if it was never loaded."""
+    rows = await database.fetchall("SELECT meta FROM compound_markets WHERE market = ?", (market,))
+    return json.loads(rows[0][0]) if rows else None
+
+
+# ---------- история портфеля ----------
+async def insert_history_points(user_id: int, ts: int, values: dict) -> None:
+    """Raw points {asset: (usd, rub)} of one user at one moment."""
+    await database.write_many(
+        "INSERT OR REPLACE INTO portfolio_history"
+        "(user_id, resolution, asset, ts, value_usd, value_rub) VALUES(?, 0, ?, ?, ?, ?)",
+        [(user_id, asset, ts, float(usd), float(rub)) for asset, (usd, rub) in values.items()],
+    )
+
+
+async def rollup_history(src: int, dst: int, since: int, until: int) -> None:
+    """Average `src` points of [since, until) into `dst` buckets (re-running a bucket overwrites it)."""
+    await database.maintenance(
+        "INSERT OR REPLACE INTO portfolio_history"
+        "(user_id, resolution, asset, ts, value_usd, value_rub) "
+        "SELECT user_id, ?, asset, (ts / ?) * ? AS bucket, AVG(value_usd), AVG(value_rub) "
+        "FROM portfolio_history WHERE resolution = ? AND ts >= ? AND ts < ? "
+        "GROUP BY user_id, asset, bucket",
+        (dst, dst, dst, src, since, until),
+    )
+
+
+async def get_rollup_watermarks() -> dict:
+    """{dst resolution: ts up to which its buckets are already computed}."""
+    return dict(await database.fetchall("SELECT resolution, rolled_until FROM history_rollups"))
+
+
+async def set_rollup_watermark(resolution: int, until: int) -> None:
+    await database.write(
+        "INSERT OR REPLACE INTO history_rollups(resolution, rolled_until) VALUES(?, ?)",
+        (resolution, until),
+    )
+
+
+async def prune_history(resolution: int, before: int) -> int:
+    return await database.maintenance(
+        "DELETE FROM portfolio_history WHERE resolution = ? AND ts < ?",
+        (resolution, before),
+    )
+
+
+async def query_history(user_id: int, resolutions: tuple, since: int) -> list[tuple]:
+    """(resolution, asset, ts, usd, rub) rows of one user from `since`, ordered by time."""
+    placeholders = ",".join("?" * len(resolutions))
+    return await database.fetchall(
+        "SELECT resolution, asset, ts, value_usd, value_rub FROM portfolio_history "
+        f"WHERE user_id = ? AND resolution IN ({placeholders}) AND ts >= ? ORDER BY ts",
+        (user_id, *resolutions, since),
+    )
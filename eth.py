@@ -1,14 +1,12 @@
 import os
-from web3 import Web3
+from eth_utils import from_wei
 import asyncio
-from rpc_manager import get_web3, get_balance_with_retry
-
-w3 = get_web3()
+from rpc_manager import get_balance_with_retry
 
 def fetch_balance_eth(addr):
     try:
         balance_wei = get_balance_with_retry(addr)
-        return w3.from_wei(balance_wei, "ether")
+        return from_wei(balance_wei, "ether")
     except Exception as e:
         print(f"Error getting ETH balance for {addr}: {e}")
         return 0
@@ -1,97 +1,175 @@
-from web3 import Web3, HTTPProvider
-import json, requests
+import os
+import time
+import logging
 from decimal import Decimal
-from rpc_manager import get_web3, call_contract_with_retry
+from eth_utils import to_checksum_address, from_wei
+from abi_files import load_abi
+from metrics import CACHE_LOOKUPS
+from tracing import span
 
-w3 = get_web3()
+logger = logging.getLogger(__name__)
 
-ACCOUNT_LENS = w3.to_checksum_address("0x94B9D29721f0477402162C93d95B3b4e52425844")
-EVC          = w3.to_checksum_address("0x0C9a3dd6b8F28529d72d7f9cE918D493519EE383")
-VLENS_ADDR   = w3.to_checksum_address("0x079FA5cdE9c9647D26E79F3520Fbdf9dbCC0E45e")
+ACCOUNT_LENS = to_checksum_address("0x94B9D29721f0477402162C93d95B3b4e52425844")
+EVC          = to_checksum_address("0x0C9a3dd6b8F28529d72d7f9cE918D493519EE383")
+VLENS_ADDR   = to_checksum_address("0x079FA5cdE9c9647D26E79F3520Fbdf9dbCC0E45e")
 
-# ✅ КАЧАЕМ АКТУАЛЬНОЕ JSON-ABI с обработкой ошибок
-def get_abi_with_fallback(url, fallback_abi):
-    """Download ABI with fallback to local definition."""
-    try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        return response.json()
-    except Exception as e:
-        print(f"Warning: Could not download ABI from {url}: {e}")
-        print("Using fallback ABI definition")
-        return fallback_abi
-
-# Fallback ABI definitions
-ACCOUNT_LENS_ABI = [
-    {
-        "name": "getAccountInfo",
-        "type": "function",
-        "stateMutability": "view",
-        "inputs": [
-            {"name": "account", "type": "address"},
-            {"name": "vault", "type": "address"}
-        ],
-        "outputs": [
-            {"name": "evcInfo", "type": "tuple"},
-            {"name": "vInfo", "type": "tuple"},
-            {"name": "perspective", "type": "tuple"}
-        ]
-    }
-]
+# ABI берём из репозитория (abi/euler), а не качаем с GitHub при импорте
+ABI = load_abi("euler/AccountLens.v1")
+EVC_ABI = load_abi("euler/EVC.v1")
+ERC20_ABI = load_abi("erc20/ERC20.v1")
 
-VAULT_LENS_ABI = [
-    {
-        "name": "getVaultInfo",
-        "type": "function",
-        "stateMutability": "view",
-        "inputs": [
-            {"name": "vault", "type": "address"}
-        ],
-        "outputs": [
-            {"name": "info", "type": "tuple"}
-        ]
-    }
+# EVC знает только хранилища-залоги и хранилища с долгом; обычный депозит без
+# включённого залога он не видит — такие хранилища проверяем всегда
+DEFAULT_VAULTS = [
+    to_checksum_address(v.strip())
+    for v in os.getenv("EULER_VAULTS", "0xD8b27CF359b7D15710a5BE299AF6e7Bf904984C2").split(",")
+    if v.strip()
 ]
+DISCOVERY_TTL = int(os.getenv("EULER_DISCOVERY_TTL", "3600"))
+
+_discovered = {}    # account → (expires_at, [vault])
+
 
-# Try to download ABIs, fallback to local definitions
-url = "https://github.com/euler-xyz/euler-interfaces/raw/refs/heads/master/abis/AccountLens.json"
-ABI = get_abi_with_fallback(url, ACCOUNT_LENS_ABI)
+class VaultPosition:
+    """Assets one account holds in one vault, in units of the vault's asset."""
 
-url_vlens = "https://github.com/euler-xyz/euler-interfaces/raw/refs/heads/master/abis/VaultLens.json"
-ABI_VLENS = get_abi_with_fallback(url_vlens, VAULT_LENS_ABI)
+    def __init__(self, vault: str, asset: str, amount: Decimal):
+        self.vault = vault
+        self.asset = asset
+        self.amount = amount
 
-#print(ABI)
 
-lens = w3.eth.contract(address=ACCOUNT_LENS, abi=ABI)
-vault_lens = w3.eth.contract(address=VLENS_ADDR, abi=ABI_VLENS)
-#print(lens)
+def get_lens():
+    """AccountLens contract, built on first use."""
+    from rpc_manager import rpc_manager
+    return rpc_manager.get_contract(ACCOUNT_LENS, ABI)
 
 def single_vault_position(user, vault):
     try:
         # Use the RPC manager's Web3 instance directly
         from rpc_manager import rpc_manager
-        
-        # Get a fresh Web3 instance
-        w3_instance = rpc_manager.get_web3_instance()
-        
-        # Recreate the contract with the new Web3 instance
-        lens_contract = w3_instance.eth.contract(address=ACCOUNT_LENS, abi=ABI)
-        
-        # Make the call with retry logic
-        def _call():
-            return lens_contract.functions.getAccountInfo(
-                w3_instance.to_checksum_address(user),
-                w3_instance.to_checksum_address(vault)
-            ).call()
-        
-        evcInfo, vInfo, _ = rpc_manager._make_request_with_retry(_call)
-        assets = w3_instance.from_wei(vInfo[6], "ether")
+
+        # Make the call with retry logic on the pooled Web3 instance and prebuilt contract
+        evcInfo, vInfo, _ = rpc_manager.call_contract_function(
+            get_lens().functions.getAccountInfo,
+            to_checksum_address(user),
+            to_checksum_address(vault)
+        )
+        assets = from_wei(vInfo[6], "ether")
         return assets
     except Exception as e:
         print(f"Error getting vault position for {user}: {e}")
         return 0
 
+async def discover_vaults(accounts: list[str]) -> dict:
+    """{account: [vault]} — EVC collaterals and controllers plus DEFAULT_VAULTS.
+
+    Accounts not seen within DISCOVERY_TTL cost two EVC reads, all of them
+    in one multicall; the rest come from memory.
+    """
+    from rpc_manager import rpc_manager
+
+    now = time.monotonic()
+    vaults = {}
+    todo = []
+    for account in accounts:
+        cached = _discovered.get(account)
+        if cached is not None and cached[0] > now:
+            vaults[account] = cached[1]
+        else:
+            todo.append(account)
+    CACHE_LOOKUPS.inc(len(vaults), cache="euler_discovery", result="hit")
+    CACHE_LOOKUPS.inc(len(todo), cache="euler_discovery", result="miss")
+    if not todo:
+        return vaults
+
+    evc = rpc_manager.get_contract(EVC, EVC_ABI)
+    calls = []
+    for account in todo:
+        calls.append(evc.functions.getCollaterals(account))
+        calls.append(evc.functions.getControllers(account))
+    with span("euler.discover", accounts=len(todo), cache_hits=len(vaults)):
+        found = await rpc_manager.async_multicall(calls, use_cache=False)
+
+    for i, account in enumerate(todo):
+        collaterals, controllers = found[2 * i], found[2 * i + 1]
+        enabled = [to_checksum_address(v) for v in (collaterals or []) + (controllers or [])]
+        vaults[account] = list(dict.fromkeys(DEFAULT_VAULTS + enabled))
+        if collaterals is None or controllers is None:
+            # Не кэшируем неполный ответ — в следующий раз спросим снова
+            logger.warning(f"EVC discovery failed for {account}, checking default vaults only")
+        else:
+            _discovered[account] = (now + DISCOVERY_TTL, vaults[account])
+    return vaults
+
+async def _token_decimals(tokens) -> dict:
+    """{token: decimals or None}; decimals() is immutable and cached by the RPC layer."""
+    from rpc_manager import rpc_manager
+
+    tokens = list(tokens)
+    calls = [rpc_manager.get_contract(token, ERC20_ABI).functions.decimals() for token in tokens]
+    return dict(zip(tokens, await rpc_manager.async_multicall(calls)))
+
+async def fetch_vault_positions(accounts: list[str]) -> dict:
+    """{account: [VaultPosition] | Exception} across every discovered vault, in batched lens reads."""
+    from rpc_manager import rpc_manager
+
+    accounts = list(dict.fromkeys(to_checksum_address(a) for a in accounts))
+    vaults = await discover_vaults(accounts)
+    lens = get_lens()
+    pairs = [(account, vault) for account in accounts for vault in vaults[account]]
+    with span("euler.lens", pairs=len(pairs)):
+        infos = await rpc_manager.async_multicall(
+            [lens.functions.getVaultAccountInfo(account, vault) for account, vault in pairs]
+        )
+
+    # VaultAccountInfo: [3] — актив хранилища, [6] — сколько его у аккаунта
+    assets = {to_checksum_address(info[3]) for info in infos if info is not None and info[6] > 0}
+    decimals = await _token_decimals(assets) if assets else {}
+
+    positions = {account: [] for account in accounts}
+    for (account, vault), info in zip(pairs, infos):
+        if isinstance(positions[account], Exception):
+            continue
+        if info is None:
+            positions[account] = RuntimeError(f"getVaultAccountInfo failed for vault {vault}")
+            continue
+        if info[6] == 0:
+            continue
+        asset = to_checksum_address(info[3])
+        if decimals.get(asset) is None:
+            positions[account] = RuntimeError(f"decimals() failed for {asset}")
+            continue
+        positions[account].append(VaultPosition(vault, asset, Decimal(info[6]) / Decimal(10) ** decimals[asset]))
+    return positions
+
+async def fetch_positions_usd(accounts: list[str]) -> dict:
+    """{account: USD value | Exception} of all Euler deposits, each asset at its own price."""
+    from cg import get_token_prices
+
+    checksummed = {account: to_checksum_address(account) for account in accounts}
+    with span("euler.positions", accounts=len(checksummed)):
+        positions = await fetch_vault_positions(list(checksummed.values()))
+        tokens = {
+            p.asset for ps in positions.values() if not isinstance(ps, Exception) for p in ps
+        }
+        prices = await get_token_prices(tokens, "usd") if tokens else {}
+
+    values = {}
+    for original, account in checksummed.items():
+        ps = positions[account]
+        if isinstance(ps, Exception):
+            values[original] = ps
+            continue
+        unpriced = [p.asset for p in ps if p.asset.lower() not in prices]
+        if unpriced:
+            values[original] = KeyError(f"No price for {', '.join(unpriced)}")
+            continue
+        values[original] = sum(
+            (p.amount * Decimal(str(prices[p.asset.lower()]["usd"])) for p in ps), Decimal(0)
+        )
+    return values
+
 
 #if __name__ == "__main__":
 #    print(single_vault_position("0x8357b66F74363E926de4186A449f365707c7fbad", "0xD8b27CF359b7D15710a5BE299AF6e7Bf904984C2"))
-    
\ No newline at end of file
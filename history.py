@@ -0,0 +1,147 @@
+import os
+import re
+import time
+import logging
+from db import (
+    insert_history_points, rollup_history, prune_history, query_history,
+    get_rollup_watermarks, set_rollup_watermark,
+)
+from portfolio import valuations, format_num
+
+logger = logging.getLogger(__name__)
+
+RAW, HOURLY, DAILY = 0, 3600, 86400   # resolution = длина бакета, сек
+
+# Сколько хранить каждую точность: таблица растёт не больше чем на ~1100 дневных точек на актив
+RETENTION = {
+    RAW: 2 * 86400,
+    HOURLY: 90 * 86400,
+    DAILY: int(os.getenv("HISTORY_DAILY_DAYS", "1095")) * 86400,
+}
+ROLLUPS = ((RAW, HOURLY), (HOURLY, DAILY))
+ROLLUP_STEP = DAILY         # кратно всем точностям: шаг режет только по границам бакетов
+RAW_INTERVAL = int(os.getenv("HISTORY_RAW_INTERVAL", "300"))   # не чаще одной сырой точки на пользователя
+DAILY_FROM = 14 * 86400     # периоды длиннее строим по дневным точкам
+
+DEFAULT_PERIOD = "7d"
+PERIOD_UNITS = {"h": 3600, "d": 86400, "w": 7 * 86400, "m": 30 * 86400, "y": 365 * 86400}
+ASSET_NAMES = {
+    "btc": "BTC",
+    "eth": "ETH",
+    "compound": "Compound",
+    "pendle": "Pendle",
+    "euler": "Euler",
+}
+
+_last_recorded = {}     # user_id → ts последней сырой точки
+
+
+async def record(user_id, results, now=None):
+    """Store a raw valuation point from portfolio stage results (throttled per user)."""
+    now = int(now if now is not None else time.time())
+    if now - _last_recorded.get(user_id, 0) < RAW_INTERVAL:
+        return
+    try:
+        values = valuations(results)
+        if not values:
+            return
+        _last_recorded[user_id] = now
+        await insert_history_points(user_id, now, values)
+    except Exception as e:
+        # История — побочный продукт, портфель из-за неё падать не должен
+        logger.warning(f"Failed to record history for user {user_id}: {e!r}")
+
+async def rollup(now=None):
+    """Downsample raw → hourly → daily for buckets completed since the last run, then prune expired points."""
+    now = int(now if now is not None else time.time())
+    watermarks = await get_rollup_watermarks()
+    for src, dst in ROLLUPS:
+        # Только бакеты, чьи исходные точки ещё целиком хранятся, и только завершённые;
+        # посчитанные прошлыми запусками не пересчитываем
+        since = max((now - RETENTION[src]) // dst * dst + dst, watermarks.get(dst, 0))
+        until = now // dst * dst
+        # По суткам за транзакцию: запись в БД не ждёт весь первый проход за 90 дней
+        for start in range(since, until, ROLLUP_STEP):
+            end = min(start + ROLLUP_STEP, until)
+            await rollup_history(src, dst, start, end)
+            await set_rollup_watermark(dst, end)
+    for resolution, keep in RETENTION.items():
+        deleted = await prune_history(resolution, now - keep)
+        if deleted:
+            logger.info(f"Pruned {deleted} history points at resolution {resolution}s")
+
+def parse_period(text):
+    """'24h', '7d', '2w', '3m', '1y' → seconds; None if malformed."""
+    match = re.fullmatch(r"(\d+)([hdwmy])", (text or DEFAULT_PERIOD).strip().lower())
+    if not match or int(match.group(1)) == 0:
+        return None
+    return int(match.group(1)) * PERIOD_UNITS[match.group(2)]
+
+def _merge_series(rows, resolutions):
+    """{asset: [(ts, usd, rub)]}: coarse points first, finer ones only after the coarse coverage ends."""
+    by_res = {}
+    for resolution, asset, ts, usd, rub in rows:
+        by_res.setdefault(asset, {}).setdefault(resolution, []).append((ts, usd, rub))
+    series = {}
+    for asset, points in by_res.items():
+        merged = []
+        covered_until = None
+        for resolution in resolutions:
+            for point in points.get(resolution, []):
+                if covered_until is None or point[0] >= covered_until:
+                    merged.append(point)
+            if merged:
+                covered_until = merged[-1][0] + resolution
+        series[asset] = merged
+    return series
+
+async def get_series(user_id, period, now=None):
+    now = int(now if now is not None else time.time())
+    resolutions = (DAILY, HOURLY, RAW) if period > DAILY_FROM else (HOURLY, RAW)
+    # Более мелкие точки нужны только там, где крупные ещё не посчитаны
+    rows = []
+    since = now - period
+    for resolution in resolutions:
+        chunk = await query_history(user_id, (resolution,), since)
+        rows.extend(chunk)
+        if chunk:
+            last_by_asset = {}
+            for _, asset, ts, _, _ in chunk:
+                last_by_asset[asset] = ts
+            since = max(since, min(last_by_asset.values()) + resolution)
+    return _merge_series(rows, resolutions)
+
+def _change(first, last):
+    diff = last - first
+    sign = "+" if diff >= 0 else "−"
+    pct = f", {sign}{abs(diff) / first * 100:.1f}%" if first else ""
+    return f"{sign}{format_num(abs(diff))} $" + pct
+
+async def render_history(user_id, period_text):
+    """Text for /history [period]."""
+    period = parse_period(period_text)
+    if period is None:
+        return "Формат: /history [24h|7d|4w|3m|1y]"
+    series = await get_series(user_id, period)
+    label = period_text or DEFAULT_PERIOD
+    if not series:
+        return f"За {label} истории пока нет — она копится, пока бот считает портфель."
+
+    lines = [f"*📈 История за {label}*"]
+    total = series.get("total")
+    if total:
+        first, last = total[0], total[-1]
+        usd_values = [usd for _, usd, _ in total]
+        lines.append(
+            f"*Итого:*  {format_num(first[1])} $ → {format_num(last[1])} $  ({_change(first[1], last[1])})"
+        )
+        lines.append(f"{format_num(first[2])} ₽ → {format_num(last[2])} ₽")
+        lines.append(f"мин {format_num(min(usd_values))} $ · макс {format_num(max(usd_values))} $")
+        lines.append("")
+    for asset, name in ASSET_NAMES.items():
+        points = series.get(asset)
+        if not points:
+            continue
+        first, last = points[0][1], points[-1][1]
+        lines.append(f"{name}:  {format_num(first)} $ → {format_num(last)} $  ({_change(first, last)})")
+    return "\n".join(lines)
@@ -0,0 +1,47 @@
+import asyncio
+from typing import Optional
+import httpx
+
+try:
+    import h2  # noqa: F401 — пакет из httpx[http2], закреплён в requirements.txt
+    HTTP2 = True
+except ImportError:
+    # Без h2 httpx откажется создавать клиент с http2=True — откатываемся на HTTP/1.1
+    HTTP2 = False
+
+
+class UpstreamPool:
+    """Long-lived httpx client plus a concurrency cap for one upstream (Esplora, Pendle).
+
+    The client is built on first use and rebuilt if it was closed, so
+    importing a module that owns a pool costs nothing.
+    """
+
+    def __init__(self, max_concurrency: int, timeout: float, http2: bool = False):
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.http2 = http2 and HTTP2
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=self.http2,
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency,
+                ),
+            )
+        return self._client
+
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def aclose(self):
+        """Close the client (call on shutdown)."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -1,22 +1,25 @@
 import asyncio
 import logging
 import os
-import json
-from decimal import Decimal
-import requests
+import httpx
 from dotenv import load_dotenv
 from telegram import Update, BotCommand
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import Application, CommandHandler, ContextTypes
 import locale
-from datetime import datetime
 
-from db import init_db_sync, add_address, remove_address, list_addresses, filter_btc_addresses, filter_eth_addresses, is_addr_eth
-from btc import get_balances_btc, fetch_balance_btc, satoshi_to_btc
-from eth import fetch_balance_eth, get_balances_eth
-from pendle import fetch_pendle_position
-from cg import get_prices
-from euler import single_vault_position
-from rpc_manager import get_balances_concurrent, get_vault_positions_concurrent
+from db import init_db_sync, open_db, close_db, add_address, remove_address, list_addresses
+from btc import fetch_balance_btc, satoshi_to_btc
+from rpc_manager import rpc_manager
+import pendle
+import btc
+from cg import price_service
+from portfolio import STAGES, run_stages, render_portfolio
+from precompute import precomputer
+import history
+import metrics
+import tracing
+from tracing import span
 
 # ---------- базовая настройка ----------
 load_dotenv()
@@ -29,6 +32,7 @@ locale.setlocale(locale.LC_ALL, '')
 
 COMMANDS = [
     BotCommand("portfolio", "Показать баланс портфеля"),
+    BotCommand("history",   "История портфеля: /history 7d"),
     BotCommand("add",       "Добавить BTC ETH‑адрес"),
     BotCommand("remove",    "Удалить адрес"),
     BotCommand("addrlist",      "Список адресов"),
@@ -36,8 +40,10 @@ COMMANDS = [
     BotCommand("help",      "Справка"),
 ]
 
-def format_num(num):
-	return '{:,.0f}'.format(num).replace(',', ' ')
+PROGRESS_EDIT_INTERVAL = 1.0  # сек между промежуточными правками сообщения /portfolio
+FINAL_EDIT_MAX_WAIT = 10      # сек, которые итоговая правка готова переждать flood control
+# Telegram id тех, кому доступны /stats и /portfolio debug; в меню они не публикуются
+ADMIN_IDS = {int(i) for i in os.getenv("ADMIN_IDS", "").split(",") if i.strip()}
 
 # ---------- обработчики команд ----------
 async def setup_commands(application: Application):
@@ -48,6 +54,33 @@ async def setup_commands(application: Application):
     from telegram import MenuButtonCommands
     await application.bot.set_chat_menu_button(menu_button=MenuButtonCommands())
 
+def _log_warm_up(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.warning(f"RPC warm-up failed, the first request will pay for it: {task.exception()!r}")
+
+async def startup(application: Application):
+    """Публикуем меню и запускаем фоновые сервисы."""
+    await open_db()
+    # web3 грузится больше секунды — пусть это случится в фоне, а не на первом /portfolio.
+    # Ссылку держим сами: у цикла событий на задачу только слабая
+    task = asyncio.create_task(asyncio.to_thread(rpc_manager.warm_up))
+    task.add_done_callback(_log_warm_up)
+    application.bot_data["warm_up_task"] = task
+    await setup_commands(application)
+    price_service.start()
+    precomputer.start()
+    await metrics.start_http_server()
+
+async def shutdown(application: Application):
+    """Останавливаем фоновые сервисы и закрываем долгоживущие HTTP-клиенты."""
+    await metrics.stop_http_server()
+    await precomputer.stop()
+    await price_service.stop()
+    await rpc_manager.aclose()
+    await pendle.aclose()
+    await btc.aclose()
+    await close_db()
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(
         "Привет!\n"
@@ -55,6 +88,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "/remove <addr> — удалить адрес\n"
         "/addrlist - список адресов"
         "/portfolio — показать баланс портфеля\n"
+        "/history [24h|7d|4w|3m|1y] — как менялся портфель\n"
         "Для одиночного адреса можешь использовать /balance <addr>."
     )
 
@@ -63,7 +97,11 @@ async def add_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("Формат: /add <btc‑адрес>")
         return
     addr = context.args[0]
-    ok = await add_address(update.effective_user.id, addr)
+    try:
+        ok = await add_address(update.effective_user.id, addr)
+    except ValueError:
+        await update.message.reply_text("⚠️ Не похоже на корректный адрес.")
+        return
     msg = "✅ Адрес добавлен." if ok else "⚠️ Этот адрес уже есть в портфеле."
     await update.message.reply_text(msg)
 
@@ -79,7 +117,7 @@ async def remove_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 async def addrlist_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     lines = []
     addrs = await list_addresses(update.effective_user.id)
-    for addr in addrs:
+    for addr, _ in addrs:
     	lines.append(addr)
     if len(lines) == 0:
     	lines = ["У тебя пока нет адресов. Добавь через /add."]
@@ -95,185 +133,133 @@ async def balance_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     address = context.args[0]
     await update.message.reply_text("⏳ Смотрю…")
     try:
-        satoshis = await asyncio.to_thread(fetch_balance_btc, address)
+        satoshis = await fetch_balance_btc(address)
         btc_balnace = satoshi_to_btc(satoshis)
         await update.message.reply_text(
             f"Баланс адреса `{address}`:\n{btc_balnace:.4f} BTC",
             parse_mode="Markdown",
         )
-    except requests.HTTPError as e:
+    except httpx.HTTPStatusError as e:
         await update.message.reply_text(f"⛔️ Ошибка API: {e.response.status_code}")
     except Exception as e:
         await update.message.reply_text(f"⚠️ Что‑то пошло не так: {e}")
 
+def format_age(seconds):
+    if seconds < 60:
+        return f"{seconds:.0f} сек"
+    return f"{seconds / 60:.0f} мин"
+
 async def portfolio_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    # /portfolio debug — для админа: живой расчёт и разбивка по времени следом
+    debug = bool(context.args) and context.args[0] == "debug" and user_id in ADMIN_IDS
+    with tracing.start_trace("portfolio_cmd", debug=debug) as trace:
+        await _portfolio(update, user_id, debug)
+    if debug:
+        await update.message.reply_text(tracing.render(trace), parse_mode="Markdown")
+
+async def _portfolio(update: Update, user_id: int, debug: bool) -> None:
     try:
-        await update.message.reply_text("⏳ Считаю портфель…")
-        addrs = await list_addresses(update.effective_user.id)
+        precomputer.record_check(user_id)
+        with span("db.list_addresses") as trace_span:
+            addrs = await list_addresses(user_id)
+            trace_span.set(addresses=len(addrs))
         if not addrs:
             await update.message.reply_text("У тебя пока нет адресов. Добавь через /add.")
             return
 
-        btc_addrs = filter_btc_addresses(addrs)
-        balances = await get_balances_btc(btc_addrs)
-        lines = ["*💼 Портфель*"]
-        lines.append("*Биткоин*") 
-        total_sat = 0
-        for addr, bal in balances.items():
-            if isinstance(bal, Exception):
-                lines.append(f"⚠️ {addr[:10]}… — ошибка API")
-            else:
-                total_sat += bal
-                lines.append(f"`{addr[:10]}…` — {satoshi_to_btc(bal):.4f} ฿")
-
-        prices = get_prices("bitcoin,ethereum,tether", "usd,rub")
-        total_btc = satoshi_to_btc(total_sat)
-        price_btc_usd = Decimal(prices["bitcoin"]['usd'])
-        price_btc_rub = Decimal(prices["bitcoin"]['rub'])
-        total_usd = total_btc * price_btc_usd
-        total_rub = total_btc * price_btc_rub
-
-        lines.append(f"Цена  {format_num(price_btc_usd)} $  {format_num(price_btc_rub)} ₽")
-        lines.append("────────────────────────")
-        lines.append(f"*BTC:*  {total_btc:.2f} ฿  {format_num(total_usd)} $  {format_num(total_rub)} ₽")
-
-        eth_addrs = filter_eth_addresses(addrs)
-        # Use concurrent balance fetching for much faster performance
-        eth_balances = await get_balances_concurrent(eth_addrs)
-        lines.append("")
-        lines.append("*Эфир*")
-        total_eth = 0
-        for addr, bal in eth_balances.items():
-            if isinstance(bal, Exception):
-                lines.append(f"⚠️ {addr[:10]}… — ошибка API")
-            else:
-                total_eth += bal
-                lines.append(f"`{addr[:10]}…` — {bal:.4f} Ξ")
-        price_eth_usd = Decimal(prices["ethereum"]['usd'])
-        price_eth_rub = Decimal(prices["ethereum"]['rub'])
-        total_usd_eth = total_eth * price_eth_usd
-        total_rub_eth = total_eth * price_eth_rub
-
-        lines.append(f"Цена  {format_num(price_eth_usd)} $  {format_num(price_eth_rub)} ₽")
-        lines.append("────────────────────────")
-        lines.append(f"*ETH:*  {total_eth:.2f} Ξ  {format_num(total_usd_eth)} $  {format_num(total_rub_eth)} ₽")
-
-        lines.append("")
-        lines.append("*DeFi*")
-        lines.append("Compound USDT")
-        with open('./cache_compound.json', 'r') as file:
-            data_compound = json.load(file)
-        now = datetime.now()
-        file_time = datetime.strptime(data_compound["time"], "%Y-%m-%d %H:%M:%S.%f")
-        diff = now - file_time
-        diff_secons = diff.seconds
-        total_usdt = 0
-        for addr in eth_addrs:
-            supplied_usdt = Decimal(data_compound["addresses"][addr]["supplied"])
-            total_usdt += supplied_usdt
-            if diff_secons > 36000:
-                lines.append(f"⚠️ `{addr[:10]}…` — {supplied_usdt:.0f} ₮")
-            else:
-                lines.append(f"`{addr[:10]}…` — {supplied_usdt:.0f} ₮")
-        price_usdt_usd = Decimal(prices["tether"]['usd'])
-        price_usdt_rub = Decimal(prices["tether"]['rub'])
-        total_usd_usdt = total_usdt * price_usdt_usd
-        total_rub_usdt = total_usdt * price_usdt_rub
-
-        lines.append(f"Цена  {price_usdt_usd:.2f} $  {price_usdt_rub:.2f} ₽")
-        lines.append("────────────────────────")
-        lines.append(f"*USDT:*  {total_usdt:.0f} Ξ  {format_num(total_usd_usdt)} $  {format_num(total_rub_usdt)} ₽")
-
-        lines.append("")
-        lines.append("Pendle USD")
-        total_usd_pendle = 0
-        for addr in eth_addrs:
-            try:
-                supplied_pendle_usd = fetch_pendle_position(addr)
-                total_usd_pendle += supplied_pendle_usd 
-                lines.append(f"`{addr[:10]}…` — {supplied_pendle_usd:.0f} $")
-            except Exception as e:
-                logging.warning(f"Error fetching Pendle position for {addr}: {e}")
-                lines.append(f"⚠️ `{addr[:10]}…` — ошибка API")
-        total_rub_pendle = total_usd_pendle * price_usdt_rub
-        lines.append("────────────────────────")
-        lines.append(f"*Pendle USD:*  {format_num(total_usd_pendle)} $  {format_num(total_rub_pendle)} ₽")
-
-        lines.append("")
-        lines.append("Euler USD")
-        total_eth_euler = 0
-        total_usd_euler = 0
-        
-        # Use concurrent vault position fetching for much faster performance
-        if eth_addrs:
-            try:
-                from euler import ACCOUNT_LENS, ABI
-                euler_positions = await get_vault_positions_concurrent(
-                    eth_addrs, 
-                    "0xD8b27CF359b7D15710a5BE299AF6e7Bf904984C2", 
-                    ACCOUNT_LENS,
-                    ABI
+        # Обычно портфель уже посчитан планировщиком — отвечаем из памяти
+        snapshot = None if debug else precomputer.get(user_id, addrs)
+        tracing.annotate(snapshot=snapshot is not None)
+        if snapshot is not None:
+            text = render_portfolio(addrs, snapshot.results)
+            with span("telegram.reply"):
+                await update.message.reply_text(
+                    f"{text}\n_обновлено {format_age(snapshot.age())} назад_", parse_mode="Markdown"
                 )
-                
-                for addr in eth_addrs:
-                    supplied_euler_eth = euler_positions.get(addr, 0)
-                    total_eth_euler += supplied_euler_eth
-                    total_usd_euler += supplied_euler_eth * price_eth_usd 
-                    lines.append(f"`{addr[:10]}…` — {supplied_euler_eth:.0f} Ξ")
-            except Exception as e:
-                logging.warning(f"Error fetching Euler positions: {e}")
-                for addr in eth_addrs:
-                    lines.append(f"⚠️ `{addr[:10]}…` — ошибка API")
-        
-        total_rub_euler = total_usd_euler * price_usdt_rub
-        lines.append("────────────────────────")
-        lines.append(f"*Euler:*  {total_eth_euler:.2f} Ξ  {format_num(total_usd_euler)} $  {format_num(total_rub_euler)} ₽")
+            return
 
-        lines.append("")
-        alt_usd = 0
-        alt_rub = 0
-        alt_usd += total_usd_eth
-        alt_rub += total_rub_eth
-        alt_usd += total_usd_usdt
-        alt_rub += total_rub_usdt
-        alt_usd += total_usd_pendle
-        alt_rub += total_rub_pendle
-        alt_usd += total_usd_euler
-        alt_rub += total_rub_euler
+        with span("telegram.reply"):
+            message = await update.message.reply_text("⏳ Считаю портфель…")
 
-        lines.append("────────────────────────")
-        lines.append(f"*BTC:*  {format_num(total_usd)} $  {format_num(total_rub)} ₽")
-        lines.append("────────────────────────")
-        lines.append(f"*Альты:*  {format_num(alt_usd)} $  {format_num(alt_rub)} ₽")
+        # Все разделы считаются параллельно; сообщение дорисовывается по мере готовности
+        last_edit = 0.0
+        last_text = None
 
-        total_usd += alt_usd
-        total_rub += alt_rub
-        
-        lines.append("────────────────────────")
-        lines.append(f"*Итого:*  {format_num(total_usd)} $  {format_num(total_rub)} ₽")
+        async def on_update(results):
+            nonlocal last_edit, last_text
+            loop = asyncio.get_running_loop()
+            done = len(results) == len(STAGES)
+            # Telegram ограничивает частоту правок — промежуточные не чаще раза в секунду
+            if not done and loop.time() - last_edit < PROGRESS_EDIT_INTERVAL:
+                return
+            text = render_portfolio(addrs, results)
+            if text == last_text:
+                return
+            # Сбой правки не должен ронять расчёт: снимок и история сохраняются после него
+            for attempt in range(2):
+                try:
+                    with span("telegram.edit"):
+                        await message.edit_text(text, parse_mode="Markdown")
+                    last_edit, last_text = loop.time(), text
+                    return
+                except RetryAfter as e:
+                    wait = e.retry_after
+                    wait = wait.total_seconds() if hasattr(wait, "total_seconds") else wait
+                    if not done or attempt or wait > FINAL_EDIT_MAX_WAIT:
+                        # Промежуточную правку просто пропускаем — следующая её догонит
+                        logging.warning(f"Portfolio message edit throttled for {wait}s, skipping")
+                        return
+                    await asyncio.sleep(wait)
+                except TelegramError as e:
+                    logging.warning(f"Failed to edit portfolio message: {e}")
+                    return
 
-        await update.message.reply_text(
-            "\n".join(lines), parse_mode="Markdown"
-        )
+        results = await run_stages(addrs, on_update)
+        precomputer.store(user_id, addrs, results)
+        with span("history.record"):
+            await history.record(user_id, results)
     except Exception as e:
         logging.error(f"Error in portfolio command: {e}")
         await update.message.reply_text(
             "⚠️ Произошла ошибка при расчете портфеля. Попробуйте позже."
         )
 
+async def history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    period = context.args[0] if context.args else None
+    try:
+        text = await history.render_history(update.effective_user.id, period)
+        await update.message.reply_text(text, parse_mode="Markdown")
+    except Exception as e:
+        logging.error(f"Error in history command: {e}")
+        await update.message.reply_text("⚠️ Не удалось загрузить историю. Попробуйте позже.")
+
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔️ Команда доступна только администратору.")
+        return
+    await update.message.reply_text(metrics.render_stats(), parse_mode="Markdown")
+
 # ---------- точка входа ----------
 def main() -> None:
     # один раз инициализируем БД в отдельном (коротком) цикле
     init_db_sync()
 
-    application = Application.builder().token(TOKEN).post_init(setup_commands).build()
+    application = Application.builder().token(TOKEN).post_init(startup).post_shutdown(shutdown).build()
 
-    application.add_handler(CommandHandler("help", start))
-    application.add_handler(CommandHandler("add", add_cmd))
-    application.add_handler(CommandHandler("remove", remove_cmd))
-    application.add_handler(CommandHandler("addrlist", addrlist_cmd))
-    application.add_handler(CommandHandler("balance", balance_cmd))
-    application.add_handler(CommandHandler("portfolio", portfolio_cmd))
+    handlers = {
+        "help": start,
+        "add": add_cmd,
+        "remove": remove_cmd,
+        "addrlist": addrlist_cmd,
+        "balance": balance_cmd,
+        "portfolio": portfolio_cmd,
+        "history": history_cmd,
+        "stats": stats_cmd,
+    }
+    for command, handler in handlers.items():
+        # Каждая команда меряется: время ответа и вылетевшие исключения
+        application.add_handler(CommandHandler(command, metrics.instrument(command, handler)))
 
     logging.info("Bot is polling…")
     application.run_polling()     # ← БЛОКИРУЕТ поток до Ctrl‑C
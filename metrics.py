@@ -0,0 +1,322 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from functools import lru_cache
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Локальный эндпоинт для Prometheus; METRICS_PORT=0 — выключен
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+
+# Секунды: от кэшированного ответа до упавшего по таймауту апстрима
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Registry:
+    """All metrics of the process, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+class Counter:
+    """Monotonic counter with labels; safe to bump from worker threads."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}    # значения меток → число
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(tuple(str(labels[label]) for label in self.labels), 0)
+
+    def keys(self) -> list:
+        with self._lock:
+            return sorted(self.values)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            yield self.name, dict(zip(self.labels, key)), value
+
+
+class Histogram:
+    """Latency histogram with fixed buckets; quantiles are interpolated within a bucket."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}    # значения меток → [счётчики по бакетам + "+Inf", сумма]
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self._lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        """`with HIST.time(...)`: observe the block's duration (works inside coroutines too)."""
+        return _Timer(self, labels)
+
+    def keys(self) -> list:
+        with self._lock:
+            return sorted(self.values)
+
+    def count(self, key) -> int:
+        return sum(self.values[key][:-1])
+
+    def quantile(self, q, key) -> float:
+        counts = self.values[key][:-1]
+        rank = q * sum(counts)
+        seen = 0
+        lower = 0.0
+        for count, upper in zip(counts, self.buckets + (float("inf"),)):
+            if count and seen + count >= rank:
+                if upper == float("inf"):
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+            lower = upper
+        return lower
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, list(counts)) for key, counts in self.values.items())
+        for key, counts in items:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts[:-1]):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": bound}, cumulative
+            yield f"{self.name}_sum", labels, counts[-1]
+            yield f"{self.name}_count", labels, cumulative
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.monotonic() - self.started, **self.labels)
+        return False
+
+
+class Gauge:
+    """Value read from its owner at scrape time: `fn()` returns {label values tuple: value}."""
+
+    def __init__(self, name, help, labels=(), fn=None, kind="gauge"):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.kind = kind
+        self.fn = fn
+        registry.register(self)
+
+    def samples(self):
+        try:
+            values = self.fn()
+        except Exception as e:
+            logger.warning(f"Metric {self.name} failed: {e!r}")
+            return
+        for key, value in sorted(values.items()):
+            yield self.name, dict(zip(self.labels, key)), value
+
+
+@lru_cache(maxsize=None)
+def endpoint_label(url: str) -> str:
+    """Host and path of an endpoint with long path segments (API keys) hidden."""
+    parts = urlsplit(url)
+    path = "/".join(seg if len(seg) <= 16 else "…" for seg in parts.path.split("/"))
+    return f"{parts.hostname}{path}".rstrip("/")
+
+
+# ---------- каталог ----------
+RPC_REQUESTS = Counter("rpc_requests_total", "JSON-RPC requests by endpoint and outcome", ("endpoint", "outcome"))
+RPC_LATENCY = Histogram("rpc_request_seconds", "JSON-RPC request latency by endpoint", ("endpoint",))
+RPC_RATE_LIMITED = Counter("rpc_rate_limited_total", "HTTP 429 answers by endpoint", ("endpoint",))
+RPC_FAILOVERS = Counter("rpc_failovers_total", "Retries moved to another endpoint after a failure")
+UPSTREAM_LATENCY = Histogram(
+    "upstream_request_seconds", "Esplora, Pendle and CoinGecko request latency", ("upstream", "outcome")
+)
+CACHE_LOOKUPS = Counter("cache_lookups_total", "In-process cache lookups by cache and result", ("cache", "result"))
+HANDLER_LATENCY = Histogram("handler_seconds", "Telegram command handler latency", ("command",))
+HANDLER_ERRORS = Counter("handler_errors_total", "Exceptions escaping a command handler", ("command",))
+
+
+class time_upstream:
+    """`with time_upstream("esplora"):` — latency with outcome "error" if the block raised."""
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        outcome = "ok" if exc_type is None else "error"
+        UPSTREAM_LATENCY.observe(time.monotonic() - self.started, upstream=self.upstream, outcome=outcome)
+        return False
+
+def instrument(command, handler):
+    """Wrap a telegram command handler to record its latency and escaped errors."""
+    async def wrapper(update, context):
+        with HANDLER_LATENCY.time(command=command):
+            try:
+                return await handler(update, context)
+            except Exception:
+                HANDLER_ERRORS.inc(command=command)
+                raise
+    return wrapper
+
+
+# ---------- /stats ----------
+def _ms(seconds):
+    return f"{seconds * 1000:.0f} мс"
+
+def _latency_line(histogram, key):
+    return f"{histogram.count(key)} запр., p50 {_ms(histogram.quantile(0.5, key))}, p95 {_ms(histogram.quantile(0.95, key))}"
+
+def _hit_rate(hits, misses):
+    total = hits + misses
+    return f"{hits / total * 100:.0f}% ({hits:g}/{total:g})" if total else "—"
+
+def render_stats() -> str:
+    """Text for the admin /stats command: the same numbers as /metrics, summarised."""
+    from rpc_manager import rpc_manager, get_endpoint_scores
+
+    lines = ["*📊 Статистика*", "", "*Маршрутизация RPC* (лучший endpoint первым)"]
+    for snap in get_endpoint_scores():
+        cooldown = f", пауза ещё {snap['cooldown_left']:g} с" if snap["cooldown_left"] else ""
+        lines.append(
+            f"`{endpoint_label(snap['endpoint'])}` — оценка {snap['score']:g}, EWMA {_ms(snap['ewma_latency'])}, "
+            f"ошибок {snap['error_rate'] * 100:.0f}%, {snap['rate']:g} запр/с{cooldown}"
+        )
+
+    lines += ["", "*RPC*"]
+    for key in RPC_LATENCY.keys():
+        endpoint = key[0]
+        errors = RPC_REQUESTS.get(endpoint=endpoint, outcome="error")
+        limited = RPC_RATE_LIMITED.get(endpoint=endpoint)
+        lines.append(f"`{endpoint}` — {_latency_line(RPC_LATENCY, key)}, ошибок {errors:g}, 429: {limited:g}")
+    lines.append(f"Переключений endpoint: {RPC_FAILOVERS.get():g}")
+
+    lines += ["", "*Кэши*"]
+    cache = rpc_manager.cache.stats()
+    lines.append(f"RPC: {_hit_rate(cache['hits'], cache['misses'])}, записей {cache['entries']}")
+    for name in sorted({key[0] for key in CACHE_LOOKUPS.keys()}):
+        hits, misses = CACHE_LOOKUPS.get(cache=name, result="hit"), CACHE_LOOKUPS.get(cache=name, result="miss")
+        lines.append(f"`{name}`: {_hit_rate(hits, misses)}")
+
+    lines += ["", "*Апстримы*"]
+    for key in UPSTREAM_LATENCY.keys():
+        upstream, outcome = key
+        lines.append(f"{upstream} ({outcome}) — {_latency_line(UPSTREAM_LATENCY, key)}")
+
+    lines += ["", "*Команды*"]
+    for key in HANDLER_LATENCY.keys():
+        command = key[0]
+        lines.append(f"/{command} — {_latency_line(HANDLER_LATENCY, key)}, ошибок {HANDLER_ERRORS.get(command=command):g}")
+    return "\n".join(lines)
+
+
+# ---------- HTTP ----------
+_server = None
+
+async def _handle(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # Заголовки запроса не нужны, но их надо дочитать
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", registry.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def start_http_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Serve GET /metrics on the running loop; a busy port only costs a warning."""
+    global _server
+    if not port or _server is not None:
+        return
+    try:
+        _server = await asyncio.start_server(_handle, host, port)
+    except OSError as e:
+        logger.warning(f"Metrics endpoint not started on {host}:{port}: {e}")
+        return
+    logger.info(f"Metrics on http://{host}:{port}/metrics")
+
+async def stop_http_server():
+    global _server
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
@@ -1,70 +1,117 @@
-import requests
+import os
+import time
+import random
+import asyncio
+import httpx
 from decimal import Decimal
 import logging
+from typing import Dict, List
+from singleflight import SingleFlight
+from http_pool import UpstreamPool
+from metrics import CACHE_LOOKUPS, time_upstream, endpoint_label
+from tracing import span, incr
 
 logger = logging.getLogger(__name__)
 
 rpc = "https://api-v2.pendle.finance/core/v1/dashboard/positions/database/"
 
-def fetch_pendle_position(addr):
-    """Fetch Pendle position with proper error handling and retry logic."""
-    max_retries = 3
-    timeout = 10
-    
-    for attempt in range(max_retries):
-        try:
-            resp = requests.get(f"{rpc}{addr}", timeout=timeout)
-            resp.raise_for_status()  # Raise exception for HTTP errors
-            
-            data = resp.json()
-            total_pos = Decimal(0)
-            
-            # Check if positions exist in response
-            if "positions" not in data:
-                logger.warning(f"No positions found for address {addr}")
-                return total_pos
-            
-            for pos in data["positions"]:
-                if pos is None: 
-                    continue
-                if "openPositions" not in pos:
-                    continue
-                    
-                for open_pos in pos["openPositions"]:
-                    if "lp" not in open_pos or "valuation" not in open_pos["lp"]:
-                        continue
-                    pos_val = open_pos["lp"]["valuation"]
-                    total_pos += Decimal(str(pos_val))
-            
-            return total_pos
-            
-        except requests.exceptions.Timeout:
-            logger.warning(f"Timeout fetching Pendle position for {addr} (attempt {attempt + 1})")
-            if attempt == max_retries - 1:
-                logger.error(f"Failed to fetch Pendle position for {addr} after {max_retries} attempts")
-                return Decimal(0)
-                
-        except requests.exceptions.ConnectionError as e:
-            logger.warning(f"Connection error fetching Pendle position for {addr}: {e} (attempt {attempt + 1})")
-            if attempt == max_retries - 1:
-                logger.error(f"Failed to fetch Pendle position for {addr} after {max_retries} attempts")
-                return Decimal(0)
-                
-        except requests.exceptions.HTTPError as e:
-            logger.warning(f"HTTP error fetching Pendle position for {addr}: {e} (attempt {attempt + 1})")
-            if attempt == max_retries - 1:
-                logger.error(f"Failed to fetch Pendle position for {addr} after {max_retries} attempts")
-                return Decimal(0)
-                
-        except (KeyError, ValueError, TypeError) as e:
-            logger.error(f"Data parsing error for Pendle position {addr}: {e}")
-            return Decimal(0)
-            
-        except Exception as e:
-            logger.error(f"Unexpected error fetching Pendle position for {addr}: {e}")
-            return Decimal(0)
-    
-    return Decimal(0)
-
-#result = fetch_pendle_position("0x0C8eb038c58E0a9d8D66Bf5805A6eC0dfDaE6c4c")
+MAX_RETRIES = 3
+TIMEOUT = 10
+BACKOFF_BASE = 0.5  # сек, удваивается на каждой попытке, плюс случайный джиттер
+MAX_CONCURRENCY = int(os.getenv("PENDLE_MAX_CONCURRENCY", "8"))
+CACHE_TTL = int(os.getenv("PENDLE_CACHE_TTL", "60"))
+
+_single_flight = SingleFlight()     # адрес, который спрашивают сразу несколько пользователей, идёт в Pendle один раз
+_pool = UpstreamPool(MAX_CONCURRENCY, TIMEOUT)
+# addr → (expires_at, total)
+_cache: Dict[str, tuple] = {}
+
+
+async def aclose():
+    """Close the shared HTTP client (call on shutdown)."""
+    await _pool.aclose()
+
+
+def parse_positions(data) -> Decimal:
+    """Sum LP valuations of all open positions in a Pendle dashboard response."""
+    total_pos = Decimal(0)
+
+    # Check if positions exist in response
+    if "positions" not in data:
+        return total_pos
+
+    for pos in data["positions"]:
+        if pos is None:
+            continue
+        if "openPositions" not in pos:
+            continue
+
+        for open_pos in pos["openPositions"]:
+            if "lp" not in open_pos or "valuation" not in open_pos["lp"]:
+                continue
+            pos_val = open_pos["lp"]["valuation"]
+            total_pos += Decimal(str(pos_val))
+
+    return total_pos
+
+
+async def _request_position(addr) -> Decimal:
+    """One address, with retries and jittered exponential backoff. Raises after the last attempt."""
+    with span("pendle", endpoint=endpoint_label(rpc)) as trace_span:
+        for attempt in range(MAX_RETRIES):
+            trace_span.set(retries=attempt)
+            try:
+                async with _pool.semaphore():
+                    with time_upstream("pendle"):
+                        resp = await _pool.client().get(f"{rpc}{addr}")
+                        resp.raise_for_status()  # Raise exception for HTTP errors
+                data = resp.json()
+                if "positions" not in data:
+                    logger.warning(f"No positions found for address {addr}")
+                return parse_positions(data)
+
+            except (KeyError, ValueError, TypeError) as e:
+                # Ответ пришёл, но не разбирается — повтор не поможет
+                logger.error(f"Data parsing error for Pendle position {addr}: {e}")
+                raise
+
+            except (httpx.TimeoutException, httpx.TransportError, httpx.HTTPStatusError) as e:
+                logger.warning(f"Error fetching Pendle position for {addr}: {e!r} (attempt {attempt + 1})")
+                if attempt == MAX_RETRIES - 1:
+                    logger.error(f"Failed to fetch Pendle position for {addr} after {MAX_RETRIES} attempts")
+                    raise
+                delay = BACKOFF_BASE * 2 ** attempt
+                await asyncio.sleep(delay + random.uniform(0, delay))
+
+async def _fetch_cached(addr) -> Decimal:
+    key = addr.lower()
+    cached = _cache.get(key)
+    if cached is not None and cached[0] > time.monotonic():
+        CACHE_LOOKUPS.inc(cache="pendle", result="hit")
+        incr("cache_hits")
+        return cached[1]
+    CACHE_LOOKUPS.inc(cache="pendle", result="miss")
+
+    total = await _single_flight.do(key, _request_position, addr)
+    _cache[key] = (time.monotonic() + CACHE_TTL, total)
+    return total
+
+async def fetch_pendle_position(addr) -> Decimal:
+    """Fetch Pendle position (USD); failures are logged and count as zero."""
+    try:
+        return await _fetch_cached(addr)
+    except Exception as e:
+        logger.error(f"Unexpected error fetching Pendle position for {addr}: {e}")
+        return Decimal(0)
+
+async def fetch_pendle_positions(addrs: List[str]) -> Dict[str, object]:
+    """Fetch positions of many addresses concurrently (bounded by PENDLE_MAX_CONCURRENCY).
+
+    Returns {addr: Decimal | Exception}, so callers can flag failed addresses.
+    """
+    with span("pendle.positions", addresses=len(addrs), cache_hits=0):
+        results = await asyncio.gather(*(_fetch_cached(addr) for addr in addrs), return_exceptions=True)
+    return dict(zip(addrs, results))
+
+#result = asyncio.run(fetch_pendle_position("0x0C8eb038c58E0a9d8D66Bf5805A6eC0dfDaE6c4c"))
 #print(result)
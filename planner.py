@@ -0,0 +1,115 @@
+import os
+import asyncio
+import logging
+from portfolio import run_stages, STAGE_TIMEOUTS
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = int(os.getenv("PLAN_CHUNK_SIZE", "200"))      # адресов в одном прогоне этапов
+CONCURRENCY = int(os.getenv("PLAN_CONCURRENCY", "4"))      # прогонов параллельно
+# Сек на запрос к апстриму с поштучными запросами (Esplora, Pendle), с запасом:
+# из них складывается дедлайн этапа в фоновом прогоне
+REQUEST_SECONDS = float(os.getenv("PLAN_REQUEST_SECONDS", "1.0"))
+
+# Какой сети адреса нужны этапу (prices от адресов не зависит)
+STAGE_CHAINS = {
+    "btc": "btc",
+    "eth": "eth",
+    "compound": "eth",
+    "pendle": "eth",
+    "euler": "eth",
+}
+
+
+class FetchPlan:
+    """Work for a set of users, deduplicated across them.
+
+    Every unique wallet is fetched once per (chain, protocol) no matter how
+    many users track it; results are fanned back out to each user.
+    `user_addrs` is {user_id: [(address, chain)]}, as the registry returns it.
+    """
+
+    def __init__(self, user_addrs: dict):
+        self.user_addrs = {user_id: list(addrs) for user_id, addrs in user_addrs.items()}
+        self.addresses = sorted({addr for addrs in self.user_addrs.values() for addr in addrs})
+
+    def links(self) -> int:
+        return sum(len(addrs) for addrs in self.user_addrs.values())
+
+    def work_items(self) -> set:
+        """{(chain, stage, address)} — what actually goes upstream."""
+        return {
+            (chain, stage, addr)
+            for stage, stage_chain in STAGE_CHAINS.items()
+            for addr, chain in self.addresses
+            if chain == stage_chain
+        }
+
+    def chunks(self, size=CHUNK_SIZE) -> list:
+        return [self.addresses[i:i + size] for i in range(0, len(self.addresses), size)]
+
+    def fan_out(self, merged: dict, errors: dict) -> dict:
+        """{user_id: stage results} shaped exactly like run_stages output for that user's addresses."""
+        per_user = {}
+        for user_id, addrs in self.user_addrs.items():
+            results = {"prices": merged["prices"]}
+            for stage in STAGE_CHAINS:
+                failed = next((errors[stage][a] for a, _ in addrs if a in errors[stage]), None)
+                if failed is not None:
+                    results[stage] = failed
+                else:
+                    results[stage] = {a: merged[stage][a] for a, _ in addrs if a in merged[stage]}
+            per_user[user_id] = results
+        return per_user
+
+
+def stage_timeouts(chunk_size: int, running: int) -> dict:
+    """Deadlines for one background run of `chunk_size` addresses among `running` parallel runs.
+
+    BTC and Pendle go out address by address through one process-wide
+    semaphore each, so a run waits for every address queued by all runs;
+    the interactive deadlines are sized for one user's handful of wallets.
+    Batched stages (ETH, Euler, Compound) keep them.
+    """
+    import btc
+    import pendle
+
+    queued = chunk_size * running
+    timeouts = dict(STAGE_TIMEOUTS)
+    timeouts["btc"] += queued / btc.MAX_CONCURRENCY * REQUEST_SECONDS
+    timeouts["pendle"] += queued / pendle.MAX_CONCURRENCY * REQUEST_SECONDS
+    return timeouts
+
+async def fetch_for_users(user_addrs: dict, concurrency=CONCURRENCY) -> dict:
+    """Run every stage once over the union of the users' addresses; returns {user_id: results}."""
+    plan = FetchPlan(user_addrs)
+    if not plan.addresses:
+        return {}
+    logger.info(
+        f"Fetch plan: {len(plan.addresses)} unique addresses for {len(plan.user_addrs)} users "
+        f"({plan.links()} links, {len(plan.work_items())} work items)"
+    )
+    semaphore = asyncio.Semaphore(concurrency)
+    chunks = plan.chunks()
+    timeouts = stage_timeouts(max(map(len, chunks)), min(concurrency, len(chunks)))
+
+    async def _run_chunk(chunk):
+        async with semaphore:
+            return chunk, await run_stages(chunk, timeouts=timeouts)
+
+    merged = {"prices": None}
+    merged.update({stage: {} for stage in STAGE_CHAINS})
+    errors = {stage: {} for stage in STAGE_CHAINS}
+    for chunk, results in await asyncio.gather(*(_run_chunk(chunk) for chunk in chunks)):
+        prices = results["prices"]
+        if merged["prices"] is None or isinstance(merged["prices"], Exception):
+            merged["prices"] = prices
+        for stage in STAGE_CHAINS:
+            result = results[stage]
+            if isinstance(result, Exception):
+                # Этап упал для всего прогона — помечаем каждый его адрес своей сети
+                chain = STAGE_CHAINS[stage]
+                errors[stage].update((addr, result) for addr, addr_chain in chunk if addr_chain == chain)
+            else:
+                merged[stage].update(result)
+    return plan.fan_out(merged, errors)
@@ -0,0 +1,352 @@
+import asyncio
+import logging
+import time
+from decimal import Decimal
+
+from db import addresses_on, get_compound_positions
+from btc import get_balances_btc, satoshi_to_btc
+from pendle import fetch_pendle_positions
+from cg import get_prices, price_service
+from compound import COMET
+from rpc_manager import get_balances_concurrent
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+COMPOUND_STALE_SECONDS = 36000
+
+# Дедлайн каждого этапа, сек: опоздавший этап рисуется как ⚠️ и не держит остальные
+STAGE_TIMEOUTS = {
+    "prices": 10,
+    "btc": 15,
+    "eth": 15,
+    "compound": 5,
+    "pendle": 20,
+    "euler": 15,
+}
+
+SEPARATOR = "────────────────────────"
+
+
+def format_num(num):
+	return '{:,.0f}'.format(num).replace(',', ' ')
+
+
+# ---------- этапы ----------
+async def stage_prices(addrs):
+    return await get_prices("bitcoin,ethereum,tether", "usd,rub")
+
+async def stage_btc(addrs):
+    return await get_balances_btc(addresses_on(addrs, "btc"))
+
+async def stage_eth(addrs):
+    return await get_balances_concurrent(addresses_on(addrs, "eth"))
+
+async def stage_compound(addrs):
+    eth_addrs = addresses_on(addrs, "eth")
+    with span("compound.db_read", addresses=len(eth_addrs)) as trace_span:
+        snapshots = await get_compound_positions(eth_addrs, COMET)
+        now = time.time()
+        positions = {}
+        for addr in eth_addrs:
+            entry = snapshots.get(addr)
+            if entry is None:
+                # Демон ещё не видел этот адрес
+                positions[addr] = KeyError(addr)
+            else:
+                stale = now - entry["updated_at"] > COMPOUND_STALE_SECONDS
+                positions[addr] = (Decimal(entry["supplied"]), stale)
+        found = [p for p in positions.values() if not isinstance(p, Exception)]
+        trace_span.set(cache_hits=len(found), stale=sum(stale for _, stale in found))
+    return positions
+
+async def stage_pendle(addrs):
+    return await fetch_pendle_positions(addresses_on(addrs, "eth"))
+
+async def stage_euler(addrs):
+    from euler import fetch_positions_usd
+    return await fetch_positions_usd(addresses_on(addrs, "eth"))
+
+STAGES = {
+    "prices": stage_prices,
+    "btc": stage_btc,
+    "eth": stage_eth,
+    "compound": stage_compound,
+    "pendle": stage_pendle,
+    "euler": stage_euler,
+}
+
+def _being_cancelled() -> bool:
+    """True if the current task itself was asked to cancel (always True before Python 3.11)."""
+    task = asyncio.current_task()
+    cancelling = getattr(task, "cancelling", None)
+    return cancelling is None or cancelling() > 0
+
+async def run_stage(name, addrs, timeouts=STAGE_TIMEOUTS):
+    """Run one stage under its deadline; returns (name, result or exception)."""
+    with span(f"stage.{name}") as trace_span:
+        try:
+            return name, await asyncio.wait_for(STAGES[name](addrs), timeouts[name])
+        except asyncio.TimeoutError:
+            logger.warning(f"Portfolio stage {name} timed out after {timeouts[name]:.0f}s")
+            trace_span.set(error="timeout")
+            return name, TimeoutError(f"{name} timed out")
+        except asyncio.CancelledError:
+            # Отменили нас — пробрасываем; отмена, прилетевшая из чужого общего
+            # запроса (single-flight), — просто ошибка этапа
+            if _being_cancelled():
+                raise
+            logger.warning(f"Portfolio stage {name} got a foreign cancellation")
+            trace_span.set(error="cancelled")
+            return name, RuntimeError(f"{name} was cancelled upstream")
+        except Exception as e:
+            logger.warning(f"Portfolio stage {name} failed: {e}")
+            trace_span.set(error=type(e).__name__)
+            return name, e
+
+async def run_stages(addrs, on_update=None, timeouts=STAGE_TIMEOUTS):
+    """Run all stages concurrently; `on_update(results)` is awaited after each one finishes."""
+    results = {}
+    for next_done in asyncio.as_completed([run_stage(name, addrs, timeouts) for name in STAGES]):
+        name, result = await next_done
+        results[name] = result
+        if on_update is not None:
+            await on_update(results)
+    return results
+
+
+# ---------- отрисовка ----------
+def _price(prices, coin, currency):
+    if prices is None:
+        return None
+    return Decimal(prices[coin][currency])
+
+def _pending_or_failed(lines, result):
+    """Append a placeholder for a stage that is not ready; True if one was added."""
+    if result is None:
+        lines.append("⏳ считаю…")
+        return True
+    if isinstance(result, Exception):
+        lines.append("⚠️ ошибка API")
+        return True
+    return False
+
+def _totals_line(label, amount, usd, rub):
+    parts = [f"*{label}:*"]
+    if amount is not None:
+        parts.append(amount)
+    if usd is not None:
+        parts.append(f"{format_num(usd)} $  {format_num(rub)} ₽")
+    return "  ".join(parts)
+
+def render_portfolio(addrs, results):
+    """Build the portfolio message from whichever stages have finished.
+
+    `results` maps stage name to its result or exception; missing stages are
+    still running and render as ⏳. Totals cover the finished sections only.
+    """
+    prices = results.get("prices")
+    if isinstance(prices, Exception):
+        prices = None
+    eth_addrs = addresses_on(addrs, "eth")
+    price_usdt_rub = _price(prices, "tether", "rub")
+
+    lines = ["*💼 Портфель*"]
+    if prices and price_service.is_stale():
+        # Фоновое обновление цен буксует — суммы посчитаны по последним удачным
+        minutes = (time.time() - price_service.updated_at) // 60
+        lines.append(f"⚠️ _Цены устарели: обновлены {minutes:.0f} мин назад_")
+    total_usd = Decimal(0) if prices else None
+    total_rub = Decimal(0) if prices else None
+    alt_usd = Decimal(0) if prices else None
+    alt_rub = Decimal(0) if prices else None
+
+    # ── BTC ──
+    lines.append("*Биткоин*")
+    balances = results.get("btc")
+    btc_usd = btc_rub = None
+    if not _pending_or_failed(lines, balances):
+        total_sat = 0
+        for addr, bal in balances.items():
+            if isinstance(bal, Exception):
+                lines.append(f"⚠️ {addr[:10]}… — ошибка API")
+            else:
+                total_sat += bal
+                lines.append(f"`{addr[:10]}…` — {satoshi_to_btc(bal):.4f} ฿")
+        total_btc = satoshi_to_btc(total_sat)
+        if prices:
+            price_btc_usd = _price(prices, "bitcoin", "usd")
+            price_btc_rub = _price(prices, "bitcoin", "rub")
+            btc_usd = total_btc * price_btc_usd
+            btc_rub = total_btc * price_btc_rub
+            total_usd += btc_usd
+            total_rub += btc_rub
+            lines.append(f"Цена  {format_num(price_btc_usd)} $  {format_num(price_btc_rub)} ₽")
+        lines.append(SEPARATOR)
+        lines.append(_totals_line("BTC", f"{total_btc:.2f} ฿", btc_usd, btc_rub))
+
+    # ── ETH ──
+    lines.append("")
+    lines.append("*Эфир*")
+    eth_balances = results.get("eth")
+    price_eth_usd = _price(prices, "ethereum", "usd")
+    if not _pending_or_failed(lines, eth_balances):
+        total_eth = 0
+        for addr, bal in eth_balances.items():
+            if isinstance(bal, Exception):
+                lines.append(f"⚠️ {addr[:10]}… — ошибка API")
+            else:
+                total_eth += bal
+                lines.append(f"`{addr[:10]}…` — {bal:.4f} Ξ")
+        usd = rub = None
+        if prices:
+            price_eth_rub = _price(prices, "ethereum", "rub")
+            usd = total_eth * price_eth_usd
+            rub = total_eth * price_eth_rub
+            alt_usd += usd
+            alt_rub += rub
+            lines.append(f"Цена  {format_num(price_eth_usd)} $  {format_num(price_eth_rub)} ₽")
+        lines.append(SEPARATOR)
+        lines.append(_totals_line("ETH", f"{total_eth:.2f} Ξ", usd, rub))
+
+    # ── Compound ──
+    lines.append("")
+    lines.append("*DeFi*")
+    lines.append("Compound USDT")
+    compound = results.get("compound")
+    if not _pending_or_failed(lines, compound):
+        total_usdt = 0
+        for addr in eth_addrs:
+            position = compound.get(addr)
+            if position is None or isinstance(position, Exception):
+                lines.append(f"⚠️ `{addr[:10]}…` — нет данных")
+                continue
+            supplied_usdt, stale = position
+            total_usdt += supplied_usdt
+            if stale:
+                lines.append(f"⚠️ `{addr[:10]}…` — {supplied_usdt:.0f} ₮")
+            else:
+                lines.append(f"`{addr[:10]}…` — {supplied_usdt:.0f} ₮")
+        usd = rub = None
+        if prices:
+            price_usdt_usd = _price(prices, "tether", "usd")
+            usd = total_usdt * price_usdt_usd
+            rub = total_usdt * price_usdt_rub
+            alt_usd += usd
+            alt_rub += rub
+            lines.append(f"Цена  {price_usdt_usd:.2f} $  {price_usdt_rub:.2f} ₽")
+        lines.append(SEPARATOR)
+        lines.append(_totals_line("USDT", f"{total_usdt:.0f} Ξ", usd, rub))
+
+    # ── Pendle ──
+    lines.append("")
+    lines.append("Pendle USD")
+    pendle = results.get("pendle")
+    if not _pending_or_failed(lines, pendle):
+        total_usd_pendle = 0
+        for addr in eth_addrs:
+            supplied_pendle_usd = pendle.get(addr, 0)
+            if isinstance(supplied_pendle_usd, Exception):
+                lines.append(f"⚠️ `{addr[:10]}…` — ошибка API")
+                continue
+            total_usd_pendle += supplied_pendle_usd
+            lines.append(f"`{addr[:10]}…` — {supplied_pendle_usd:.0f} $")
+        rub = None
+        if prices:
+            rub = total_usd_pendle * price_usdt_rub
+            alt_usd += total_usd_pendle
+            alt_rub += rub
+        lines.append(SEPARATOR)
+        lines.append(_totals_line("Pendle USD", None, total_usd_pendle if prices else None, rub))
+
+    # ── Euler ──
+    lines.append("")
+    lines.append("Euler USD")
+    euler_positions = results.get("euler")
+    if not _pending_or_failed(lines, euler_positions):
+        # Все хранилища аккаунта, каждое по цене своего актива — уже в долларах
+        total_usd_euler = 0
+        for addr in eth_addrs:
+            supplied_euler_usd = euler_positions.get(addr, 0)
+            if isinstance(supplied_euler_usd, Exception):
+                lines.append(f"⚠️ `{addr[:10]}…` — ошибка API")
+                continue
+            total_usd_euler += supplied_euler_usd
+            lines.append(f"`{addr[:10]}…` — {supplied_euler_usd:.0f} $")
+        rub = None
+        if prices:
+            rub = total_usd_euler * price_usdt_rub
+            alt_usd += total_usd_euler
+            alt_rub += rub
+        lines.append(SEPARATOR)
+        lines.append(_totals_line("Euler USD", None, total_usd_euler if prices else None, rub))
+
+    # ── Итого ──
+    lines.append("")
+    if prices:
+        btc_usd = btc_usd or 0
+        btc_rub = btc_rub or 0
+        lines.append(SEPARATOR)
+        lines.append(f"*BTC:*  {format_num(btc_usd)} $  {format_num(btc_rub)} ₽")
+        lines.append(SEPARATOR)
+        lines.append(f"*Альты:*  {format_num(alt_usd)} $  {format_num(alt_rub)} ₽")
+        lines.append(SEPARATOR)
+        lines.append(f"*Итого:*  {format_num(total_usd + alt_usd)} $  {format_num(total_rub + alt_rub)} ₽")
+    elif results.get("prices") is None:
+        lines.append("⏳ Итого: жду цены…")
+    else:
+        lines.append("⚠️ Итого недоступно: нет цен")
+
+    unfinished = [
+        name for name in STAGES
+        if name != "prices" and (name not in results or isinstance(results[name], Exception))
+    ]
+    if prices and unfinished:
+        lines.append("_без учёта незавершённых разделов_")
+
+    return "\n".join(lines)
+
+
+# ---------- оценка для истории ----------
+ASSET_STAGES = ("btc", "eth", "compound", "pendle", "euler")
+
+def _stage_total(result):
+    """Sum of a stage's per-address values, or None if the stage or any address failed."""
+    if result is None or isinstance(result, Exception):
+        return None
+    total = Decimal(0)
+    for value in result.values():
+        if isinstance(value, Exception):
+            return None
+        if isinstance(value, tuple):  # compound: (supplied, stale)
+            value = value[0]
+        total += Decimal(value)
+    return total
+
+def valuations(results):
+    """{asset: (usd, rub)} for every fully successful stage, same math as render_portfolio.
+
+    Partial sums would show up as fake dips in the history, so a stage with
+    any failed address is left out, and "total" is only present when every
+    stage succeeded.
+    """
+    prices = results.get("prices")
+    if prices is None or isinstance(prices, Exception):
+        return {}
+    usdt_rub = _price(prices, "tether", "rub")
+    amounts = {name: _stage_total(results.get(name)) for name in ASSET_STAGES}
+    values = {}
+    if amounts["btc"] is not None:
+        btc = satoshi_to_btc(amounts["btc"])
+        values["btc"] = (btc * _price(prices, "bitcoin", "usd"), btc * _price(prices, "bitcoin", "rub"))
+    if amounts["eth"] is not None:
+        values["eth"] = (amounts["eth"] * _price(prices, "ethereum", "usd"), amounts["eth"] * _price(prices, "ethereum", "rub"))
+    if amounts["compound"] is not None:
+        values["compound"] = (amounts["compound"] * _price(prices, "tether", "usd"), amounts["compound"] * usdt_rub)
+    if amounts["pendle"] is not None:
+        values["pendle"] = (amounts["pendle"], amounts["pendle"] * usdt_rub)
+    if amounts["euler"] is not None:
+        values["euler"] = (amounts["euler"], amounts["euler"] * usdt_rub)
+    if len(values) == len(ASSET_STAGES):
+        values["total"] = (sum(v[0] for v in values.values()), sum(v[1] for v in values.values()))
+    return values
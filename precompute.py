@@ -0,0 +1,176 @@
+import os
+import time
+import asyncio
+import logging
+from db import list_user_addresses, list_user_ids
+from planner import fetch_for_users
+from daemon import refresh_compound
+import history
+from metrics import CACHE_LOOKUPS, Gauge
+
+logger = logging.getLogger(__name__)
+
+TICK = 10                                                               # сек между проверками расписания
+REFRESH_MIN = int(os.getenv("PRECOMPUTE_REFRESH_MIN", "60"))            # самые активные пользователи
+REFRESH_IDLE = int(os.getenv("PRECOMPUTE_REFRESH_IDLE", "1800"))        # давно не заходившие
+ACTIVE_WINDOW = 6 * 3600                # после этого пользователь считается неактивным
+MAX_AGE = int(os.getenv("PRECOMPUTE_MAX_AGE", "3600"))                  # старше — считаем вживую
+COMPOUND_REFRESH = int(os.getenv("COMPOUND_REFRESH_INTERVAL", "600"))   # цикл бывшего daemon.py
+HISTORY_ROLLUP = 3600                   # сек между даунсэмплингом истории
+GAP_ALPHA = 0.3                         # вес нового интервала в EWMA между проверками
+
+
+class Snapshot:
+    """Portfolio stage results of one user, computed for a specific address list."""
+
+    def __init__(self, addrs, results):
+        self.addrs = tuple(sorted(addrs))
+        self.results = results
+        self.computed_at = time.time()
+
+    def age(self) -> float:
+        return time.time() - self.computed_at
+
+
+class UserActivity:
+    """How often a user runs /portfolio: last check and EWMA of the gap between checks."""
+
+    def __init__(self):
+        self.last_check = None
+        self.avg_gap = None
+
+    def record(self, now):
+        if self.last_check is not None:
+            gap = now - self.last_check
+            self.avg_gap = gap if self.avg_gap is None else GAP_ALPHA * gap + (1 - GAP_ALPHA) * self.avg_gap
+        self.last_check = now
+
+
+class Precomputer:
+    """Refreshes every user's portfolio in the background so /portfolio is a memory read.
+
+    Users who check often get refreshed often (a quarter of their usual gap
+    between checks, within REFRESH_MIN..REFRESH_IDLE); users who haven't
+    checked for ACTIVE_WINDOW drop to REFRESH_IDLE. Compound positions are
+    refreshed on their own, slower cycle.
+    """
+
+    def __init__(self, tick=TICK):
+        self.tick = tick
+        self.snapshots = {}     # user_id → Snapshot
+        self.activity = {}      # user_id → UserActivity
+        self.compound_refreshed_at = 0.0
+        self.history_rolled_at = 0.0
+        self._task = None
+        self._compound_task = None
+
+    def record_check(self, user_id):
+        self.activity.setdefault(user_id, UserActivity()).record(time.time())
+
+    def refresh_interval(self, user_id) -> float:
+        activity = self.activity.get(user_id)
+        if activity is None or time.time() - activity.last_check > ACTIVE_WINDOW:
+            return REFRESH_IDLE
+        if activity.avg_gap is None:
+            return REFRESH_MIN
+        return min(max(activity.avg_gap / 4, REFRESH_MIN), REFRESH_IDLE)
+
+    def due_users(self, user_ids) -> list:
+        """Users whose snapshot is older than their interval, most recently active first."""
+        due = []
+        for user_id in user_ids:
+            snapshot = self.snapshots.get(user_id)
+            if snapshot is None or snapshot.age() >= self.refresh_interval(user_id):
+                due.append(user_id)
+        return sorted(due, key=lambda u: self.activity[u].last_check if u in self.activity else 0, reverse=True)
+
+    def get(self, user_id, addrs):
+        """Fresh enough snapshot for exactly these addresses, or None."""
+        snapshot = self.snapshots.get(user_id)
+        if snapshot is None or snapshot.addrs != tuple(sorted(addrs)) or snapshot.age() > MAX_AGE:
+            CACHE_LOOKUPS.inc(cache="snapshot", result="miss")
+            return None
+        CACHE_LOOKUPS.inc(cache="snapshot", result="hit")
+        return snapshot
+
+    def store(self, user_id, addrs, results):
+        """Save stage results; a failed stage keeps the previous good result for the same addresses."""
+        previous = self.snapshots.get(user_id)
+        snapshot = Snapshot(addrs, dict(results))
+        if previous is not None and previous.addrs == snapshot.addrs and previous.age() <= MAX_AGE:
+            for name, result in snapshot.results.items():
+                old = previous.results.get(name)
+                if isinstance(result, Exception) and old is not None and not isinstance(old, Exception):
+                    snapshot.results[name] = old
+        self.snapshots[user_id] = snapshot
+        return snapshot
+
+    async def refresh_users(self, user_ids):
+        """Recompute portfolios of several users; wallets shared between them are fetched once."""
+        user_addrs = await list_user_addresses(user_ids)
+        for user_id, addrs in user_addrs.items():
+            if not addrs:
+                self.snapshots.pop(user_id, None)
+        user_addrs = {user_id: addrs for user_id, addrs in user_addrs.items() if addrs}
+        started = time.monotonic()
+        per_user = await fetch_for_users(user_addrs)
+        logger.debug(f"Precomputed {len(per_user)} portfolios in {time.monotonic() - started:.2f}s")
+        for user_id, results in per_user.items():
+            self.store(user_id, user_addrs[user_id], results)
+            await history.record(user_id, results)
+
+    async def _refresh_compound(self):
+        try:
+            await refresh_compound()
+        except Exception as e:
+            logger.error(f"Scheduled Compound refresh failed: {e}")
+
+    async def run_once(self):
+        """One scheduler tick: kick off the Compound cycle if due, roll up history, refresh due users."""
+        if time.time() - self.compound_refreshed_at >= COMPOUND_REFRESH and (
+            self._compound_task is None or self._compound_task.done()
+        ):
+            self.compound_refreshed_at = time.time()
+            self._compound_task = asyncio.create_task(self._refresh_compound())
+
+        if time.time() - self.history_rolled_at >= HISTORY_ROLLUP:
+            self.history_rolled_at = time.time()
+            try:
+                await history.rollup()
+            except Exception as e:
+                logger.error(f"History rollup failed: {e}")
+
+        user_ids = await list_user_ids()
+        for user_id in list(self.snapshots):
+            if user_id not in user_ids:
+                del self.snapshots[user_id]
+        due = self.due_users(user_ids)
+        if due:
+            await self.refresh_users(due)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Precompute tick failed: {e}")
+            await asyncio.sleep(self.tick)
+
+    def start(self):
+        """Start the scheduler on the running loop."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        for task in (self._task, self._compound_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = self._compound_task = None
+
+
+precomputer = Precomputer()
+Gauge("precompute_snapshots", "Users with a precomputed portfolio in memory", fn=lambda: {(): len(precomputer.snapshots)})
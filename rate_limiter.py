@@ -0,0 +1,93 @@
+import time
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+
+class TokenBucket:
+    """Token bucket with adaptive rate (AIMD) for one upstream endpoint.
+
+    `acquire()` awaits without blocking the event loop; `acquire_blocking()`
+    is for callers already running in a worker thread. Tokens are reserved
+    under a short lock and the wait happens outside it, so callers never
+    serialize on each other's sleeps.
+    """
+
+    def __init__(self, rate: float, burst: int, min_rate: float = 0.5):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.tokens = float(burst)
+        self.blocked_until = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self._updated = now
+
+    def reserve(self) -> float:
+        """Take a token (possibly borrowed from the future); return seconds to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= 1
+            wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+            return max(wait, self.blocked_until - now)
+
+    def expected_wait(self) -> float:
+        """Seconds the next reserve() would wait, without taking a token."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+            return max(wait, self.blocked_until - now)
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def acquire_blocking(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def on_success(self):
+        """Additive increase back towards the configured rate."""
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+    def on_rate_limited(self, retry_after: Optional[float] = None):
+        """Multiplicative decrease; hold all tokens until Retry-After has passed."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0.0
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self._refill(time.monotonic())
+            return {"rate": round(self.rate, 2), "max_rate": self.max_rate, "tokens": round(self.tokens, 2)}
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds from a Retry-After header (delta-seconds or HTTP-date), None if absent/invalid."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,105 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+from eth_utils import function_signature_to_4byte_selector
+
+# (chain, method, to, calldata, block)
+CacheKey = Tuple[int, str, Optional[str], Optional[str], str]
+
+MISSING = object()  # sentinel for "not cached", since None is a valid result
+
+# Результаты этих вызовов не меняются (кроме редких governance-апгрейдов)
+IMMUTABLE_SIGNATURES = [
+    "symbol()",
+    "decimals()",
+    "name()",
+    "baseToken()",
+    "baseScale()",
+]
+IMMUTABLE_SELECTORS = {
+    "0x" + function_signature_to_4byte_selector(sig).hex() for sig in IMMUTABLE_SIGNATURES
+}
+
+
+class RPCCache:
+    """Bounded LRU cache for JSON-RPC results keyed by call content.
+
+    Entries are keyed on (chain, method, to-address, calldata, block tag), so
+    two different calls can never share a slot. TTLs are per method, with a
+    long TTL for eth_calls of immutable getters (symbol, decimals, baseToken…).
+    """
+
+    def __init__(self, max_entries: int = 10000, immutable_ttl: float = 24 * 3600):
+        self.max_entries = max_entries
+        self.immutable_ttl = immutable_ttl
+        self.method_ttls = {
+            "eth_chainId": float("inf"),
+            "eth_getBalance": 15,
+            "eth_call": 30,
+        }
+        self.default_ttl = 30
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[CacheKey, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(chain: int, method: str, to: Optional[str] = None,
+                 calldata: Optional[str] = None, block: str = "latest") -> CacheKey:
+        return (
+            chain,
+            method,
+            to.lower() if to else None,
+            calldata.lower() if calldata else None,
+            block,
+        )
+
+    def ttl_for(self, key: CacheKey) -> float:
+        """TTL of an entry: long for immutable getters, otherwise per method."""
+        _, method, _, calldata, _ = key
+        if method == "eth_call" and calldata and calldata[:10] in IMMUTABLE_SELECTORS:
+            return self.immutable_ttl
+        return self.method_ttls.get(method, self.default_ttl)
+
+    def get(self, key: CacheKey, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: CacheKey, value: Any):
+        expires_at = time.monotonic() + self.ttl_for(key)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        """Number of stored entries, expired ones included until they are evicted."""
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -1,16 +1,109 @@
+import os
 import time
 import random
 import asyncio
+import httpx
 from typing import List, Optional, Dict, Any
-from web3 import Web3, HTTPProvider
-from web3.exceptions import Web3Exception
 import requests
 import logging
-from functools import lru_cache
 import threading
+import json
+import hashlib
+from requests.adapters import HTTPAdapter
+from eth_utils import to_checksum_address, from_wei
+from rpc_cache import RPCCache, MISSING
+from rate_limiter import TokenBucket, parse_retry_after
+from singleflight import SingleFlight
+from metrics import RPC_REQUESTS, RPC_LATENCY, RPC_RATE_LIMITED, RPC_FAILOVERS, Gauge, endpoint_label
+from tracing import span, incr
 
 logger = logging.getLogger(__name__)
 
+# Multicall3 задеплоен по одному адресу во всех EVM-сетях
+MULTICALL3_ADDRESS = to_checksum_address("0xcA11bde05977b3631167028862bE2a173976CA11")
+def decode_output(fn, data: bytes):
+    """Decode a bound contract function's return data; single outputs are unwrapped.
+
+    web3/eth_abi are imported here rather than at module level: importing
+    web3 alone costs over a second of bot startup.
+    """
+    from eth_abi import decode as abi_decode
+    from web3._utils.abi import get_abi_output_types
+    decoded = abi_decode(get_abi_output_types(fn.abi), data)
+    return decoded[0] if len(decoded) == 1 else decoded
+
+MULTICALL3_ABI = [
+    {"name":"aggregate3","type":"function","stateMutability":"payable",
+     "inputs":[{"name":"calls","type":"tuple[]","components":[
+         {"name":"target","type":"address"},
+         {"name":"allowFailure","type":"bool"},
+         {"name":"callData","type":"bytes"},
+     ]}],
+     "outputs":[{"name":"returnData","type":"tuple[]","components":[
+         {"name":"success","type":"bool"},
+         {"name":"returnData","type":"bytes"},
+     ]}]},
+]
+
+class RPCError(Exception):
+    """Error returned for a single item of a JSON-RPC batch."""
+
+    def __init__(self, code: int, message: str):
+        super().__init__(f"RPC error {code}: {message}")
+        self.code = code
+        self.message = message
+
+class EndpointHealth:
+    """Rolling health of one RPC endpoint: EWMA latency, error rate, cooldown."""
+
+    def __init__(self, endpoint: str, priority: int, alpha: float = 0.2, initial_latency: float = 0.3):
+        self.endpoint = endpoint
+        self.priority = priority  # position in rpc_endpoints, used as a tie-breaker
+        self.alpha = alpha
+        self.ewma_latency = initial_latency
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.rate_limit_strikes = 0  # consecutive 429s, drives the adaptive backoff
+
+    def record_success(self, latency: float):
+        self.requests += 1
+        self.ewma_latency = self.alpha * latency + (1 - self.alpha) * self.ewma_latency
+        self.error_rate = (1 - self.alpha) * self.error_rate
+
+    def record_failure(self, latency: float):
+        self.requests += 1
+        self.failures += 1
+        # Timeouts are failures *and* slow: let them push the latency estimate up too
+        self.ewma_latency = self.alpha * latency + (1 - self.alpha) * self.ewma_latency
+        self.error_rate = self.alpha + (1 - self.alpha) * self.error_rate
+
+    def is_available(self, now: float) -> bool:
+        return now >= self.cooldown_until
+
+    def score(self) -> float:
+        """Expected cost of sending a request here (lower is better)."""
+        return (
+            self.ewma_latency
+            * (1 + 10 * self.error_rate)
+            * (1 + 0.25 * self.in_flight)
+            + 0.001 * self.priority
+        )
+
+    def snapshot(self, now: float) -> dict:
+        return {
+            "endpoint": self.endpoint,
+            "score": round(self.score(), 4),
+            "ewma_latency": round(self.ewma_latency, 4),
+            "error_rate": round(self.error_rate, 4),
+            "requests": self.requests,
+            "failures": self.failures,
+            "in_flight": self.in_flight,
+            "cooldown_left": max(0.0, round(self.cooldown_until - now, 1)),
+        }
+
 class RPCManager:
     """Manages multiple RPC endpoints with automatic failover and rate limiting handling."""
     
@@ -26,182 +119,583 @@ class RPCManager:
             "https://rpc.ankr.com/eth",  # Ankr public RPC (requires auth)
         ]
         
-        self.current_endpoint_index = 0
-        self.rate_limited_endpoints = set()
-        self.last_request_time = 0
-        self.min_request_interval = 0.01  # Reduced to 10ms between requests
-        self.request_lock = threading.Lock()
-        self.endpoint_locks = {endpoint: threading.Lock() for endpoint in self.rpc_endpoints}
-        self.cache = {}
-        self.cache_ttl = 30  # Cache for 30 seconds
+        # Health model per endpoint; traffic goes to the best-scoring ones
+        self.health = {
+            endpoint: EndpointHealth(endpoint, priority)
+            for priority, endpoint in enumerate(self.rpc_endpoints)
+        }
+        self.health_lock = threading.RLock()
+        self.spread_endpoints = 3  # healthy endpoints sharing the load at once
+        self.spread_factor = 2.0   # ...as long as their score is within this factor of the best
+        self.explore_rate = 0.02   # share of requests probing a random endpoint so scores can recover
+        # Cooldown after 401/403, and the adaptive backoff bounds after a 429 without Retry-After
+        self.auth_error_cooldown = 120
+        self.rate_limit_backoff = 5
+        self.rate_limit_backoff_max = 120
+        # Token bucket per endpoint: requests/second and burst, overridable per endpoint
+        self.default_rate_limit = (float(os.getenv("RPC_RATE", "20")), int(os.getenv("RPC_BURST", "40")))
+        self.rate_limits = {
+            "https://eth-mainnet.g.alchemy.com/v2/demo": (2, 5),
+            "https://ethereum.blockpi.network/v1/rpc/public": (5, 10),
+        }
+        self.buckets: Dict[str, TokenBucket] = {}
+        self._local = threading.local()
+        self.chain_id = 1  # all endpoints are Ethereum mainnet
+        self.cache = RPCCache(max_entries=int(os.getenv("RPC_CACHE_SIZE", "10000")))
+        # Identical calls in flight at the same time share one upstream request
+        self.single_flight = SingleFlight()
+        self.multicall_chunk_size = 200  # Max sub-calls packed into one aggregate3
+        # Max items per JSON-RPC batch POST, per endpoint (public nodes cap batch size)
+        self.batch_sizes = {
+            "https://ethereum.publicnode.com": 100,
+            "https://eth-mainnet.g.alchemy.com/v2/4T2FGg31ChPTZ2bQML9iW": 50,
+            "https://eth-mainnet.g.alchemy.com/v2/demo": 10,
+            "https://eth.llamarpc.com": 50,
+            "https://ethereum.blockpi.network/v1/rpc/public": 10,
+            "https://eth-mainnet.public.blastapi.io": 50,
+            "https://rpc.ankr.com/eth": 50,
+        }
+        self.default_batch_size = 20
+        self.request_timeout = 10
+        # Async engine: shared httpx client + cap on in-flight requests
+        self.max_concurrency = int(os.getenv("RPC_MAX_CONCURRENCY", "16"))
+        self.session = self._make_session()
+        # Long-lived Web3 per endpoint and prebuilt contracts per (endpoint, address, ABI)
+        self._web3_instances: Dict[str, Any] = {}
+        self._codec_web3 = None  # provider-less, only for encoding calldata; built on first use
+        self._contracts: Dict[tuple, Any] = {}
+        self._abi_keys: Dict[int, tuple] = {}
+        self._pool_lock = threading.Lock()
+        self._async_client: Optional[httpx.AsyncClient] = None
+        self._async_semaphore: Optional[asyncio.Semaphore] = None
         
     def _get_current_endpoint(self) -> str:
-        """Get the current active RPC endpoint."""
-        return self.rpc_endpoints[self.current_endpoint_index]
-    
-    def _switch_to_next_endpoint(self):
-        """Switch to the next available RPC endpoint."""
-        # Try to find an available endpoint
-        original_index = self.current_endpoint_index
-        attempts = 0
-        
-        while attempts < len(self.rpc_endpoints):
-            self.current_endpoint_index = (self.current_endpoint_index + 1) % len(self.rpc_endpoints)
-            current_endpoint = self._get_current_endpoint()
-            
-            if self._is_endpoint_available(current_endpoint):
-                logger.info(f"Switched to available RPC endpoint: {current_endpoint}")
-                return
-            
-            attempts += 1
-        
-        # If no available endpoint found, reset to original and log warning
-        self.current_endpoint_index = original_index
-        logger.warning(f"No available endpoints found, staying on: {self._get_current_endpoint()}")
-    
+        """Endpoint of the request in progress on this thread, or the best one to use now."""
+        return getattr(self._local, "endpoint", None) or self._pick_endpoint()
+
+    def _get_health(self, endpoint: str) -> EndpointHealth:
+        health = self.health.get(endpoint)
+        if health is None:
+            with self.health_lock:
+                health = self.health.setdefault(endpoint, EndpointHealth(endpoint, len(self.health)))
+        return health
+
+    def _pick_endpoint(self, exclude=()) -> str:
+        """Pick an endpoint for the next request.
+
+        Candidates are the available endpoints not tried yet in this request;
+        one of the few best-scoring ones is chosen at random weighted by
+        1/score, so load is spread across several healthy endpoints.
+        """
+        now = time.time()
+        with self.health_lock:
+            healths = [self._get_health(endpoint) for endpoint in self.rpc_endpoints]
+            candidates = [h for h in healths if h.is_available(now) and h.endpoint not in exclude]
+            if not candidates:
+                candidates = [h for h in healths if h.is_available(now)]
+            if not candidates:
+                # Everything is cooling down: use the endpoint that recovers first
+                best = min(healths, key=lambda h: h.cooldown_until)
+                logger.warning(f"No available endpoints found, using: {best.endpoint}")
+                return best.endpoint
+
+            if len(candidates) > 1 and random.random() < self.explore_rate:
+                return random.choice(candidates).endpoint
+
+            # Time we'd spend waiting for the endpoint's token bucket counts against it
+            scores = {h.endpoint: h.score() + self._get_bucket(h.endpoint).expected_wait() for h in candidates}
+            candidates.sort(key=lambda h: scores[h.endpoint])
+            best_score = scores[candidates[0].endpoint]
+            pool = [h for h in candidates[:self.spread_endpoints] if scores[h.endpoint] <= best_score * self.spread_factor]
+            weights = [1 / scores[h.endpoint] for h in pool]
+            return random.choices(pool, weights=weights)[0].endpoint
+
+    def _begin_request(self, endpoint: str) -> float:
+        with self.health_lock:
+            self._get_health(endpoint).in_flight += 1
+        return time.monotonic()
+
+    def _end_request(self, endpoint: str, started: float, ok: bool):
+        latency = time.monotonic() - started
+        with self.health_lock:
+            health = self._get_health(endpoint)
+            health.in_flight -= 1
+            if ok:
+                health.record_success(latency)
+                health.rate_limit_strikes = 0
+            else:
+                health.record_failure(latency)
+        if ok:
+            self._get_bucket(endpoint).on_success()
+        label = endpoint_label(endpoint)
+        RPC_REQUESTS.inc(endpoint=label, outcome="ok" if ok else "error")
+        RPC_LATENCY.observe(latency, endpoint=label)
+
     def _is_endpoint_available(self, endpoint: str) -> bool:
-        """Check if an endpoint is available (not rate limited)."""
-        return endpoint not in self.rate_limited_endpoints
-    
-    def _mark_endpoint_rate_limited(self, endpoint: str):
-        """Mark an endpoint as rate limited."""
-        self.rate_limited_endpoints.add(endpoint)
-        logger.warning(f"Marked endpoint as rate limited: {endpoint}")
-        
-        # Remove from rate limited set after 2 minutes (shorter timeout)
-        def remove_from_rate_limited():
-            time.sleep(120)  # 2 minutes
-            self.rate_limited_endpoints.discard(endpoint)
-            logger.info(f"Removed rate limit from endpoint: {endpoint}")
-        
-        import threading
-        threading.Thread(target=remove_from_rate_limited, daemon=True).start()
+        """Check if an endpoint is available (not cooling down after a rate limit)."""
+        return self._get_health(endpoint).is_available(time.time())
     
-    def _get_cache_key(self, func_name: str, *args, **kwargs) -> str:
-        """Generate cache key for function call."""
-        key_parts = [func_name] + [str(arg) for arg in args] + [f"{k}={v}" for k, v in sorted(kwargs.items())]
-        return "|".join(key_parts)
-    
-    def _is_cache_valid(self, cache_key: str) -> bool:
-        """Check if cache entry is still valid."""
-        if cache_key not in self.cache:
-            return False
-        cache_time, _ = self.cache[cache_key]
-        return time.time() - cache_time < self.cache_ttl
-    
-    def _get_from_cache(self, cache_key: str) -> Any:
-        """Get value from cache if valid."""
-        if self._is_cache_valid(cache_key):
-            _, value = self.cache[cache_key]
-            return value
-        return None
+    def _mark_endpoint_rate_limited(self, endpoint: str, retry_after: Optional[float] = None):
+        """Put an endpoint on cooldown after a 429.
+
+        Honors Retry-After when the endpoint sends it, otherwise backs off
+        exponentially with consecutive 429s. Expiry is checked by timestamp.
+        """
+        with self.health_lock:
+            health = self._get_health(endpoint)
+            health.rate_limit_strikes += 1
+            if retry_after is None:
+                retry_after = min(
+                    self.rate_limit_backoff_max,
+                    self.rate_limit_backoff * 2 ** (health.rate_limit_strikes - 1),
+                )
+            health.cooldown_until = max(health.cooldown_until, time.time() + retry_after)
+        self._get_bucket(endpoint).on_rate_limited(retry_after)
+        RPC_RATE_LIMITED.inc(endpoint=endpoint_label(endpoint))
+        logger.warning(f"Marked endpoint as rate limited for {retry_after:.0f}s: {endpoint}")
+
+    def _mark_endpoint_unauthorized(self, endpoint: str):
+        """Put an endpoint that rejects us (401/403) on a long cooldown."""
+        with self.health_lock:
+            self._get_health(endpoint).cooldown_until = time.time() + self.auth_error_cooldown
+        logger.warning(f"Marked endpoint as unauthorized for {self.auth_error_cooldown}s: {endpoint}")
+
+    def _get_bucket(self, endpoint: str) -> TokenBucket:
+        bucket = self.buckets.get(endpoint)
+        if bucket is None:
+            rate, burst = self.rate_limits.get(endpoint, self.default_rate_limit)
+            bucket = self.buckets.setdefault(endpoint, TokenBucket(rate, burst))
+        return bucket
+
+    def _handle_http_status(self, endpoint: str, status_code: int, headers, error: Exception):
+        """Shared 429/401/403 handling for the sync and async engines."""
+        if status_code == 429:  # Rate limited
+            logger.warning(f"Rate limited on endpoint {endpoint}: {error}")
+            self._mark_endpoint_rate_limited(endpoint, parse_retry_after(headers.get("Retry-After")))
+        elif status_code in [401, 403]:  # Unauthorized/Forbidden
+            logger.warning(f"Unauthorized access to endpoint {endpoint}: {error}")
+            self._mark_endpoint_unauthorized(endpoint)
+        else:
+            logger.error(f"HTTP error on endpoint {endpoint}: {error}")
+
+    def get_endpoint_scores(self) -> List[dict]:
+        """Health snapshot of every endpoint, best first."""
+        now = time.time()
+        with self.health_lock:
+            snapshots = [
+                {**self._get_health(endpoint).snapshot(now), **self._get_bucket(endpoint).snapshot()}
+                for endpoint in self.rpc_endpoints
+            ]
+        return sorted(snapshots, key=lambda snap: (snap["cooldown_left"] > 0, snap["score"]))
     
-    def _set_cache(self, cache_key: str, value: Any):
-        """Set value in cache."""
-        self.cache[cache_key] = (time.time(), value)
+    def cache_key(self, method: str, to: Optional[str] = None, calldata: Optional[str] = None, block: str = "latest"):
+        """Content-addressed cache key of a JSON-RPC call on this manager's chain."""
+        return RPCCache.make_key(self.chain_id, method, to, calldata, block)
     
     def _rate_limit_delay(self, endpoint: str):
-        """Add delay to respect rate limits per endpoint."""
-        with self.endpoint_locks[endpoint]:
-            current_time = time.time()
-            last_time_key = f"{endpoint}_last_request"
-            
-            if last_time_key in self.cache:
-                last_request_time, _ = self.cache[last_time_key]
-                time_since_last_request = current_time - last_request_time
-                
-                if time_since_last_request < self.min_request_interval:
-                    sleep_time = self.min_request_interval - time_since_last_request
-                    time.sleep(sleep_time)
-            
-            self.cache[last_time_key] = (current_time, None)
+        """Wait for the endpoint's token bucket (sync callers run in worker threads)."""
+        self._get_bucket(endpoint).acquire_blocking()
     
-    def _make_request_with_retry(self, func, *args, max_retries=3, use_cache=True, **kwargs):
-        """Make a request with automatic retry, endpoint switching, and caching."""
-        # Check cache first
+    def _make_request_with_retry(self, func, *args, max_retries=3, use_cache=True, cache_key=None, **kwargs):
+        """Make a request with automatic retry, endpoint switching, and caching.
+
+        The result is cached, and identical concurrent calls are coalesced,
+        only when the caller supplies a `cache_key` (see `cache_key()`), since
+        `func` is usually an argument-less closure.
+        """
+        if cache_key is None:
+            return self._request_with_retry(func, args, kwargs, max_retries)
+
         if use_cache:
-            cache_key = self._get_cache_key(func.__name__, *args, **kwargs)
-            cached_result = self._get_from_cache(cache_key)
-            if cached_result is not None:
+            cached_result = self.cache.get(cache_key, MISSING)
+            if cached_result is not MISSING:
+                incr("cache_hits")
                 return cached_result
-        
+
+        result = self.single_flight.do_sync(cache_key, self._request_with_retry, func, args, kwargs, max_retries)
+        if use_cache:
+            self.cache.set(cache_key, result)
+        return result
+
+    def _request_with_retry(self, func, args, kwargs, max_retries):
         last_exception = None
+        tried = set()
         
-        for attempt in range(max_retries):
-            try:
-                # Try current endpoint
-                current_endpoint = self._get_current_endpoint()
-                if not self._is_endpoint_available(current_endpoint):
-                    self._switch_to_next_endpoint()
-                    continue
-                
+        with span("rpc") as trace_span:
+            for attempt in range(max_retries):
+                current_endpoint = self._pick_endpoint(exclude=tried)
+                tried.add(current_endpoint)
+                if attempt:
+                    RPC_FAILOVERS.inc()
+                trace_span.set(endpoint=endpoint_label(current_endpoint), retries=attempt)
                 # Rate limiting delay per endpoint
                 self._rate_limit_delay(current_endpoint)
-                
-                # Make the request
-                result = func(*args, **kwargs)
-                
-                # Cache the result
-                if use_cache:
-                    self._set_cache(cache_key, result)
-                
-                return result
-                
-            except requests.exceptions.HTTPError as e:
-                if e.response.status_code == 429:  # Rate limited
-                    logger.warning(f"Rate limited on endpoint {current_endpoint}: {e}")
-                    self._mark_endpoint_rate_limited(current_endpoint)
-                    self._switch_to_next_endpoint()
-                    last_exception = e
-                    continue
-                elif e.response.status_code in [401, 403]:  # Unauthorized/Forbidden
-                    logger.warning(f"Unauthorized access to endpoint {current_endpoint}: {e}")
-                    self._mark_endpoint_rate_limited(current_endpoint)
-                    self._switch_to_next_endpoint()
+                # func() picks up the endpoint through _get_current_endpoint()/get_web3_instance()
+                self._local.endpoint = current_endpoint
+                started = self._begin_request(current_endpoint)
+                ok = False
+                try:
+                    result = func(*args, **kwargs)
+                    ok = True
+                    return result
+
+                except requests.exceptions.HTTPError as e:
+                    self._handle_http_status(current_endpoint, e.response.status_code, e.response.headers, e)
                     last_exception = e
-                    continue
-                else:
-                    logger.error(f"HTTP error on endpoint {current_endpoint}: {e}")
-                    self._switch_to_next_endpoint()
+
+                except Exception as e:
+                    logger.error(f"Request failed on endpoint {current_endpoint}: {e}")
                     last_exception = e
-                    continue
-                    
-            except (Web3Exception, requests.exceptions.RequestException, Exception) as e:
-                logger.error(f"Request failed on endpoint {current_endpoint}: {e}")
-                self._switch_to_next_endpoint()
-                last_exception = e
-                continue
-        
+
+                finally:
+                    self._local.endpoint = None
+                    self._end_request(current_endpoint, started, ok)
+
         # If all retries failed, raise the last exception
         raise last_exception or Exception("All RPC endpoints failed")
     
-    def get_web3_instance(self) -> Web3:
-        """Get a Web3 instance with the current endpoint."""
+    def _get_batch_size(self, endpoint: str) -> int:
+        """Max number of items the endpoint accepts in one JSON-RPC batch."""
+        return self.batch_sizes.get(endpoint, self.default_batch_size)
+
+    def _split_for_endpoint(self, endpoint: str, payloads: List[dict]) -> List[List[dict]]:
+        size = self._get_batch_size(endpoint)
+        return [payloads[i:i + size] for i in range(0, len(payloads), size)]
+
+    @staticmethod
+    def _make_batch_payloads(calls: List[tuple], first_id: int) -> List[dict]:
+        return [
+            {"jsonrpc": "2.0", "id": first_id + i, "method": method, "params": params}
+            for i, (method, params) in enumerate(calls)
+        ]
+
+    @staticmethod
+    def _parse_batch_response(data: Any) -> Dict[int, dict]:
+        if not isinstance(data, list):
+            # Endpoint rejected the batch as a whole (e.g. batch too large)
+            error = data.get("error", {}) if isinstance(data, dict) else {}
+            raise RPCError(error.get("code", -1), error.get("message", "batch rejected"))
+        return {item.get("id"): item for item in data}
+
+    @staticmethod
+    def _fill_batch_results(results: List[Any], payloads: List[dict], responses: Any):
+        """Put each batch item's result (or RPCError) at its call index."""
+        for payload in payloads:
+            if isinstance(responses, Exception):
+                results[payload["id"]] = responses
+                continue
+            response = responses.get(payload["id"])
+            if response is None:
+                results[payload["id"]] = RPCError(-1, "missing response in batch")
+            elif "error" in response:
+                error = response["error"] or {}
+                results[payload["id"]] = RPCError(error.get("code", -1), error.get("message", ""))
+            else:
+                results[payload["id"]] = response.get("result")
+
+    # ---------- async engine ----------
+    def _get_async_client(self) -> httpx.AsyncClient:
+        if self._async_client is None or self._async_client.is_closed:
+            self._async_client = httpx.AsyncClient(
+                timeout=self.request_timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency,
+                    keepalive_expiry=60,
+                ),
+            )
+        return self._async_client
+
+    def _get_async_semaphore(self) -> asyncio.Semaphore:
+        if self._async_semaphore is None:
+            self._async_semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._async_semaphore
+
+    async def _async_post(self, endpoint: str, payload: Any) -> Any:
+        """POST a JSON-RPC payload (single or batch) to the endpoint."""
+        # Wait for a token before taking a concurrency slot, so throttled calls don't hold one
+        await self._get_bucket(endpoint).acquire()
+        async with self._get_async_semaphore():
+            resp = await self._get_async_client().post(endpoint, json=payload)
+            resp.raise_for_status()
+            return resp.json()
+
+    async def _make_async_request_with_retry(self, func, *args, max_retries=3):
+        """Async retry/failover loop; `func(endpoint, *args)` is awaited on the picked endpoint."""
+        last_exception = None
+        tried = set()
+
+        with span("rpc") as trace_span:
+            for attempt in range(max_retries):
+                current_endpoint = self._pick_endpoint(exclude=tried)
+                tried.add(current_endpoint)
+                if attempt:
+                    RPC_FAILOVERS.inc()
+                trace_span.set(endpoint=endpoint_label(current_endpoint), retries=attempt)
+                started = self._begin_request(current_endpoint)
+                ok = False
+                try:
+                    result = await func(current_endpoint, *args)
+                    ok = True
+                    return result
+
+                except httpx.HTTPStatusError as e:
+                    self._handle_http_status(current_endpoint, e.response.status_code, e.response.headers, e)
+                    last_exception = e
+
+                except Exception as e:
+                    logger.error(f"Request failed on endpoint {current_endpoint}: {e}")
+                    last_exception = e
+
+                finally:
+                    self._end_request(current_endpoint, started, ok)
+
+        raise last_exception or Exception("All RPC endpoints failed")
+
+    async def async_request(self, method: str, params: list) -> Any:
+        """Single JSON-RPC call on the async engine."""
+        async def _request(endpoint):
+            data = await self._async_post(
+                endpoint, {"jsonrpc": "2.0", "id": 1, "method": method, "params": params}
+            )
+            if "error" in data:
+                error = data["error"] or {}
+                raise RPCError(error.get("code", -1), error.get("message", ""))
+            return data.get("result")
+
+        return await self._make_async_request_with_retry(_request)
+
+    async def async_batch_request(self, calls: List[tuple]) -> List[Any]:
+        """Send many (method, params) JSON-RPC calls packed into batch POSTs.
+
+        Calls are chunked by the active endpoint's batch size and all chunks
+        are in flight at once, bounded by max_concurrency; each chunk gets the
+        usual retry/failover. Returns results in call order, with an RPCError
+        in place of every item the node answered with an error.
+        """
+        results: List[Any] = [None] * len(calls)
+        chunk_size = self._get_batch_size(self._get_current_endpoint())
+
+        async def _post_chunk(start: int):
+            payloads = self._make_batch_payloads(calls[start:start + chunk_size], start)
+
+            async def _request(endpoint):
+                responses = {}
+                pieces = await asyncio.gather(*(
+                    self._async_post(endpoint, piece) for piece in self._split_for_endpoint(endpoint, payloads)
+                ))
+                for data in pieces:
+                    responses.update(self._parse_batch_response(data))
+                return responses
+
+            try:
+                responses = await self._make_async_request_with_retry(_request)
+            except Exception as e:
+                responses = e
+            self._fill_batch_results(results, payloads, responses)
+
+        starts = range(0, len(calls), chunk_size)
+        with span("rpc.batch", calls=len(calls), chunks=len(starts)):
+            await asyncio.gather(*(_post_chunk(start) for start in starts))
+        return results
+
+    async def async_call(self, bound_func, block: str = "latest", use_cache: bool = True) -> Any:
+        """eth_call a bound contract function (e.g. `lens.functions.getAccountInfo(a, v)`) and decode it."""
+        tx = {"to": bound_func.address, "data": bound_func._encode_transaction_data()}
+        key = self.cache_key("eth_call", tx["to"], tx["data"], block)
+        if use_cache:
+            cached = self.cache.get(key, MISSING)
+            if cached is not MISSING:
+                incr("cache_hits")
+                return cached
+
+        raw = await self.single_flight.do(key, self.async_request, "eth_call", [tx, block])
+        # Пустой ответ (нет контракта по адресу, узел вернул null) — ошибка RPC, а не ValueError из декодера
+        if not raw or (raw == "0x" and bound_func.abi.get("outputs")):
+            raise RPCError(-1, f"empty eth_call result from {tx['to']}")
+        result = decode_output(bound_func, bytes.fromhex(raw[2:]))
+        if use_cache:
+            self.cache.set(key, result)
+        return result
+
+    async def async_multicall(self, calls: list, allow_failure: bool = True, use_cache: bool = True) -> List[Any]:
+        """Async counterpart of multicall; chunks are sent concurrently."""
+        multicall = self.get_contract(MULTICALL3_ADDRESS, MULTICALL3_ABI)
+        results, pending = self._split_cached_calls(calls, use_cache)
+        chunks = [
+            pending[start:start + self.multicall_chunk_size]
+            for start in range(0, len(pending), self.multicall_chunk_size)
+        ]
+
+        async def _run_chunk(chunk):
+            raw_results = await self.async_call(
+                multicall.functions.aggregate3(self._make_multicall_payload([fn for _, fn, _ in chunk], allow_failure)),
+                use_cache=False,
+            )
+            self._store_multicall_results(results, chunk, raw_results)
+
+        with span("rpc.multicall", calls=len(calls), cache_hits=len(calls) - len(pending), chunks=len(chunks)):
+            await asyncio.gather(*(_run_chunk(chunk) for chunk in chunks))
+        return results
+
+    async def aclose(self):
+        """Close the async HTTP client (call on shutdown)."""
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+    def _make_session(self) -> requests.Session:
+        """requests session whose keep-alive pool matches the concurrency limit."""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.rpc_endpoints), pool_maxsize=self.max_concurrency)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def get_web3_instance(self) -> "Web3":
+        """Get the pooled Web3 instance of the current endpoint."""
+        from web3 import Web3, HTTPProvider
         current_endpoint = self._get_current_endpoint()
-        return Web3(HTTPProvider(current_endpoint))
-    
+        w3 = self._web3_instances.get(current_endpoint)
+        if w3 is None:
+            with self._pool_lock:
+                w3 = self._web3_instances.get(current_endpoint)
+                if w3 is None:
+                    w3 = Web3(HTTPProvider(
+                        current_endpoint,
+                        request_kwargs={"timeout": self.request_timeout},
+                        session=self.session,
+                    ))
+                    # Проверка chainId стоит лишнего eth_chainId перед каждым eth_call;
+                    # клиент только читает и всегда смотрит в mainnet — проверять нечего
+                    w3.middleware_onion.remove("validation")
+                    self._web3_instances[current_endpoint] = w3
+        return w3
+
+    def _get_abi_key(self, abi: list) -> str:
+        cached = self._abi_keys.get(id(abi))
+        if cached is not None and cached[0] is abi:
+            return cached[1]
+        key = hashlib.sha1(json.dumps(abi, sort_keys=True).encode()).hexdigest()
+        self._abi_keys[id(abi)] = (abi, key)
+        return key
+
+    def _get_codec_web3(self) -> "Web3":
+        if self._codec_web3 is None:
+            from web3 import Web3
+            self._codec_web3 = Web3()
+        return self._codec_web3
+
+    def warm_up(self):
+        """Import web3/eth_abi and build the codec ahead of the first request (run in a thread)."""
+        self._get_codec_web3()
+        import eth_abi  # noqa: F401
+        import web3._utils.abi  # noqa: F401
+
+    def get_contract(self, address: str, abi: list, w3: Optional["Web3"] = None):
+        """Prebuilt contract object cached per (endpoint, address, ABI).
+
+        Without `w3` the contract is bound to a provider-less Web3 and is only
+        good for building calldata (multicall / async engine).
+        """
+        w3 = w3 or self._get_codec_web3()
+        endpoint = getattr(w3.provider, "endpoint_uri", None) if w3 is not self._codec_web3 else None
+        key = (endpoint, address, self._get_abi_key(abi))
+        contract = self._contracts.get(key)
+        if contract is None:
+            contract = w3.eth.contract(address=address, abi=abi)
+            self._contracts[key] = contract
+        return contract
+
     def call_contract_function(self, contract_func, *args, **kwargs):
         """Call a contract function with automatic retry and endpoint switching."""
         def _call():
-            w3 = self.get_web3_instance()
-            # Recreate the contract with the new Web3 instance
-            contract = w3.eth.contract(
-                address=contract_func.contract.address,
-                abi=contract_func.contract.abi
-            )
-            # Get the function from the new contract
+            # Prebuilt contract on the current endpoint's Web3 instance
+            contract = self.get_contract(contract_func.address, contract_func.contract_abi, self.get_web3_instance())
             new_func = getattr(contract.functions, contract_func.fn_name)
             return new_func(*args).call(**kwargs)
         
-        return self._make_request_with_retry(_call)
+        cache_key = None
+        if not kwargs:
+            cache_key = self.cache_key("eth_call", contract_func.address, contract_func(*args)._encode_transaction_data())
+        return self._make_request_with_retry(_call, cache_key=cache_key)
     
+    def multicall(self, calls: list, allow_failure: bool = True, use_cache: bool = True) -> List[Any]:
+        """Execute many contract calls through Multicall3.aggregate3.
+
+        `calls` are bound contract functions (e.g. `comet.functions.balanceOf(addr)`).
+        Returns decoded results in the same order; a sub-call that reverted yields
+        None when `allow_failure` is set, otherwise the whole batch fails.
+        """
+        results, pending = self._split_cached_calls(calls, use_cache)
+        for start in range(0, len(pending), self.multicall_chunk_size):
+            chunk = pending[start:start + self.multicall_chunk_size]
+            payload = self._make_multicall_payload([fn for _, fn, _ in chunk], allow_failure)
+
+            def _aggregate3():
+                multicall = self.get_contract(MULTICALL3_ADDRESS, MULTICALL3_ABI, self.get_web3_instance())
+                return multicall.functions.aggregate3(payload).call()
+
+            # Keyed (for single-flight only) on the aggregate3 calldata
+            calldata = self.get_contract(MULTICALL3_ADDRESS, MULTICALL3_ABI).functions.aggregate3(payload)._encode_transaction_data()
+            raw_results = self._make_request_with_retry(
+                _aggregate3,
+                use_cache=False,
+                cache_key=self.cache_key("eth_call", MULTICALL3_ADDRESS, calldata),
+            )
+            self._store_multicall_results(results, chunk, raw_results)
+
+        return results
+
+    def _split_cached_calls(self, calls: list, use_cache: bool) -> tuple:
+        """Serve multicall sub-calls from the cache; return (results, [(index, fn, key)] still to fetch)."""
+        results: List[Any] = [None] * len(calls)
+        pending = []
+        for i, fn in enumerate(calls):
+            key = self.cache_key("eth_call", fn.address, fn._encode_transaction_data())
+            cached = self.cache.get(key, MISSING) if use_cache else MISSING
+            if cached is MISSING:
+                pending.append((i, fn, key))
+            else:
+                results[i] = cached
+        return results, pending
+
+    def _store_multicall_results(self, results: List[Any], chunk: list, raw_results: list):
+        decoded = self._decode_multicall_results([fn for _, fn, _ in chunk], raw_results)
+        for (i, _, key), value in zip(chunk, decoded):
+            results[i] = value
+            # Failed sub-calls are not cached
+            if value is not None:
+                self.cache.set(key, value)
+
+    def _make_multicall_payload(self, chunk: list, allow_failure: bool) -> list:
+        return [
+            (to_checksum_address(fn.address), allow_failure, fn._encode_transaction_data())
+            for fn in chunk
+        ]
+
+    @staticmethod
+    def _decode_multicall_results(chunk: list, raw_results: list) -> List[Any]:
+        """Decode aggregate3 (success, returnData) pairs with each sub-call's output types."""
+        results = []
+        for fn, (success, return_data) in zip(chunk, raw_results):
+            if not success or not return_data:
+                results.append(None)
+                continue
+            try:
+                results.append(decode_output(fn, return_data))
+            except Exception as e:
+                logger.warning(f"Failed to decode multicall result for {fn.fn_name}: {e}")
+                results.append(None)
+        return results
+
     def get_balance(self, address: str):
         """Get ETH balance with automatic retry and endpoint switching."""
         def _get_balance():
             w3 = self.get_web3_instance()
             return w3.eth.get_balance(address)
         
-        return self._make_request_with_retry(_get_balance)
+        return self._make_request_with_retry(_get_balance, cache_key=self.cache_key("eth_getBalance", address))
     
     def get_chain_id(self):
         """Get chain ID with automatic retry and endpoint switching."""
@@ -209,96 +703,60 @@ class RPCManager:
             w3 = self.get_web3_instance()
             return w3.eth.chain_id
         
-        return self._make_request_with_retry(_get_chain_id)
+        return self._make_request_with_retry(_get_chain_id, cache_key=self.cache_key("eth_chainId"))
     
     async def get_balances_concurrent(self, addresses: List[str]) -> Dict[str, Any]:
-        """Get balances for multiple addresses concurrently."""
-        async def _get_single_balance(address: str):
-            def _get_balance():
-                w3 = self.get_web3_instance()
-                balance_wei = w3.eth.get_balance(address)
-                # Convert wei to ETH
-                return w3.from_wei(balance_wei, "ether")
-            
-            try:
-                return address, self._make_request_with_retry(_get_balance)
-            except Exception as e:
-                logger.error(f"Error getting balance for {address}: {e}")
-                return address, 0
-        
-        # Create tasks for all addresses
-        tasks = [_get_single_balance(addr) for addr in addresses]
-        
-        # Execute concurrently
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        
-        # Process results
+        """Get balances for multiple addresses with batched eth_getBalance calls.
+
+        Balances are returned in ETH; an address whose call failed maps to the exception.
+        """
         balance_dict = {}
-        for result in results:
-            if isinstance(result, Exception):
-                logger.error(f"Task failed: {result}")
-                continue
-            address, balance = result
-            balance_dict[address] = balance
-        
-        return balance_dict
-    
-    async def get_vault_positions_concurrent(self, addresses: List[str], vault_address: str, contract_address: str, contract_abi: list) -> Dict[str, Any]:
-        """Get vault positions for multiple addresses concurrently."""
-        async def _get_single_position(address: str):
-            try:
-                # Run the synchronous call in a thread
-                def _sync_call():
-                    w3_instance = self.get_web3_instance()
-                    # Recreate the contract with the new Web3 instance
-                    lens_contract = w3_instance.eth.contract(
-                        address=contract_address,
-                        abi=contract_abi
-                    )
-                    
-                    # Make the call with retry logic
-                    def _call():
-                        return lens_contract.functions.getAccountInfo(
-                            w3_instance.to_checksum_address(address),
-                            w3_instance.to_checksum_address(vault_address)
-                        ).call()
-                    
-                    result = self._make_request_with_retry(_call)
-                    assets = w3_instance.from_wei(result[1][6], "ether")
-                    return address, assets
-                
-                # Run in thread to avoid blocking
-                return await asyncio.to_thread(_sync_call)
-            except Exception as e:
-                logger.error(f"Error getting vault position for {address}: {e}")
-                return address, 0
-        
-        # Create tasks for all addresses
-        tasks = [_get_single_position(addr) for addr in addresses]
-        
-        # Execute concurrently
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        
-        # Process results
-        position_dict = {}
-        for result in results:
+        missing = []
+        for address in addresses:
+            cached = self.cache.get(self.cache_key("eth_getBalance", address), MISSING)
+            if cached is MISSING:
+                missing.append(address)
+            else:
+                balance_dict[address] = from_wei(cached, "ether")
+
+        async def _fetch_balances(keys):
+            # key = (chain, method, address, calldata, block)
+            results = await self.async_batch_request([("eth_getBalance", [key[2], "latest"]) for key in keys])
+            for key, result in zip(keys, results):
+                if not isinstance(result, Exception):
+                    self.cache.set(key, int(result, 16))
+            return results
+
+        # Addresses already being fetched by a concurrent call are awaited, not re-requested
+        keys = {address: self.cache_key("eth_getBalance", address) for address in missing}
+        with span("rpc.balances", addresses=len(addresses), cache_hits=len(addresses) - len(missing)):
+            results = await self.single_flight.do_many(list(keys.values()), _fetch_balances)
+
+        for address in missing:
+            result = results[keys[address]]
             if isinstance(result, Exception):
-                logger.error(f"Task failed: {result}")
+                logger.error(f"Error getting balance for {address}: {result}")
+                balance_dict[address] = result
                 continue
-            address, position = result
-            position_dict[address] = position
-        
-        return position_dict
-    
+            balance_dict[address] = from_wei(int(result, 16), "ether")
+
+        return {address: balance_dict[address] for address in addresses}
+
     def clear_rate_limits(self):
         """Clear all rate limits (useful for testing)."""
-        self.rate_limited_endpoints.clear()
+        with self.health_lock:
+            for health in self.health.values():
+                health.cooldown_until = 0.0
         logger.info("Cleared all rate limits")
 
 # Global RPC manager instance
 rpc_manager = RPCManager()
 
-def get_web3() -> Web3:
+def get_endpoint_scores() -> List[dict]:
+    """Health and routing score of every RPC endpoint, best first."""
+    return rpc_manager.get_endpoint_scores()
+
+def get_web3() -> "Web3":
     """Get a Web3 instance with automatic failover."""
     return rpc_manager.get_web3_instance()
 
@@ -306,6 +764,10 @@ def call_contract_with_retry(contract_func, *args, **kwargs):
     """Call a contract function with automatic retry and endpoint switching."""
     return rpc_manager.call_contract_function(contract_func, *args, **kwargs)
 
+def multicall_with_retry(calls: list, allow_failure: bool = True, use_cache: bool = True) -> List[Any]:
+    """Execute many contract calls in one eth_call via Multicall3."""
+    return rpc_manager.multicall(calls, allow_failure=allow_failure, use_cache=use_cache)
+
 def get_balance_with_retry(address: str):
     """Get ETH balance with automatic retry and endpoint switching."""
     return rpc_manager.get_balance(address)
@@ -314,6 +776,20 @@ async def get_balances_concurrent(addresses: List[str]) -> Dict[str, Any]:
     """Get balances for multiple addresses concurrently."""
     return await rpc_manager.get_balances_concurrent(addresses)
 
-async def get_vault_positions_concurrent(addresses: List[str], vault_address: str, contract_address: str, contract_abi: list) -> Dict[str, Any]:
-    """Get vault positions for multiple addresses concurrently."""
-    return await rpc_manager.get_vault_positions_concurrent(addresses, vault_address, contract_address, contract_abi)
+# Снимаются в момент запроса /metrics
+Gauge(
+    "rpc_in_flight", "JSON-RPC requests currently in flight by endpoint", ("endpoint",),
+    lambda: {(endpoint_label(h.endpoint),): h.in_flight for h in list(rpc_manager.health.values())},
+)
+def _endpoint_gauge(field):
+    return lambda: {(endpoint_label(snap["endpoint"]),): snap[field] for snap in get_endpoint_scores()}
+
+Gauge("rpc_endpoint_score", "Routing score of an RPC endpoint (expected cost, lower is better)",
+      ("endpoint",), _endpoint_gauge("score"))
+Gauge("rpc_endpoint_error_rate", "EWMA error rate of an RPC endpoint", ("endpoint",), _endpoint_gauge("error_rate"))
+Gauge("rpc_endpoint_cooldown_seconds", "Seconds until a cooled-down RPC endpoint is tried again",
+      ("endpoint",), _endpoint_gauge("cooldown_left"))
+Gauge("rpc_endpoint_rate", "Current token-bucket rate of an RPC endpoint, requests/s", ("endpoint",), _endpoint_gauge("rate"))
+Gauge("rpc_cache_hits_total", "RPC response cache hits", fn=lambda: {(): rpc_manager.cache.hits}, kind="counter")
+Gauge("rpc_cache_misses_total", "RPC response cache misses", fn=lambda: {(): rpc_manager.cache.misses}, kind="counter")
+Gauge("rpc_cache_entries", "Entries in the RPC response cache", fn=lambda: {(): len(rpc_manager.cache)})
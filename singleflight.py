@@ -0,0 +1,101 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Hashable, List
+
+
+class SingleFlight:
+    """Coalesce identical concurrent upstream calls into one.
+
+    While a call for `key` is in flight, every other caller asking for the
+    same key waits for that call and gets the same result (or exception)
+    instead of hitting the upstream again. Nothing is kept once the call
+    finishes, so this is not a cache: it only collapses simultaneous work.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sync_calls: Dict[Hashable, Future] = {}
+        self._async_calls: Dict[Hashable, asyncio.Future] = {}
+
+    def do_sync(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Thread-safe variant for blocking callers."""
+        with self._lock:
+            future = self._sync_calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._sync_calls[key] = future
+
+        if not leader:
+            return future.result()
+
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._sync_calls.pop(key, None)
+        return future.result()
+
+    def _get_async_future(self, key: Hashable):
+        future = self._async_calls.get(key)
+        if future is not None and future.get_loop() is not asyncio.get_running_loop():
+            return None
+        return future
+
+    async def do(self, key: Hashable, coro_fn: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """Async variant: the leader's coroutine runs as a task shared by all waiters."""
+        future = self._get_async_future(key)
+        if future is None:
+            future = asyncio.ensure_future(coro_fn(*args, **kwargs))
+            self._async_calls[key] = future
+            future.add_done_callback(lambda _: self._async_calls.pop(key, None))
+        # shield: one waiter being cancelled must not cancel the shared call
+        return await asyncio.shield(future)
+
+    async def do_many(self, keys: List[Hashable], fetch_many: Callable[[List[Hashable]], Awaitable[List[Any]]]) -> Dict[Hashable, Any]:
+        """Batch variant: keys already in flight are awaited, the rest go out in one `fetch_many(keys)`.
+
+        `fetch_many` returns results aligned with its keys; per-key exceptions
+        may be returned as values and are passed through as values. Like `do`,
+        the fetch runs as its own task, so cancelling the caller that started
+        it doesn't cancel it for the others.
+        """
+        loop = asyncio.get_running_loop()
+        owned, waiting = [], {}
+        for key in dict.fromkeys(keys):
+            future = self._get_async_future(key)
+            if future is None:
+                future = loop.create_future()
+                self._async_calls[key] = future
+                owned.append(key)
+            waiting[key] = future
+
+        if owned:
+            task = asyncio.ensure_future(fetch_many(owned))
+            task.add_done_callback(lambda task: self._settle_many(task, owned, waiting))
+
+        # shield: one waiter being cancelled must not cancel the shared call
+        return {key: await asyncio.shield(future) for key, future in waiting.items()}
+
+    def _settle_many(self, task: asyncio.Future, owned: List[Hashable], waiting: Dict[Hashable, asyncio.Future]):
+        """Copy the outcome of a `do_many` fetch onto the futures of the keys it owned."""
+        for key in owned:
+            self._async_calls.pop(key, None)
+        futures = [waiting[key] for key in owned if not waiting[key].done()]
+        if task.cancelled():
+            for future in futures:
+                future.cancel()
+            return
+        error = task.exception()
+        if error is not None:
+            for future in futures:
+                future.set_exception(error)
+                # Waiters see the error via their own await; don't warn about it being unretrieved
+                future.exception()
+            return
+        for key, value in zip(owned, task.result()):
+            if not waiting[key].done():
+                waiting[key].set_result(value)
@@ -0,0 +1,28 @@
+import asyncio
+
+import pytest
+
+import db
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    """Point the global database at a fresh file; the test creates the schema with init_db_sync."""
+    path = str(tmp_path / "wallets.db")
+    monkeypatch.setattr(db, "DB_PATH", path)
+    return path
+
+
+@pytest.fixture
+def run_db(db_path):
+    """Run a coroutine function against the temporary database, opened and closed around it."""
+    def _run(coro_fn):
+        async def _wrapped():
+            await db.open_db()
+            try:
+                return await coro_fn()
+            finally:
+                await db.close_db()
+        return asyncio.run(_wrapped())
+
+    return _run
@@ -0,0 +1,80 @@
+import sqlite3
+
+import db
+
+ETH = "0x" + "ab" * 20
+ETH_CHECKSUM = "0xABaBaBaBABabABabAbAbABAbABabababaBaBABaB"
+BECH32 = "BC1QAR0SRRR7XFKVY5L643LYDNW9RE59GTZZWF5MDQ"
+BASE58 = "1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN2"
+
+
+def make_legacy_db(path, rows):
+    """A wallets.db from before the registry: one user_addresses table."""
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE user_addresses (user_id INTEGER, address TEXT, PRIMARY KEY(user_id, address))")
+        conn.executemany("INSERT INTO user_addresses VALUES(?, ?)", rows)
+
+
+def test_legacy_rows_move_to_registry(db_path, run_db):
+    make_legacy_db(db_path, [
+        (1, ETH.upper()),                           # старый бот сохранял "0X…" как есть
+        (1, BECH32),
+        (2, ETH),
+        (2, BASE58),
+        (2, "0x123"),                               # битый ETH-адрес пропускается
+    ])
+
+    async def body():
+        return await db.list_addresses(1), await db.list_addresses(2), await db.list_addresses_all()
+
+    db.init_db_sync()
+    user1, user2, every = run_db(body)
+
+    assert sorted(user1) == sorted([(ETH_CHECKSUM, "eth"), (BECH32.lower(), "btc")])
+    assert sorted(user2) == sorted([(ETH_CHECKSUM, "eth"), (BASE58, "btc")])
+    # Один кошелёк двух пользователей — одна запись реестра
+    assert sorted(every) == sorted([ETH_CHECKSUM, BECH32.lower(), BASE58])
+    with sqlite3.connect(db_path) as conn:
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert "user_addresses" not in tables
+
+
+def test_migration_is_one_off(db_path, run_db):
+    make_legacy_db(db_path, [(1, ETH), (1, BECH32)])
+    db.init_db_sync()
+
+    assert run_db(lambda: db.remove_address(1, ETH)) is True
+    # Рестарт: удалённый адрес не должен вернуться из старой таблицы
+    db.init_db_sync()
+    assert run_db(lambda: db.list_addresses(1)) == [(BECH32.lower(), "btc")]
+
+
+def test_add_address_reports_new_links_only(run_db):
+    db.init_db_sync()
+
+    async def body():
+        return [
+            await db.add_address(1, ETH),
+            await db.add_address(1, ETH.lower()),
+            await db.add_address(2, ETH),
+        ]
+
+    assert run_db(body) == [True, False, True]
+    assert run_db(lambda: db.list_addresses_all("eth")) == [ETH_CHECKSUM]
+
+
+def test_compound_snapshots_follow_registry(run_db):
+    db.init_db_sync()
+    other = "0x" + "cd" * 20
+
+    async def body():
+        await db.add_address(1, ETH)
+        await db.add_address(1, other)
+        addrs = await db.list_addresses_all("eth")
+        await db.save_compound_positions("comet", {a: ("USDC", 1, 0, []) for a in addrs})
+        await db.remove_address(1, other)
+        # Упавшее чтение оставляет прежний снимок, удалённый из реестра адрес уходит
+        await db.save_compound_positions("comet", {ETH_CHECKSUM: TimeoutError()})
+        return await db.get_compound_positions(addrs, "comet")
+
+    assert list(run_db(body)) == [ETH_CHECKSUM]
@@ -0,0 +1,58 @@
+import db
+import history
+from history import RAW, HOURLY, DAILY
+
+# Середина дня: есть и завершённые часы, и незавершённый текущий
+NOW = 1_700_000_000 // DAILY * DAILY + 5 * HOURLY + 600
+HOUR = NOW // HOURLY * HOURLY - 2 * HOURLY
+
+
+def hourly_point(rows, asset="btc"):
+    return [(ts, usd) for resolution, a, ts, usd, _ in rows if resolution == HOURLY and a == asset]
+
+
+def test_rollup_advances_watermarks_to_last_complete_bucket(run_db):
+    db.init_db_sync()
+
+    async def body():
+        await db.insert_history_points(1, HOUR + 60, {"btc": (100, 9000)})
+        await db.insert_history_points(1, HOUR + 120, {"btc": (200, 18000)})
+        await history.rollup(now=NOW)
+        return await db.get_rollup_watermarks(), await db.query_history(1, (HOURLY,), 0)
+
+    watermarks, rows = run_db(body)
+    assert watermarks == {HOURLY: NOW // HOURLY * HOURLY, DAILY: NOW // DAILY * DAILY}
+    assert hourly_point(rows) == [(HOUR, 150)]
+
+
+def test_rollup_skips_buckets_below_watermark(run_db):
+    db.init_db_sync()
+
+    async def body():
+        await db.insert_history_points(1, HOUR + 60, {"btc": (100, 9000)})
+        await history.rollup(now=NOW)
+        # Опоздавшая точка в уже свёрнутом часе: бакет не пересчитывается
+        await db.insert_history_points(1, HOUR + 180, {"btc": (300, 27000)})
+        # Точка в часе, который завершится только к следующему запуску
+        current = NOW // HOURLY * HOURLY
+        await db.insert_history_points(1, current + 60, {"btc": (500, 45000)})
+        await history.rollup(now=NOW + HOURLY)
+        return await db.get_rollup_watermarks(), await db.query_history(1, (HOURLY,), 0)
+
+    watermarks, rows = run_db(body)
+    current = NOW // HOURLY * HOURLY
+    assert watermarks[HOURLY] == current + HOURLY
+    assert hourly_point(rows) == [(HOUR, 100), (current, 500)]
+
+
+def test_rollup_prunes_expired_raw_points(run_db):
+    db.init_db_sync()
+    old = NOW - history.RETENTION[RAW] - HOURLY
+
+    async def body():
+        await db.insert_history_points(1, old, {"eth": (1, 90)})
+        await db.insert_history_points(1, HOUR, {"eth": (2, 180)})
+        await history.rollup(now=NOW)
+        return await db.query_history(1, (RAW,), 0)
+
+    assert [row[2] for row in run_db(body)] == [HOUR]
@@ -0,0 +1,51 @@
+import pytest
+
+import rate_limiter
+from rate_limiter import TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Frozen monotonic clock the test moves by hand."""
+    now = [1000.0]
+    monkeypatch.setattr(rate_limiter.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_burst_is_free_then_waits_one_interval(clock):
+    bucket = TokenBucket(rate=10, burst=3)
+    assert [bucket.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.reserve() == pytest.approx(0.1)
+    assert bucket.reserve() == pytest.approx(0.2)
+
+
+def test_rate_limited_halves_rate_down_to_min(clock):
+    bucket = TokenBucket(rate=8, burst=4, min_rate=1.5)
+    rates = []
+    for _ in range(4):
+        bucket.on_rate_limited()
+        rates.append(bucket.rate)
+    assert rates == [4, 2, 1.5, 1.5]
+    # Все токены сгорели: следующий запрос ждёт интервал уже по сниженной скорости
+    assert bucket.reserve() == pytest.approx(1 / 1.5)
+
+
+def test_retry_after_blocks_until_deadline(clock):
+    bucket = TokenBucket(rate=100, burst=10)
+    bucket.on_rate_limited(retry_after=5)
+    assert bucket.expected_wait() == pytest.approx(5)
+    clock[0] += 4
+    assert bucket.reserve() == pytest.approx(1)
+    clock[0] += 2
+    assert bucket.reserve() == 0.0
+
+
+def test_success_recovers_additively_to_max_rate(clock):
+    bucket = TokenBucket(rate=20, burst=5)
+    bucket.on_rate_limited()
+    assert bucket.rate == 10
+    bucket.on_success()
+    assert bucket.rate == pytest.approx(11)  # +5% от максимальной скорости
+    for _ in range(100):
+        bucket.on_success()
+    assert bucket.rate == 20
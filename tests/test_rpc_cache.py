@@ -0,0 +1,62 @@
+import pytest
+
+import rpc_cache
+from rpc_cache import RPCCache, MISSING
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rpc_cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def balance_key(cache, address):
+    return cache.make_key(1, "eth_getBalance", address)
+
+
+def test_entry_expires_after_method_ttl(clock):
+    cache = RPCCache()
+    key = balance_key(cache, "0xAbC")
+    cache.set(key, 5)
+    clock[0] += cache.method_ttls["eth_getBalance"] - 1
+    assert cache.get(key, MISSING) == 5
+    clock[0] += 1
+    assert cache.get(key, MISSING) is MISSING
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_none_is_a_cached_value(clock):
+    cache = RPCCache()
+    key = balance_key(cache, "0x1")
+    cache.set(key, None)
+    assert cache.get(key, MISSING) is None
+
+
+def test_immutable_getter_outlives_eth_call_ttl(clock):
+    cache = RPCCache(immutable_ttl=3600)
+    symbol = cache.make_key(1, "eth_call", "0xToken", "0x95d89b41")   # symbol()
+    balance_of = cache.make_key(1, "eth_call", "0xToken", "0x70a08231" + "00" * 32)
+    cache.set(symbol, "USDC")
+    cache.set(balance_of, 7)
+    clock[0] += 60
+    assert cache.get(symbol) == "USDC"
+    assert cache.get(balance_of, MISSING) is MISSING
+
+
+def test_lru_evicts_least_recently_used(clock):
+    cache = RPCCache(max_entries=2)
+    a, b, c = (balance_key(cache, addr) for addr in ("0xa", "0xb", "0xc"))
+    cache.set(a, 1)
+    cache.set(b, 2)
+    cache.get(a)            # a свежее b
+    cache.set(c, 3)
+    assert cache.get(b, MISSING) is MISSING
+    assert cache.get(a) == 1 and cache.get(c) == 3
+    assert len(cache) == 2
+
+
+def test_keys_ignore_address_case():
+    cache = RPCCache()
+    assert balance_key(cache, "0xABC") == balance_key(cache, "0xabc")
@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def test_do_coalesces_concurrent_calls():
+    flight = SingleFlight()
+    calls = []
+
+    async def fetch(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return f"value-{key}"
+
+    async def main():
+        return await asyncio.gather(*(flight.do("k", fetch, "k") for _ in range(5)))
+
+    assert asyncio.run(main()) == ["value-k"] * 5
+    assert calls == ["k"]
+
+
+def test_do_spreads_failure_to_followers_and_forgets_key():
+    flight = SingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("upstream down")
+
+    async def main():
+        results = await asyncio.gather(*(flight.do("k", fetch) for _ in range(3)), return_exceptions=True)
+        # Ничего не кэшируется: следующий вызов снова идёт в апстрим
+        with pytest.raises(RuntimeError):
+            await flight.do("k", fetch)
+        return results
+
+    results = asyncio.run(main())
+    assert all(isinstance(r, RuntimeError) and str(r) == "upstream down" for r in results)
+    assert len(calls) == 2
+
+
+def test_do_waiter_cancellation_does_not_cancel_shared_call():
+    flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.02)
+        return 42
+
+    async def main():
+        first = asyncio.ensure_future(flight.do("k", fetch))
+        second = asyncio.ensure_future(flight.do("k", fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(main()) == 42
+
+
+def test_do_many_aligns_results_and_fetches_only_new_keys():
+    flight = SingleFlight()
+    batches = []
+
+    async def fetch_many(keys):
+        batches.append(list(keys))
+        await asyncio.sleep(0.01)
+        # Ошибка одного ключа приходит значением и значением же отдаётся
+        return [ValueError(k) if k == "bad" else k.upper() for k in keys]
+
+    async def main():
+        first = asyncio.ensure_future(flight.do_many(["a", "b", "bad"], fetch_many))
+        await asyncio.sleep(0)
+        second = await flight.do_many(["c", "a", "b", "c"], fetch_many)
+        return await first, second
+
+    first, second = asyncio.run(main())
+    assert first["a"] == "A" and first["b"] == "B" and isinstance(first["bad"], ValueError)
+    assert second == {"c": "C", "a": "A", "b": "B"}
+    assert batches == [["a", "b", "bad"], ["c"]]
+
+
+def test_do_many_spreads_fetch_failure_to_followers():
+    flight = SingleFlight()
+
+    async def fetch_many(keys):
+        await asyncio.sleep(0.01)
+        raise ConnectionError("batch rejected")
+
+    async def follower_fetch(keys):
+        raise AssertionError(f"keys {keys} should have been awaited, not fetched")
+
+    async def main():
+        leader = asyncio.ensure_future(flight.do_many(["a", "b"], fetch_many))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do_many(["b"], follower_fetch))
+        single = asyncio.ensure_future(flight.do("a", follower_fetch, ["a"]))
+        return await asyncio.gather(leader, follower, single, return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(r, ConnectionError) for r in results)
@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import logging
+import itertools
+import threading
+import contextvars
+from logging.handlers import RotatingFileHandler
+
+logger = logging.getLogger(__name__)
+
+# Файл JSON-трасс (строка на запрос); TRACE_LOG= пустой — не пишем
+TRACE_LOG = os.getenv("TRACE_LOG", "traces.jsonl")
+TRACE_LOG_MAX_BYTES = int(os.getenv("TRACE_LOG_MAX_BYTES", str(20 * 2 ** 20)))
+TRACE_LOG_BACKUPS = 3
+RENDER_MAX_CHARS = 3800  # лимит сообщения Telegram — 4096
+
+# Текущий спан; asyncio-задачи и asyncio.to_thread получают копию контекста,
+# так что вложенные вызовы — и в потоках тоже — вешают спаны на нужного родителя
+_current_span = contextvars.ContextVar("current_span", default=None)
+_log = None
+
+
+class Span:
+    """One timed step of a trace; attributes are free-form (endpoint, retries, cache_hits…)."""
+
+    def __init__(self, trace, name, parent, attrs):
+        self.trace = trace
+        self.id = next(trace._ids)
+        self.parent = parent.id if parent is not None else None
+        self.name = name
+        self.attrs = dict(attrs)
+        self.started = time.monotonic()
+        self.ended = None
+
+    def set(self, **attrs):
+        with self.trace._lock:
+            self.attrs.update(attrs)
+
+    def incr(self, key, amount=1):
+        with self.trace._lock:
+            self.attrs[key] = self.attrs.get(key, 0) + amount
+
+    def end(self):
+        self.ended = time.monotonic()
+
+    def duration(self) -> float:
+        return (self.ended or time.monotonic()) - self.started
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "parent": self.parent,
+            "name": self.name,
+            "start_ms": round((self.started - self.trace.root.started) * 1000, 1),
+            "duration_ms": round(self.duration() * 1000, 1),
+            **self.attrs,
+        }
+
+
+class _NullSpan:
+    """What span() hands out when no trace is active: every call is a no-op."""
+
+    def set(self, **attrs):
+        pass
+
+    def incr(self, key, amount=1):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+
+class Trace:
+    """Spans of one request, rooted at a span named after it."""
+
+    def __init__(self, name, attrs):
+        self.id = os.urandom(6).hex()
+        self.ts = time.time()
+        self.spans = []
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.root = self.start_span(name, None, attrs)
+
+    def start_span(self, name, parent, attrs) -> Span:
+        span = Span(self, name, parent, attrs)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = list(self.spans)
+        return {
+            "trace_id": self.id,
+            "ts": round(self.ts, 3),
+            "name": self.root.name,
+            "duration_ms": round(self.root.duration() * 1000, 1),
+            "spans": [span.to_dict() for span in spans],
+        }
+
+
+class span:
+    """`with span("esplora", endpoint=...) as s:` — a child of the current span, if a trace is active."""
+
+    def __init__(self, name, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.span = None
+
+    def __enter__(self):
+        parent = _current_span.get()
+        if parent is None:
+            return _NULL_SPAN
+        self.span = parent.trace.start_span(self.name, parent, self.attrs)
+        self._token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.span is None:
+            return False
+        if exc_type is not None:
+            self.span.set(error=exc_type.__name__)
+        self.span.end()
+        _current_span.reset(self._token)
+        return False
+
+
+class start_trace:
+    """`with start_trace("portfolio_cmd", user_id=...) as trace:` — root of a new trace.
+
+    On exit the trace goes to the JSON trace log.
+    """
+
+    def __init__(self, name, **attrs):
+        self.trace = Trace(name, attrs)
+
+    def __enter__(self):
+        self._token = _current_span.set(self.trace.root)
+        return self.trace
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.trace.root.set(error=exc_type.__name__)
+        self.trace.root.end()
+        _current_span.reset(self._token)
+        write(self.trace)
+        return False
+
+
+def current_span():
+    return _current_span.get() or _NULL_SPAN
+
+def annotate(**attrs):
+    """Set attributes on the current span (no-op outside a trace)."""
+    current_span().set(**attrs)
+
+def incr(key, amount=1):
+    current_span().incr(key, amount)
+
+
+# ---------- журнал ----------
+def _get_log():
+    global _log
+    if _log is None:
+        _log = logging.getLogger("trace_log")
+        _log.propagate = False
+        _log.setLevel(logging.INFO)
+        handler = RotatingFileHandler(TRACE_LOG, maxBytes=TRACE_LOG_MAX_BYTES, backupCount=TRACE_LOG_BACKUPS)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        _log.addHandler(handler)
+    return _log
+
+def write(trace):
+    if not TRACE_LOG:
+        return
+    try:
+        _get_log().info(json.dumps(trace.to_dict(), ensure_ascii=False, default=str))
+    except Exception as e:
+        # Трасса — отладочная роскошь, запрос из-за неё падать не должен
+        logger.warning(f"Failed to write trace {trace.id}: {e!r}")
+
+
+# ---------- отрисовка ----------
+def _ms(seconds):
+    return f"{seconds * 1000:.0f} мс"
+
+def _merge_attrs(spans):
+    """Numbers are summed across spans, anything else is listed once."""
+    merged = {}
+    for s in spans:
+        for key, value in s.attrs.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                merged[key] = merged.get(key, 0) + value
+            else:
+                merged.setdefault(key, [])
+                if value not in merged[key]:
+                    merged[key].append(value)
+    parts = []
+    for key, value in merged.items():
+        if isinstance(value, list):
+            value = "/".join(map(str, value[:3])) + ("…" if len(value) > 3 else "")
+        parts.append(f"{key}={value}")
+    return ", ".join(parts)
+
+def render(trace) -> str:
+    """Timing breakdown as a tree; sibling spans with the same name are folded into one line."""
+    with trace._lock:
+        spans = list(trace.spans)
+    children = {}
+    for s in spans:
+        children.setdefault(s.parent, []).append(s)
+
+    lines = []
+
+    def walk(group, depth):
+        by_name = {}
+        for s in group:
+            by_name.setdefault(s.name, []).append(s)
+        for name, same in by_name.items():
+            durations = [s.duration() for s in same]
+            if len(same) == 1:
+                timing = _ms(durations[0])
+            else:
+                timing = f"×{len(same)}, макс {_ms(max(durations))}, сумма {_ms(sum(durations))}"
+            attrs = _merge_attrs(same)
+            lines.append(f"{'  ' * depth}{name} — {timing}" + (f" ({attrs})" if attrs else ""))
+            walk([c for s in same for c in children.get(s.id, [])], depth + 1)
+
+    walk(children.get(None, []), 0)
+    header = f"*⏱ Трассировка* `{trace.id}`"
+    body = "\n".join(lines)
+    if len(body) > RENDER_MAX_CHARS:
+        body = body[:RENDER_MAX_CHARS].rsplit("\n", 1)[0] + "\n…"
+    return f"{header}\n```\n{body}\n```"